@@ -11,10 +11,11 @@ import json
 from datetime import datetime
 
 # 导入服务模块
-from services.excel_service import ExcelService
+from services.excel_service import ExcelService, TemplateError
 from services.llm_service import LLMService
 from services.image_service import ImageService
 from services.task_service import TaskService
+from services.coordinator import WorkerCoordinator, LeaseLostError
 from database.db import init_db, get_db_connection
 
 # 创建Flask应用
@@ -62,6 +63,7 @@ with app.app_context():
     app.llm_service = LLMService()
     app.image_service = ImageService()
     app.task_service = TaskService(app.excel_service, app.llm_service, app.image_service)
+    app.coordinator = WorkerCoordinator(app)
 
 # 路由：主页
 @app.route('/')
@@ -86,14 +88,19 @@ def upload_file():
         
         try:
             # 解析Excel文件
-            fields, preview_data = app.excel_service.parse_excel(temp_path)
+            fields, preview_data, row_count, cache_info = app.excel_service.parse_excel(temp_path)
+            cache_info = cache_info or {}
             
-            # 保存文件信息到数据库
+            # 保存文件信息到数据库（同时保存行数和列式缓存，之后不必再解析原始文件）
             conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO excel_schemas (file_name, fields, file_path, created_at) VALUES (?, ?, ?, ?)",
-                (filename, json.dumps(fields), temp_path, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                """INSERT INTO excel_schemas (file_name, fields, file_path, created_at, row_count,
+                cache_path, source_mtime, source_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    filename, json.dumps(fields), temp_path, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), row_count,
+                    cache_info.get('cache_path'), cache_info.get('source_mtime'), cache_info.get('source_hash')
+                )
             )
             schema_id = cursor.lastrowid
             conn.commit()
@@ -103,7 +110,8 @@ def upload_file():
                 'success': True,
                 'schema_id': schema_id,
                 'fields': fields,
-                'preview': preview_data
+                'preview': preview_data,
+                'row_count': row_count
             })
         except Exception as e:
             logger.error(f"Excel解析错误: {str(e)}")
@@ -127,7 +135,15 @@ def process_task():
             schema_id=data['schema_id'],
             prompt_template=data['prompt_template'],
             concurrency=int(data['concurrency']),
-            image_fields=data.get('image_fields', [])
+            image_fields=data.get('image_fields', []),
+            engine=data.get('engine'),
+            api_config_id=data.get('api_config_id'),
+            weight=data.get('weight', 1),
+            pack_size=data.get('pack_size', 1),
+            api_config_ids=data.get('api_config_ids'),
+            row_order=data.get('row_order'),
+            token_budget=data.get('token_budget'),
+            cost_budget=data.get('cost_budget')
         )
         
         # 启动处理任务
@@ -137,10 +153,43 @@ def process_task():
             'success': True,
             'task_id': task_id
         })
+    except TemplateError as e:
+        return jsonify({'error': f'创建任务错误: {str(e)}', 'unknown_fields': e.unknown_fields}), 400
     except Exception as e:
         logger.error(f"创建任务错误: {str(e)}")
         return jsonify({'error': f'创建任务错误: {str(e)}'}), 500
 
+# 路由：预估任务的token数、费用和耗时（不调用LLM）
+@app.route('/estimate', methods=['POST'])
+def estimate_task():
+    data = request.json
+    
+    # 验证请求数据
+    required_fields = ['schema_id', 'prompt_template']
+    if not data or not all(field in data for field in required_fields):
+        return jsonify({'error': '缺少必要参数'}), 400
+    
+    try:
+        estimate = app.task_service.estimate_task(
+            schema_id=data['schema_id'],
+            prompt_template=data['prompt_template'],
+            concurrency=int(data.get('concurrency', 1)),
+            image_fields=data.get('image_fields', []),
+            api_config_id=data.get('api_config_id'),
+            api_config_ids=data.get('api_config_ids')
+        )
+        return jsonify({
+            'success': True,
+            'estimate': estimate
+        })
+    except TemplateError as e:
+        return jsonify({'error': f'预估任务错误: {str(e)}', 'unknown_fields': e.unknown_fields}), 400
+    except ValueError as e:
+        return jsonify({'error': f'预估任务错误: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"预估任务错误: {str(e)}")
+        return jsonify({'error': f'预估任务错误: {str(e)}'}), 500
+
 # 路由：获取任务状态
 @app.route('/task_status/<int:task_id>', methods=['GET'])
 def task_status(task_id):
@@ -161,6 +210,40 @@ def stop_task(task_id):
         logger.error(f"停止任务错误: {str(e)}")
         return jsonify({'error': f'停止任务错误: {str(e)}'}), 500
 
+# 路由：续跑任务
+@app.route('/resume_task/<int:task_id>', methods=['POST'])
+def resume_task(task_id):
+    # 因用完预算而暂停的任务可以在续跑时提高预算
+    data = request.get_json(silent=True) or {}
+    try:
+        app.task_service.resume_task(
+            task_id,
+            token_budget=data.get('token_budget'),
+            cost_budget=data.get('cost_budget')
+        )
+        return jsonify({'success': True})
+    except Exception as e:
+        logger.error(f"续跑任务错误: {str(e)}")
+        return jsonify({'error': f'续跑任务错误: {str(e)}'}), 500
+
+# 路由：重试任务中失败的行
+@app.route('/retry_failed/<int:task_id>', methods=['POST'])
+def retry_failed(task_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        retry_task_id = app.task_service.retry_failed_rows(
+            task_id,
+            api_config_id=data.get('api_config_id'),
+            concurrency=data.get('concurrency')
+        )
+        return jsonify({
+            'success': True,
+            'task_id': retry_task_id
+        })
+    except Exception as e:
+        logger.error(f"重试失败行错误: {str(e)}")
+        return jsonify({'error': f'重试失败行错误: {str(e)}'}), 500
+
 # 路由：删除任务
 @app.route('/delete_task/<int:task_id>', methods=['POST'])
 def delete_task(task_id):
@@ -362,6 +445,68 @@ def delete_template(template_id):
         logger.error(f"删除模板错误: {str(e)}")
         return jsonify({'error': f'删除模板错误: {str(e)}'}), 500
 
+# 远程Worker接口：校验共享令牌
+def _worker_authorized():
+    return app.coordinator.check_token(request.headers.get('X-Worker-Token'))
+
+# 路由：远程Worker领取行批次
+@app.route('/worker/lease', methods=['POST'])
+def worker_lease():
+    if not _worker_authorized():
+        return jsonify({'error': '未授权的Worker'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    if not data.get('worker_id'):
+        return jsonify({'error': '缺少worker_id'}), 400
+    
+    try:
+        result = app.coordinator.lease(
+            data['worker_id'],
+            max_jobs=data.get('max_jobs', 1),
+            payload=data.get('payload', WorkerCoordinator.PAYLOAD_PROMPT)
+        )
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        logger.error(f"Worker领取批次错误: {str(e)}")
+        return jsonify({'error': f'Worker领取批次错误: {str(e)}'}), 500
+
+# 路由：远程Worker续约
+@app.route('/worker/heartbeat', methods=['POST'])
+def worker_heartbeat():
+    if not _worker_authorized():
+        return jsonify({'error': '未授权的Worker'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        task_running = app.coordinator.heartbeat(data.get('job_id'), data.get('lease_token'))
+        return jsonify({'success': True, 'task_running': task_running})
+    except LeaseLostError as e:
+        return jsonify({'error': str(e), 'lease_lost': True}), 409
+    except Exception as e:
+        logger.error(f"Worker续约错误: {str(e)}")
+        return jsonify({'error': f'Worker续约错误: {str(e)}'}), 500
+
+# 路由：远程Worker批量回传结果
+@app.route('/worker/results', methods=['POST'])
+def worker_results():
+    if not _worker_authorized():
+        return jsonify({'error': '未授权的Worker'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        accepted = app.coordinator.submit_results(
+            data.get('job_id'),
+            data.get('lease_token'),
+            data.get('results', []),
+            complete=bool(data.get('complete'))
+        )
+        return jsonify({'success': True, 'accepted': accepted})
+    except LeaseLostError as e:
+        return jsonify({'error': str(e), 'lease_lost': True}), 409
+    except Exception as e:
+        logger.error(f"Worker回传结果错误: {str(e)}")
+        return jsonify({'error': f'Worker回传结果错误: {str(e)}'}), 500
+
 if __name__ == '__main__':
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
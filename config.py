@@ -29,6 +29,64 @@ API_REQUEST_TIMEOUT = 30  # 请求超时时间（秒）
 API_RETRY_COUNT = 3       # 请求失败重试次数
 API_RETRY_DELAY = 2       # 重试间隔（秒）
 
+# 任务执行引擎配置
+DEFAULT_TASK_ENGINE = 'thread'  # 默认执行引擎：thread（线程池）、async（asyncio事件循环）或worker（独立Worker进程）
+ASYNC_MAX_CONCURRENCY = 5000    # asyncio引擎单个任务允许的最大并发请求数
+GLOBAL_MAX_CONCURRENCY = 1000   # 进程内所有任务共享的最大在途LLM请求数
+PROGRESS_FLUSH_INTERVAL = 1.0   # 任务进度写入数据库的最短间隔（秒）
+PROGRESS_FLUSH_ROWS = 100       # 累计完成多少行后立即写入一次进度
+LOG_WRITE_BATCH_SIZE = 200      # 后台线程每批写入的最多任务日志条数
+LOG_WRITE_MAX_LATENCY = 0.5     # 任务日志入队后最多等待多少秒写入数据库
+DEDUP_REQUESTS = True           # 同一任务中完全相同的请求（提示词、图片、API配置）只调用一次LLM
+PACK_MAX_SIZE = 50              # 多行合并请求时每个请求最多包含的行数
+
+# Batch API配置（执行引擎为batch时，所有行的请求通过服务商的/files和/batches接口批量提交）
+BATCH_POLL_INTERVAL = 30             # 查询批处理状态的间隔（秒）
+BATCH_COMPLETION_WINDOW = '24h'      # 批处理的完成时限
+BATCH_MAX_REQUESTS = 50000           # 单个批处理最多包含的请求数，超过时拆分为多个批处理
+BATCH_MAX_FILE_BYTES = 100 * 1024 * 1024  # 单个请求文件的最大字节数
+BATCH_REQUEST_TIMEOUT = 300          # 上传请求文件、下载结果文件的超时时间（秒）
+
+# 独立Worker进程配置（执行引擎为worker时由 python -m services.worker 处理任务）
+WORKER_BATCH_SIZE = 50          # 每个队列任务包含的行数
+WORKER_LEASE_SECONDS = 60       # 领取队列任务的租约时长，Worker失联超过该时间后任务会被重新领取
+WORKER_POLL_INTERVAL = 1.0      # 队列为空时的轮询间隔（秒）
+DB_BUSY_TIMEOUT = 30            # SQLite写锁等待超时（秒），多个进程同时写入时使用
+WORKER_TOKEN = os.environ.get('EXCEL_LLM_WORKER_TOKEN', '')  # 远程Worker访问/worker/*接口的共享令牌，为空时禁用远程Worker
+
+# 自适应并发配置（API配置启用"自适应并发"后生效，AIMD算法）
+ADAPTIVE_INITIAL_CONCURRENCY = 8      # 初始在途请求上限
+ADAPTIVE_MIN_CONCURRENCY = 1          # 最小在途请求上限
+ADAPTIVE_DECREASE_FACTOR = 0.5        # 遇到429/超时/5xx时上限乘以该系数
+ADAPTIVE_LATENCY_TOLERANCE = 2.0      # 短期延迟超过基线的倍数，超过视为拥塞
+
+# 限流配置（API配置设置了每分钟请求数/token数后生效）
+RATE_LIMIT_BURST_SECONDS = 10             # 令牌桶容量相当于多少秒的补充量
+RATE_LIMIT_DEFAULT_COMPLETION_TOKENS = 500  # other_params未设置max_tokens时预估的输出token数
+IMAGE_TOKEN_ESTIMATE = 765                # 每张图片预估占用的token数
+
+# token计数与任务预估配置
+TOKENIZER_ENCODING = 'cl100k_base'  # 安装了tiktoken且词表已缓存时使用的编码，否则使用内置规则离线估算
+ESTIMATE_DEFAULT_LATENCY = 5.0      # API配置没有历史请求记录时，预估每个请求的耗时（秒）
+
+# 任务预算配置（任务设置了token或费用预算后生效）
+BUDGET_SLOWDOWN_AT = 0.9  # 用量达到预算的该比例后按剩余预算降低在途请求数，用完后暂停任务
+
+# API配置池配置（任务使用多个API配置时生效）
+POOL_EJECT_FAILURES = 3    # 配置连续失败多少次后暂时移出配置池，0表示不移出
+POOL_EJECT_SECONDS = 30    # 移出配置池的时长（秒），到期后重新参与路由
+
+# 对冲请求配置（API配置启用"对冲请求"后生效）
+HEDGE_PERCENTILE = 95      # 超过最近首字节/响应延迟的该百分位数仍未返回时发送对冲请求
+HEDGE_MAX_RATE = 0.05      # 对冲请求数占请求数的比例上限
+HEDGE_MIN_SAMPLES = 20     # 每个配置至少有多少个延迟样本后才开始对冲
+HEDGE_MIN_DELAY = 1.0      # 对冲延迟的下限（秒）
+
+# 响应缓存配置（API配置启用"响应缓存"后生效，相同的请求跨任务复用已成功的响应）
+RESPONSE_CACHE_PATH = os.path.join(BASE_DIR, 'response_cache.db')  # 缓存文件路径，为空时禁用响应缓存
+RESPONSE_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 缓存最大总大小，超过后按最近使用时间淘汰
+RESPONSE_CACHE_MAX_AGE = 30 * 86400           # 条目超过该秒数未被使用后清理
+
 # 图片处理配置
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
 IMAGE_DOWNLOAD_TIMEOUT = 10  # 图片下载超时时间（秒）
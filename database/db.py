@@ -12,7 +12,10 @@ def get_db_connection():
     """获取数据库连接"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(current_app.config['DATABASE'])
+        db = g._database = sqlite3.connect(
+            current_app.config['DATABASE'],
+            timeout=current_app.config.get('DB_BUSY_TIMEOUT', 30)
+        )
         db.row_factory = sqlite3.Row
     return db
 
@@ -28,6 +31,9 @@ def init_db():
         connection = sqlite3.connect(current_app.config['DATABASE'])
         cursor = connection.cursor()
         
+        # WAL模式允许Web进程和多个Worker进程同时读写
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # 创建任务表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS tasks (
@@ -45,7 +51,19 @@ def init_db():
             result_path TEXT,
             created_at TEXT,
             started_at TEXT,
-            completed_at TEXT
+            completed_at TEXT,
+            engine TEXT DEFAULT 'thread',
+            api_config_id INTEGER,
+            weight INTEGER DEFAULT 1,
+            parent_task_id INTEGER,
+            row_indexes TEXT,
+            pack_size INTEGER DEFAULT 1,
+            pack_stats TEXT,
+            api_config_ids TEXT,
+            row_order TEXT DEFAULT 'fifo',
+            token_budget INTEGER DEFAULT 0,
+            cost_budget REAL DEFAULT 0,
+            budget_stats TEXT
         )
         ''')
         
@@ -71,7 +89,17 @@ def init_db():
             other_params TEXT,
             created_at TEXT,
             is_default INTEGER DEFAULT 0,
-            use_stream INTEGER DEFAULT 0
+            use_stream INTEGER DEFAULT 0,
+            max_concurrency INTEGER DEFAULT 0,
+            adaptive_concurrency INTEGER DEFAULT 0,
+            rpm_limit INTEGER DEFAULT 0,
+            tpm_limit INTEGER DEFAULT 0,
+            cache_enabled INTEGER DEFAULT 0,
+            cache_ttl INTEGER DEFAULT 0,
+            route_weight INTEGER DEFAULT 1,
+            hedge_enabled INTEGER DEFAULT 0,
+            input_price REAL DEFAULT 0,
+            output_price REAL DEFAULT 0
         )
         ''')
         
@@ -82,7 +110,11 @@ def init_db():
             file_name TEXT,
             fields TEXT,
             file_path TEXT,
-            created_at TEXT
+            created_at TEXT,
+            row_count INTEGER,
+            cache_path TEXT,
+            source_mtime REAL,
+            source_hash TEXT
         )
         ''')
         
@@ -98,10 +130,54 @@ def init_db():
             token_count INTEGER,
             response_text TEXT,
             created_at TEXT,
+            deduplicated INTEGER DEFAULT 0,
+            completion_tokens INTEGER,
             FOREIGN KEY (task_id) REFERENCES tasks (id)
         )
         ''')
         
+        # 创建任务队列表（Worker进程按批次领取行，租约过期后可被其他Worker重新领取）
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS task_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER,
+            kind TEXT DEFAULT 'rows',
+            row_indexes TEXT,
+            status TEXT DEFAULT 'pending',
+            worker_id TEXT,
+            lease_token TEXT,
+            lease_expires_at REAL,
+            attempts INTEGER DEFAULT 0,
+            created_at TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (task_id) REFERENCES tasks (id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_jobs_task_status ON task_jobs (task_id, status)
+        ''')
+        
+        # 创建批处理记录表（batch引擎已提交的批处理，进程重启后续跑时重新接管，不重复提交）
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS task_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER,
+            batch_id TEXT,
+            api_config_id INTEGER,
+            requests TEXT,
+            created_at TEXT,
+            FOREIGN KEY (task_id) REFERENCES tasks (id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_batches_task ON task_batches (task_id)
+        ''')
+        
+        # 按任务和行查询日志（续跑、重试失败行）使用的索引
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_task_logs_task_row ON task_logs (task_id, row_index)
+        ''')
+        
         # 插入默认API配置
         cursor.execute('''
         INSERT OR IGNORE INTO api_configs (id, name, type, url, api_key, model_name, other_params, created_at, is_default)
@@ -114,6 +190,44 @@ def init_db():
         VALUES (1, '基础摘要模板', '请根据以下信息生成摘要：\n\n标题：{{标题}}\n内容：{{内容}}\n\n请提供一个简洁的摘要，不超过100字。', CURRENT_TIMESTAMP)
         ''')
         
+        # 为旧版本数据库补充新增的列
+        _ensure_columns(cursor, 'tasks', [
+            ('engine', "TEXT DEFAULT 'thread'"),
+            ('api_config_id', "INTEGER"),
+            ('weight', "INTEGER DEFAULT 1"),
+            ('parent_task_id', "INTEGER"),
+            ('row_indexes', "TEXT"),
+            ('pack_size', "INTEGER DEFAULT 1"),
+            ('pack_stats', "TEXT"),
+            ('api_config_ids', "TEXT"),
+            ('row_order', "TEXT DEFAULT 'fifo'"),
+            ('token_budget', "INTEGER DEFAULT 0"),
+            ('cost_budget', "REAL DEFAULT 0"),
+            ('budget_stats', "TEXT"),
+        ])
+        _ensure_columns(cursor, 'api_configs', [
+            ('max_concurrency', "INTEGER DEFAULT 0"),
+            ('adaptive_concurrency', "INTEGER DEFAULT 0"),
+            ('rpm_limit', "INTEGER DEFAULT 0"),
+            ('tpm_limit', "INTEGER DEFAULT 0"),
+            ('cache_enabled', "INTEGER DEFAULT 0"),
+            ('cache_ttl', "INTEGER DEFAULT 0"),
+            ('route_weight', "INTEGER DEFAULT 1"),
+            ('hedge_enabled', "INTEGER DEFAULT 0"),
+            ('input_price', "REAL DEFAULT 0"),
+            ('output_price', "REAL DEFAULT 0"),
+        ])
+        _ensure_columns(cursor, 'task_logs', [
+            ('deduplicated', "INTEGER DEFAULT 0"),
+            ('completion_tokens', "INTEGER"),
+        ])
+        _ensure_columns(cursor, 'excel_schemas', [
+            ('row_count', "INTEGER"),
+            ('cache_path', "TEXT"),
+            ('source_mtime', "REAL"),
+            ('source_hash', "TEXT"),
+        ])
+        
         connection.commit()
         logger.info("数据库初始化成功")
     except Exception as e:
@@ -121,6 +235,22 @@ def init_db():
     finally:
         connection.close()
 
+def _ensure_columns(cursor, table, columns):
+    """
+    确保表中存在指定的列，不存在则自动添加
+    
+    Args:
+        cursor: 数据库游标
+        table: 表名
+        columns: (列名, 列定义) 列表
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {column[1] for column in cursor.fetchall()}
+    for name, definition in columns:
+        if name not in existing:
+            logger.info(f"添加{name}列到{table}表")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
 def query_db(query, args=(), one=False):
     """查询数据库"""
     cursor = get_db_connection().execute(query, args)
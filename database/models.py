@@ -2,8 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
+import uuid
 from datetime import datetime
-from database.db import query_db, insert_db, update_db, delete_db
+from database.db import query_db, insert_db, update_db, delete_db, get_db_connection
+
+
+def _row_value(row, key, default=None):
+    """安全获取数据库行中的字段值，兼容旧版本数据库中不存在的列"""
+    try:
+        value = row[key]
+    except (IndexError, KeyError):
+        return default
+    return default if value is None else value
+
 
 class Task:
     """任务模型"""
@@ -13,11 +25,27 @@ class Task:
     STATUS_COMPLETED = 'completed'
     STATUS_STOPPED = 'stopped'
     STATUS_ERROR = 'error'
+    STATUS_PAUSED = 'paused'  # 用完预算后暂停，提高预算后可以续跑
+    
+    # 执行引擎：线程池（默认）或asyncio事件循环
+    ENGINE_THREAD = 'thread'
+    ENGINE_ASYNC = 'async'
+    ENGINE_WORKER = 'worker'  # 写入任务队列，由独立Worker进程处理
+    ENGINE_BATCH = 'batch'    # 通过服务商的Batch API批量提交
+    ENGINES = (ENGINE_THREAD, ENGINE_ASYNC, ENGINE_WORKER, ENGINE_BATCH)
+    
+    # 行的处理顺序
+    ROW_ORDER_FIFO = 'fifo'                    # 按文件顺序
+    ROW_ORDER_LONGEST_FIRST = 'longest_first'  # 预估耗时长的行优先
+    ROW_ORDERS = (ROW_ORDER_FIFO, ROW_ORDER_LONGEST_FIRST)
     
     def __init__(self, id=None, name=None, schema_id=None, status=STATUS_PENDING,
                  total_count=0, processed_count=0, success_count=0, error_count=0,
                  concurrency=1, prompt_template='', image_fields=None, result_path=None,
-                 created_at=None, started_at=None, completed_at=None):
+                 created_at=None, started_at=None, completed_at=None, engine=ENGINE_THREAD,
+                 api_config_id=None, weight=1, parent_task_id=None, row_indexes=None,
+                 pack_size=1, pack_stats=None, api_config_ids=None, row_order=ROW_ORDER_FIFO,
+                 token_budget=0, cost_budget=0, budget_stats=None):
         self.id = id
         self.name = name or f"任务-{datetime.now().strftime('%Y%m%d%H%M%S')}"
         self.schema_id = schema_id
@@ -33,8 +61,22 @@ class Task:
         self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         self.started_at = started_at
         self.completed_at = completed_at
+        self.engine = engine or self.ENGINE_THREAD
+        self.api_config_id = api_config_id  # 为None时使用默认API配置
+        self.weight = weight or 1           # 全局调度器中的权重
+        self.parent_task_id = parent_task_id  # 重试失败行的任务指向原任务
+        self.row_indexes = row_indexes        # 需要处理的行索引，为None时处理全部行
+        self.pack_size = pack_size or 1       # 每个LLM请求合并的行数，1表示逐行请求
+        self.pack_stats = pack_stats          # 多行合并请求的统计（任务结束时保存）
+        self.api_config_ids = api_config_ids or []  # API配置池，为空时只使用api_config_id
+        self.row_order = row_order or self.ROW_ORDER_FIFO  # 行的处理顺序（结果始终按原始行顺序）
+        self.token_budget = token_budget or 0  # 任务最多消耗的token数，0表示不限制
+        self.cost_budget = cost_budget or 0    # 任务最多花费的费用（按API配置的价格计算），0表示不限制
+        self.budget_stats = budget_stats       # 预算的使用情况（任务结束或暂停时保存）
         # 保存处理结果的列表
         self.result_column = []
+        # 任务开始时批量渲染的提示词（按行位置排列），为None时逐行渲染
+        self.prompts = None
     
     @classmethod
     def from_row(cls, row):
@@ -57,7 +99,19 @@ class Task:
             result_path=row['result_path'],
             created_at=row['created_at'],
             started_at=row['started_at'],
-            completed_at=row['completed_at']
+            completed_at=row['completed_at'],
+            engine=_row_value(row, 'engine', cls.ENGINE_THREAD),
+            api_config_id=_row_value(row, 'api_config_id'),
+            weight=_row_value(row, 'weight', 1),
+            parent_task_id=_row_value(row, 'parent_task_id'),
+            row_indexes=json.loads(row['row_indexes']) if _row_value(row, 'row_indexes') else None,
+            pack_size=_row_value(row, 'pack_size', 1),
+            pack_stats=json.loads(row['pack_stats']) if _row_value(row, 'pack_stats') else None,
+            api_config_ids=json.loads(row['api_config_ids']) if _row_value(row, 'api_config_ids') else [],
+            row_order=_row_value(row, 'row_order', cls.ROW_ORDER_FIFO),
+            token_budget=_row_value(row, 'token_budget', 0),
+            cost_budget=_row_value(row, 'cost_budget', 0),
+            budget_stats=json.loads(row['budget_stats']) if _row_value(row, 'budget_stats') else None
         )
         return task
     
@@ -68,13 +122,21 @@ class Task:
             update_db(
                 """UPDATE tasks SET name=?, schema_id=?, status=?, total_count=?, 
                 processed_count=?, success_count=?, error_count=?, concurrency=?, 
-                prompt_template=?, image_fields=?, result_path=?, started_at=?, completed_at=?
-                WHERE id=?""",
+                prompt_template=?, image_fields=?, result_path=?, started_at=?, completed_at=?,
+                engine=?, api_config_id=?, weight=?, parent_task_id=?, row_indexes=?, pack_size=?,
+                pack_stats=?, api_config_ids=?, row_order=?, token_budget=?, cost_budget=?,
+                budget_stats=? WHERE id=?""",
                 (
                     self.name, self.schema_id, self.status, self.total_count,
                     self.processed_count, self.success_count, self.error_count, 
                     self.concurrency, self.prompt_template, json.dumps(self.image_fields),
-                    self.result_path, self.started_at, self.completed_at, self.id
+                    self.result_path, self.started_at, self.completed_at, self.engine,
+                    self.api_config_id, self.weight, self.parent_task_id,
+                    json.dumps(self.row_indexes) if self.row_indexes is not None else None, self.pack_size,
+                    json.dumps(self.pack_stats) if self.pack_stats is not None else None,
+                    json.dumps(self.api_config_ids) if self.api_config_ids else None, self.row_order,
+                    self.token_budget, self.cost_budget,
+                    json.dumps(self.budget_stats) if self.budget_stats is not None else None, self.id
                 )
             )
             return self.id
@@ -83,13 +145,21 @@ class Task:
             self.id = insert_db(
                 """INSERT INTO tasks (name, schema_id, status, total_count, processed_count,
                 success_count, error_count, concurrency, prompt_template, image_fields,
-                result_path, created_at, started_at, completed_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                result_path, created_at, started_at, completed_at, engine, api_config_id, weight,
+                parent_task_id, row_indexes, pack_size, pack_stats, api_config_ids, row_order,
+                token_budget, cost_budget, budget_stats)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     self.name, self.schema_id, self.status, self.total_count,
                     self.processed_count, self.success_count, self.error_count,
                     self.concurrency, self.prompt_template, json.dumps(self.image_fields),
-                    self.result_path, self.created_at, self.started_at, self.completed_at
+                    self.result_path, self.created_at, self.started_at, self.completed_at,
+                    self.engine, self.api_config_id, self.weight, self.parent_task_id,
+                    json.dumps(self.row_indexes) if self.row_indexes is not None else None, self.pack_size,
+                    json.dumps(self.pack_stats) if self.pack_stats is not None else None,
+                    json.dumps(self.api_config_ids) if self.api_config_ids else None, self.row_order,
+                    self.token_budget, self.cost_budget,
+                    json.dumps(self.budget_stats) if self.budget_stats is not None else None
                 )
             )
             return self.id
@@ -113,11 +183,40 @@ class Task:
         tasks = [cls.from_row(row) for row in rows]
         return tasks, total
     
+    @classmethod
+    def set_status(cls, task_id, status):
+        """只更新任务状态，不覆盖Worker进程写入的进度"""
+        update_db("UPDATE tasks SET status=? WHERE id=?", (status, task_id))
+    
+    @classmethod
+    def update_progress(cls, task_id, processed, success, error):
+        """只更新任务进度计数，不覆盖任务的其他字段"""
+        update_db(
+            "UPDATE tasks SET processed_count=?, success_count=?, error_count=? WHERE id=?",
+            (processed, success, error, task_id)
+        )
+    
+    @classmethod
+    def add_progress(cls, task_id, processed, success, error):
+        """原子地累加任务进度（多个Worker进程同时处理同一任务时使用）"""
+        update_db(
+            """UPDATE tasks SET processed_count = processed_count + ?,
+            success_count = success_count + ?, error_count = error_count + ? WHERE id = ?""",
+            (processed, success, error, task_id)
+        )
+    
+    def get_retry_tasks(self):
+        """获取由该任务派生的重试失败行任务"""
+        rows = query_db("SELECT * FROM tasks WHERE parent_task_id = ? ORDER BY id", (self.id,))
+        return [Task.from_row(row) for row in rows]
+    
     def delete(self):
         """删除任务"""
         if self.id:
             delete_db("DELETE FROM tasks WHERE id = ?", (self.id,))
             delete_db("DELETE FROM task_logs WHERE task_id = ?", (self.id,))
+            delete_db("DELETE FROM task_jobs WHERE task_id = ?", (self.id,))
+            delete_db("DELETE FROM task_batches WHERE task_id = ?", (self.id,))
             return True
         return False
     
@@ -139,6 +238,16 @@ class Task:
             'created_at': self.created_at,
             'started_at': self.started_at,
             'completed_at': self.completed_at,
+            'engine': self.engine,
+            'api_config_id': self.api_config_id,
+            'weight': self.weight,
+            'parent_task_id': self.parent_task_id,
+            'pack_size': self.pack_size,
+            'pack_stats': self.pack_stats,
+            'api_config_ids': self.api_config_ids,
+            'row_order': self.row_order,
+            'token_budget': self.token_budget,
+            'cost_budget': self.cost_budget,
             'progress': int(self.processed_count / self.total_count * 100) if self.total_count > 0 else 0
         }
 
@@ -217,7 +326,10 @@ class APIConfig:
     """API配置模型"""
     
     def __init__(self, id=None, name=None, type='openai', url=None, api_key=None,
-                 model_name=None, other_params=None, created_at=None, is_default=0, use_stream=0):
+                 model_name=None, other_params=None, created_at=None, is_default=0, use_stream=0,
+                 max_concurrency=0, adaptive_concurrency=0, rpm_limit=0, tpm_limit=0,
+                 cache_enabled=0, cache_ttl=0, route_weight=1, hedge_enabled=0,
+                 input_price=0, output_price=0):
         self.id = id
         self.name = name
         self.type = type
@@ -228,6 +340,26 @@ class APIConfig:
         self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         self.is_default = is_default
         self.use_stream = use_stream
+        self.max_concurrency = max_concurrency or 0  # 该配置的全局在途请求上限，0表示不限制
+        self.adaptive_concurrency = adaptive_concurrency or 0  # 是否根据延迟和429自动调整在途请求上限
+        self.rpm_limit = rpm_limit or 0  # 每分钟请求数上限，0表示不限制
+        self.tpm_limit = tpm_limit or 0  # 每分钟token数上限，0表示不限制
+        self.cache_enabled = cache_enabled or 0  # 是否使用跨任务的持久化响应缓存
+        self.cache_ttl = cache_ttl or 0  # 缓存响应的有效期（秒），0表示不限制
+        self.route_weight = route_weight or 1  # 在API配置池中的路由权重
+        self.hedge_enabled = hedge_enabled or 0  # 是否对超过对冲延迟仍未返回的请求发送对冲请求
+        self.input_price = input_price or 0  # 每百万输入token的价格，0表示未设置
+        self.output_price = output_price or 0  # 每百万输出token的价格，0表示未设置
+    
+    @classmethod
+    def from_dict(cls, data):
+        """从to_dict生成的字典创建API配置对象（远程Worker使用协调端下发的配置）"""
+        fields = (
+            'id', 'name', 'type', 'url', 'api_key', 'model_name', 'other_params', 'created_at',
+            'is_default', 'use_stream', 'max_concurrency', 'adaptive_concurrency', 'rpm_limit', 'tpm_limit',
+            'cache_enabled', 'cache_ttl', 'route_weight', 'hedge_enabled', 'input_price', 'output_price'
+        )
+        return cls(**{key: data[key] for key in fields if key in data})
     
     @classmethod
     def from_row(cls, row):
@@ -251,7 +383,17 @@ class APIConfig:
             other_params=json.loads(row['other_params']) if row['other_params'] else {},
             created_at=row['created_at'],
             is_default=row['is_default'],
-            use_stream=use_stream
+            use_stream=use_stream,
+            max_concurrency=_row_value(row, 'max_concurrency', 0),
+            adaptive_concurrency=_row_value(row, 'adaptive_concurrency', 0),
+            rpm_limit=_row_value(row, 'rpm_limit', 0),
+            tpm_limit=_row_value(row, 'tpm_limit', 0),
+            cache_enabled=_row_value(row, 'cache_enabled', 0),
+            cache_ttl=_row_value(row, 'cache_ttl', 0),
+            route_weight=_row_value(row, 'route_weight', 1),
+            hedge_enabled=_row_value(row, 'hedge_enabled', 0),
+            input_price=_row_value(row, 'input_price', 0),
+            output_price=_row_value(row, 'output_price', 0)
         )
         return config
     
@@ -265,11 +407,15 @@ class APIConfig:
             # 更新现有配置
             update_db(
                 """UPDATE api_configs SET name=?, type=?, url=?, api_key=?,
-                model_name=?, other_params=?, is_default=?, use_stream=? WHERE id=?""",
+                model_name=?, other_params=?, is_default=?, use_stream=?, max_concurrency=?,
+                adaptive_concurrency=?, rpm_limit=?, tpm_limit=?, cache_enabled=?, cache_ttl=?,
+                route_weight=?, hedge_enabled=?, input_price=?, output_price=? WHERE id=?""",
                 (
                     self.name, self.type, self.url, self.api_key,
                     self.model_name, json.dumps(self.other_params), self.is_default,
-                    self.use_stream, self.id
+                    self.use_stream, self.max_concurrency, self.adaptive_concurrency,
+                    self.rpm_limit, self.tpm_limit, self.cache_enabled, self.cache_ttl,
+                    self.route_weight, self.hedge_enabled, self.input_price, self.output_price, self.id
                 )
             )
             return self.id
@@ -277,10 +423,15 @@ class APIConfig:
             # 创建新配置
             self.id = insert_db(
                 """INSERT INTO api_configs (name, type, url, api_key, model_name,
-                other_params, created_at, is_default, use_stream) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                other_params, created_at, is_default, use_stream, max_concurrency, adaptive_concurrency,
+                rpm_limit, tpm_limit, cache_enabled, cache_ttl, route_weight, hedge_enabled, input_price, output_price)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     self.name, self.type, self.url, self.api_key, self.model_name,
-                    json.dumps(self.other_params), self.created_at, self.is_default, self.use_stream
+                    json.dumps(self.other_params), self.created_at, self.is_default, self.use_stream,
+                    self.max_concurrency, self.adaptive_concurrency, self.rpm_limit, self.tpm_limit,
+                    self.cache_enabled, self.cache_ttl, self.route_weight, self.hedge_enabled,
+                    self.input_price, self.output_price
                 )
             )
             return self.id
@@ -323,19 +474,34 @@ class APIConfig:
             'other_params': self.other_params,
             'created_at': self.created_at,
             'is_default': self.is_default,
-            'use_stream': self.use_stream
+            'use_stream': self.use_stream,
+            'max_concurrency': self.max_concurrency,
+            'adaptive_concurrency': self.adaptive_concurrency,
+            'rpm_limit': self.rpm_limit,
+            'tpm_limit': self.tpm_limit,
+            'cache_enabled': self.cache_enabled,
+            'cache_ttl': self.cache_ttl,
+            'route_weight': self.route_weight,
+            'hedge_enabled': self.hedge_enabled,
+            'input_price': self.input_price,
+            'output_price': self.output_price
         }
 
 
 class ExcelSchema:
     """Excel表结构模型"""
     
-    def __init__(self, id=None, file_name=None, fields=None, file_path=None, created_at=None):
+    def __init__(self, id=None, file_name=None, fields=None, file_path=None, created_at=None, row_count=None,
+                 cache_path=None, source_mtime=None, source_hash=None):
         self.id = id
         self.file_name = file_name
         self.fields = fields or []
         self.file_path = file_path
         self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.row_count = row_count  # 上传时统计的数据行数，旧版本数据库中为None
+        self.cache_path = cache_path  # 列式缓存文件（Arrow IPC）路径
+        self.source_mtime = source_mtime  # 生成缓存时原始文件的修改时间
+        self.source_hash = source_hash  # 生成缓存时原始文件的SHA-256
     
     @classmethod
     def from_row(cls, row):
@@ -348,7 +514,11 @@ class ExcelSchema:
             file_name=row['file_name'],
             fields=json.loads(row['fields']) if row['fields'] else [],
             file_path=row['file_path'],
-            created_at=row['created_at']
+            created_at=row['created_at'],
+            row_count=_row_value(row, 'row_count'),
+            cache_path=_row_value(row, 'cache_path'),
+            source_mtime=_row_value(row, 'source_mtime'),
+            source_hash=_row_value(row, 'source_hash')
         )
         return schema
     
@@ -357,15 +527,23 @@ class ExcelSchema:
         if self.id:
             # 更新现有表结构
             update_db(
-                "UPDATE excel_schemas SET file_name=?, fields=?, file_path=? WHERE id=?",
-                (self.file_name, json.dumps(self.fields), self.file_path, self.id)
+                """UPDATE excel_schemas SET file_name=?, fields=?, file_path=?, row_count=?,
+                cache_path=?, source_mtime=?, source_hash=? WHERE id=?""",
+                (
+                    self.file_name, json.dumps(self.fields), self.file_path, self.row_count,
+                    self.cache_path, self.source_mtime, self.source_hash, self.id
+                )
             )
             return self.id
         else:
             # 创建新表结构
             self.id = insert_db(
-                "INSERT INTO excel_schemas (file_name, fields, file_path, created_at) VALUES (?, ?, ?, ?)",
-                (self.file_name, json.dumps(self.fields), self.file_path, self.created_at)
+                """INSERT INTO excel_schemas (file_name, fields, file_path, created_at, row_count,
+                cache_path, source_mtime, source_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    self.file_name, json.dumps(self.fields), self.file_path, self.created_at, self.row_count,
+                    self.cache_path, self.source_mtime, self.source_hash
+                )
             )
             return self.id
     
@@ -389,7 +567,8 @@ class ExcelSchema:
             'file_name': self.file_name,
             'fields': self.fields,
             'file_path': self.file_path,
-            'created_at': self.created_at
+            'created_at': self.created_at,
+            'row_count': self.row_count
         }
 
 
@@ -400,7 +579,8 @@ class TaskLog:
     STATUS_ERROR = 'error'
     
     def __init__(self, id=None, task_id=None, row_index=None, status=STATUS_SUCCESS,
-                 error_message=None, processing_time=0, token_count=0, response_text=None, created_at=None):
+                 error_message=None, processing_time=0, token_count=0, response_text=None, created_at=None,
+                 deduplicated=False, completion_tokens=None):
         self.id = id
         self.task_id = task_id
         self.row_index = row_index
@@ -410,6 +590,8 @@ class TaskLog:
         self.token_count = token_count
         self.response_text = response_text
         self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.deduplicated = bool(deduplicated)  # 结果复用了同一任务中相同请求的响应，没有单独调用LLM
+        self.completion_tokens = completion_tokens  # token数中的输出token数，None表示服务商没有返回拆分
     
     @classmethod
     def from_row(cls, row):
@@ -435,7 +617,9 @@ class TaskLog:
             processing_time=row['processing_time'],
             token_count=row['token_count'],
             response_text=response_text,
-            created_at=row['created_at']
+            created_at=row['created_at'],
+            deduplicated=_row_value(row, 'deduplicated', 0),
+            completion_tokens=_row_value(row, 'completion_tokens')
         )
         return log
     
@@ -445,11 +629,12 @@ class TaskLog:
             # 更新现有日志
             update_db(
                 """UPDATE task_logs SET task_id=?, row_index=?, status=?,
-                error_message=?, processing_time=?, token_count=?, response_text=? WHERE id=?""",
+                error_message=?, processing_time=?, token_count=?, response_text=?, deduplicated=?,
+                completion_tokens=? WHERE id=?""",
                 (
                     self.task_id, self.row_index, self.status,
                     self.error_message, self.processing_time, self.token_count,
-                    self.response_text, self.id
+                    self.response_text, int(self.deduplicated), self.completion_tokens, self.id
                 )
             )
             return self.id
@@ -457,10 +642,12 @@ class TaskLog:
             # 创建新日志
             self.id = insert_db(
                 """INSERT INTO task_logs (task_id, row_index, status, error_message,
-                processing_time, token_count, response_text, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                processing_time, token_count, response_text, created_at, deduplicated, completion_tokens)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                 (
                     self.task_id, self.row_index, self.status, self.error_message,
-                    self.processing_time, self.token_count, self.response_text, self.created_at
+                    self.processing_time, self.token_count, self.response_text, self.created_at,
+                    int(self.deduplicated), self.completion_tokens
                 )
             )
             return self.id
@@ -481,6 +668,163 @@ class TaskLog:
         logs = [cls.from_row(row) for row in rows]
         return logs, total
     
+    @classmethod
+    def save_many(cls, logs):
+        """批量写入新的任务日志"""
+        if not logs:
+            return
+        conn = get_db_connection()
+        conn.executemany(
+            """INSERT INTO task_logs (task_id, row_index, status, error_message,
+            processing_time, token_count, response_text, created_at, deduplicated, completion_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    log.task_id, log.row_index, log.status, log.error_message,
+                    log.processing_time, log.token_count, log.response_text, log.created_at,
+                    int(log.deduplicated), log.completion_tokens
+                )
+                for log in logs
+            ]
+        )
+        conn.commit()
+    
+    @classmethod
+    def get_dedup_summary(cls, task_id):
+        """
+        统计任务日志中复用了相同请求响应的行数
+        
+        Args:
+            task_id: 任务ID
+            
+        Returns:
+            tuple: (日志总数, 复用响应的日志数)
+        """
+        row = query_db(
+            "SELECT COUNT(*) AS total, COALESCE(SUM(deduplicated), 0) AS deduplicated FROM task_logs WHERE task_id = ?",
+            (task_id,), one=True
+        )
+        return row['total'], row['deduplicated']
+    
+    @classmethod
+    def get_recent_latency(cls, api_config_id, include_default=False, limit=1000):
+        """
+        统计使用指定API配置的任务最近成功请求的平均处理时间
+        
+        只统计实际调用了LLM的日志（不含复用响应和token数为0的日志），不含batch执行引擎的任务
+        
+        Args:
+            api_config_id: API配置ID（任务的主配置）
+            include_default: 是否同时统计未指定API配置（使用默认配置）的任务
+            limit: 最多统计最近多少条日志
+        
+        Returns:
+            tuple: (平均处理时间（秒）, 日志数)，没有日志时平均处理时间为None
+        """
+        config_filter = "(t.api_config_id = ? OR t.api_config_id IS NULL)" if include_default else "t.api_config_id = ?"
+        row = query_db(
+            f"""SELECT AVG(processing_time) AS latency, COUNT(*) AS samples FROM (
+                SELECT l.processing_time FROM task_logs l JOIN tasks t ON t.id = l.task_id
+                WHERE {config_filter} AND t.engine != ? AND l.status = ?
+                AND COALESCE(l.deduplicated, 0) = 0 AND l.token_count > 0
+                ORDER BY l.id DESC LIMIT ?
+            )""",
+            (api_config_id, Task.ENGINE_BATCH, cls.STATUS_SUCCESS, limit), one=True
+        )
+        return row['latency'], row['samples']
+    
+    @classmethod
+    def get_token_totals(cls, task_id):
+        """
+        统计任务日志中已消耗的token数
+        
+        Args:
+            task_id: 任务ID
+            
+        Returns:
+            tuple: (token总数, 其中已知的输入token数, token数不为0的日志数)，
+                   服务商没有返回拆分的日志不计入输入token数
+        """
+        row = query_db(
+            """SELECT COALESCE(SUM(token_count), 0) AS tokens,
+            COALESCE(SUM(token_count - completion_tokens), 0) AS prompt_tokens, COUNT(*) AS logs
+            FROM task_logs WHERE task_id = ? AND token_count > 0""",
+            (task_id,), one=True
+        )
+        return row['tokens'], row['prompt_tokens'], row['logs']
+    
+    @classmethod
+    def get_succeeded_rows(cls, task_id, row_indexes):
+        """
+        在指定的行中查找已有成功日志的行
+        
+        Args:
+            task_id: 任务ID
+            row_indexes: 行索引列表
+            
+        Returns:
+            set: 已成功处理的行索引
+        """
+        if not row_indexes:
+            return set()
+        placeholders = ','.join('?' * len(row_indexes))
+        rows = query_db(
+            f"SELECT DISTINCT row_index FROM task_logs WHERE task_id = ? AND status = ? AND row_index IN ({placeholders})",
+            (task_id, cls.STATUS_SUCCESS, *row_indexes)
+        )
+        return {row['row_index'] for row in rows}
+    
+    @classmethod
+    def get_success_results(cls, task_id):
+        """
+        获取任务中已成功处理的行及其结果（同一行有多条成功日志时取最新一条）
+        
+        Returns:
+            dict: 行索引 -> 处理结果
+        """
+        rows = query_db(
+            "SELECT row_index, response_text FROM task_logs WHERE task_id = ? AND status = ? ORDER BY id",
+            (task_id, cls.STATUS_SUCCESS)
+        )
+        return {row['row_index']: row['response_text'] for row in rows}
+    
+    @classmethod
+    def get_row_results(cls, task_id, include_retries=False):
+        """
+        汇总任务中每一行的最终结果
+        
+        成功日志优先于错误日志，同类日志取最新一条
+        
+        Args:
+            task_id: 任务ID
+            include_retries: 是否包含由该任务派生的重试任务的日志
+            
+        Returns:
+            tuple: (成功行 {行索引: 处理结果}, 失败行 {行索引: 错误信息})
+        """
+        if include_retries:
+            rows = query_db(
+                """SELECT row_index, status, response_text, error_message FROM task_logs
+                WHERE task_id IN (SELECT id FROM tasks WHERE id = ? OR parent_task_id = ?) ORDER BY id""",
+                (task_id, task_id)
+            )
+        else:
+            rows = query_db(
+                """SELECT row_index, status, response_text, error_message FROM task_logs
+                WHERE task_id = ? ORDER BY id""",
+                (task_id,)
+            )
+        succeeded = {}
+        failed = {}
+        for row in rows:
+            if row['status'] == cls.STATUS_SUCCESS:
+                succeeded[row['row_index']] = row['response_text']
+            else:
+                failed[row['row_index']] = row['error_message']
+        for row_index in succeeded:
+            failed.pop(row_index, None)
+        return succeeded, failed
+    
     @classmethod
     def get_task_logs_recent(cls, task_id, limit=10):
         """获取特定任务的最新日志"""
@@ -507,5 +851,258 @@ class TaskLog:
             'processing_time': self.processing_time,
             'token_count': self.token_count,
             'response_text': self.response_text,
-            'created_at': self.created_at
-        }
\ No newline at end of file
+            'created_at': self.created_at,
+            'deduplicated': self.deduplicated,
+            'completion_tokens': self.completion_tokens
+        }
+
+
+class TaskJob:
+    """任务队列模型
+
+    执行引擎为worker的任务启动时，待处理的行按批次写入task_jobs表，另有一个
+    finalize任务在所有行批次完成后生成结果文件。Worker进程通过租约领取队列任务：
+    领取后定期续约（心跳），租约过期（Worker崩溃或失联）后其他Worker可以重新领取。
+    """
+    
+    STATUS_PENDING = 'pending'
+    STATUS_LEASED = 'leased'
+    STATUS_DONE = 'done'
+    
+    KIND_ROWS = 'rows'
+    KIND_FINALIZE = 'finalize'
+    
+    def __init__(self, id=None, task_id=None, kind=KIND_ROWS, row_indexes=None, status=STATUS_PENDING,
+                 worker_id=None, lease_token=None, lease_expires_at=None, attempts=0,
+                 created_at=None, updated_at=None):
+        self.id = id
+        self.task_id = task_id
+        self.kind = kind
+        self.row_indexes = row_indexes or []
+        self.status = status
+        self.worker_id = worker_id
+        self.lease_token = lease_token
+        self.lease_expires_at = lease_expires_at
+        self.attempts = attempts
+        self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.updated_at = updated_at
+    
+    @classmethod
+    def from_row(cls, row):
+        """从数据库行创建队列任务对象"""
+        if not row:
+            return None
+        
+        job = cls(
+            id=row['id'],
+            task_id=row['task_id'],
+            kind=row['kind'],
+            row_indexes=json.loads(row['row_indexes']) if row['row_indexes'] else [],
+            status=row['status'],
+            worker_id=row['worker_id'],
+            lease_token=row['lease_token'],
+            lease_expires_at=row['lease_expires_at'],
+            attempts=row['attempts'],
+            created_at=row['created_at'],
+            updated_at=row['updated_at']
+        )
+        return job
+    
+    @classmethod
+    def enqueue(cls, task_id, batches):
+        """
+        为任务写入行批次和结果生成任务，并清除该任务之前的队列记录
+        
+        Args:
+            task_id: 任务ID
+            batches: 行索引批次列表
+        """
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn = get_db_connection()
+        conn.execute("DELETE FROM task_jobs WHERE task_id = ?", (task_id,))
+        conn.executemany(
+            "INSERT INTO task_jobs (task_id, kind, row_indexes, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(task_id, cls.KIND_ROWS, json.dumps(batch), cls.STATUS_PENDING, now) for batch in batches]
+        )
+        conn.execute(
+            "INSERT INTO task_jobs (task_id, kind, row_indexes, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            (task_id, cls.KIND_FINALIZE, None, cls.STATUS_PENDING, now)
+        )
+        conn.commit()
+    
+    @classmethod
+    def get_by_id(cls, job_id):
+        """根据ID获取队列任务"""
+        row = query_db("SELECT * FROM task_jobs WHERE id = ?", (job_id,), one=True)
+        return cls.from_row(row)
+    
+    @classmethod
+    def claim(cls, worker_id, lease_seconds, kind=None, task_id=None):
+        """
+        领取一个队列任务
+        
+        只领取运行中任务的待处理或租约已过期的队列任务；finalize任务要等同一任务的
+        所有行批次完成后才能领取。领取在单条UPDATE语句中完成，多个进程并发领取也不会重复。
+        
+        Args:
+            worker_id: Worker标识
+            lease_seconds: 租约时长（秒）
+            kind: 只领取指定类型的队列任务，为None时不限
+            task_id: 只领取指定任务的队列任务，为None时不限
+            
+        Returns:
+            TaskJob: 领取到的队列任务，没有可领取的任务时返回None
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        affected = update_db(
+            """UPDATE task_jobs SET status = ?, worker_id = ?, lease_token = ?, lease_expires_at = ?,
+            attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT j.id FROM task_jobs j JOIN tasks t ON t.id = j.task_id
+                WHERE t.status = ?
+                AND (j.status = ? OR (j.status = ? AND j.lease_expires_at < ?))
+                AND (j.kind = ? OR NOT EXISTS (
+                    SELECT 1 FROM task_jobs r
+                    WHERE r.task_id = j.task_id AND r.kind = ? AND r.status != ?
+                ))
+                AND (? IS NULL OR j.kind = ?)
+                AND (? IS NULL OR j.task_id = ?)
+                ORDER BY j.kind = ?, j.id LIMIT 1
+            )""",
+            (
+                cls.STATUS_LEASED, worker_id, token, now + lease_seconds,
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                Task.STATUS_RUNNING,
+                cls.STATUS_PENDING, cls.STATUS_LEASED, now,
+                cls.KIND_ROWS, cls.KIND_ROWS, cls.STATUS_DONE,
+                kind, kind, task_id, task_id,
+                cls.KIND_FINALIZE
+            )
+        )
+        if not affected:
+            return None
+        row = query_db("SELECT * FROM task_jobs WHERE lease_token = ?", (token,), one=True)
+        return cls.from_row(row)
+    
+    def heartbeat(self, lease_seconds):
+        """
+        续约
+        
+        Returns:
+            bool: 是否仍持有租约（租约已被其他Worker接管时返回False）
+        """
+        affected = update_db(
+            "UPDATE task_jobs SET lease_expires_at = ? WHERE id = ? AND lease_token = ? AND status = ?",
+            (time.time() + lease_seconds, self.id, self.lease_token, self.STATUS_LEASED)
+        )
+        return affected > 0
+    
+    def release(self):
+        """放弃租约，队列任务重新变为待处理"""
+        update_db(
+            "UPDATE task_jobs SET status = ?, lease_token = NULL WHERE id = ? AND lease_token = ? AND status = ?",
+            (self.STATUS_PENDING, self.id, self.lease_token, self.STATUS_LEASED)
+        )
+    
+    @classmethod
+    def requeue_expired(cls):
+        """
+        将租约已过期的队列任务重新放回待处理状态
+        
+        Returns:
+            int: 重新入队的队列任务数
+        """
+        return update_db(
+            "UPDATE task_jobs SET status = ?, lease_token = NULL WHERE status = ? AND lease_expires_at < ?",
+            (cls.STATUS_PENDING, cls.STATUS_LEASED, time.time())
+        )
+    
+    def complete(self):
+        """
+        标记队列任务完成
+        
+        Returns:
+            bool: 是否仍持有租约
+        """
+        affected = update_db(
+            "UPDATE task_jobs SET status = ?, updated_at = ? WHERE id = ? AND lease_token = ?",
+            (self.STATUS_DONE, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.id, self.lease_token)
+        )
+        return affected > 0
+    
+    @classmethod
+    def get_task_summary(cls, task_id):
+        """
+        获取任务的队列状态
+        
+        Returns:
+            dict: 各状态的队列任务数和当前持有租约的Worker，任务没有队列记录时返回None
+        """
+        rows = query_db(
+            "SELECT status, COUNT(*) as count FROM task_jobs WHERE task_id = ? AND kind = ? GROUP BY status",
+            (task_id, cls.KIND_ROWS)
+        )
+        if not rows:
+            return None
+        summary = {cls.STATUS_PENDING: 0, cls.STATUS_LEASED: 0, cls.STATUS_DONE: 0}
+        for row in rows:
+            summary[row['status']] = row['count']
+        workers = query_db(
+            "SELECT DISTINCT worker_id FROM task_jobs WHERE task_id = ? AND status = ? AND lease_expires_at >= ?",
+            (task_id, cls.STATUS_LEASED, time.time())
+        )
+        summary['workers'] = [row['worker_id'] for row in workers]
+        return summary
+
+
+class TaskBatch:
+    """批处理记录模型
+    
+    batch引擎提交批处理后立即记录服务商的批处理ID和custom_id到行的映射，结果写入任务日志后删除。
+    进程在批处理完成前重启时，续跑根据这些记录重新接管仍然有效的批处理，而不是重新提交（重复付费）。
+    """
+    
+    def __init__(self, id=None, task_id=None, batch_id=None, api_config_id=None, requests=None, created_at=None):
+        self.id = id
+        self.task_id = task_id
+        self.batch_id = batch_id              # 服务商的批处理ID
+        self.api_config_id = api_config_id    # 提交批处理使用的API配置
+        self.requests = requests or {}        # custom_id -> {'rows': 使用该结果的行索引, 'cache_key': 缓存键}
+        self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    @classmethod
+    def from_row(cls, row):
+        """从数据库行创建批处理记录对象"""
+        if not row:
+            return None
+        
+        return cls(
+            id=row['id'],
+            task_id=row['task_id'],
+            batch_id=row['batch_id'],
+            api_config_id=row['api_config_id'],
+            requests=json.loads(row['requests']) if row['requests'] else {},
+            created_at=row['created_at']
+        )
+    
+    @classmethod
+    def get_by_task(cls, task_id):
+        """获取任务尚未取回结果的批处理记录"""
+        rows = query_db("SELECT * FROM task_batches WHERE task_id = ? ORDER BY id", (task_id,))
+        return [cls.from_row(row) for row in rows]
+    
+    def save(self):
+        """保存批处理记录"""
+        self.id = insert_db(
+            "INSERT INTO task_batches (task_id, batch_id, api_config_id, requests, created_at) VALUES (?, ?, ?, ?, ?)",
+            (self.task_id, self.batch_id, self.api_config_id, json.dumps(self.requests), self.created_at)
+        )
+        return self.id
+    
+    def delete(self):
+        """删除批处理记录（结果已写入任务日志或批处理已取消）"""
+        if self.id:
+            delete_db("DELETE FROM task_batches WHERE id = ?", (self.id,))
+            return True
+        return False
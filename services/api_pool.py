@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigHealthRegistry:
+    """按API配置记录调用健康状况，连续失败的配置被暂时移出API配置池
+
+    每次调用尝试（包括重试）都会反馈结果：连续失败达到eject_failures次后，该配置在
+    eject_seconds秒内不再被配置池选中；到期后重新参与路由，若下一次尝试仍然失败则再次移出，
+    成功一次即恢复正常。只影响配置池的路由，只使用单个配置的任务不受影响。
+    """
+
+    def __init__(self, eject_failures=3, eject_seconds=30):
+        """
+        初始化健康状况登记表
+
+        Args:
+            eject_failures: 连续失败多少次后移出配置池，0表示不移出
+            eject_seconds: 移出的时长（秒）
+        """
+        self.eject_failures = max(0, int(eject_failures or 0))
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._failures = defaultdict(int)   # 配置ID -> 连续失败次数
+        self._ejected_until = {}            # 配置ID -> 移出截止时间
+        self._ejections = defaultdict(int)  # 配置ID -> 累计移出次数
+
+    def record(self, config_id, success):
+        """
+        记录一次调用尝试的结果
+
+        Args:
+            config_id: API配置ID
+            success: 是否成功
+        """
+        with self._lock:
+            if success:
+                self._failures.pop(config_id, None)
+                self._ejected_until.pop(config_id, None)
+                return
+            self._failures[config_id] += 1
+            if self.eject_failures and self._failures[config_id] >= self.eject_failures:
+                if not self.is_ejected(config_id):
+                    self._ejections[config_id] += 1
+                    logger.warning(
+                        f"API配置 {config_id} 连续失败 {self._failures[config_id]} 次，"
+                        f"{self.eject_seconds} 秒内移出配置池"
+                    )
+                self._ejected_until[config_id] = time.monotonic() + self.eject_seconds
+
+    def is_ejected(self, config_id):
+        """
+        判断配置当前是否被移出配置池
+
+        Args:
+            config_id: API配置ID
+
+        Returns:
+            bool: 是否被移出
+        """
+        until = self._ejected_until.get(config_id)
+        return until is not None and time.monotonic() < until
+
+    def snapshot(self, config_id):
+        """
+        获取配置的健康状况
+
+        Returns:
+            dict: 连续失败次数、是否被移出、剩余移出秒数及累计移出次数
+        """
+        with self._lock:
+            ejected = self.is_ejected(config_id)
+            return {
+                'consecutive_failures': self._failures.get(config_id, 0),
+                'ejected': ejected,
+                'ejected_seconds_left': round(self._ejected_until[config_id] - time.monotonic(), 1) if ejected else 0,
+                'ejections': self._ejections.get(config_id, 0)
+            }
+
+
+class RoutingStats:
+    """一个任务在API配置池中各配置上的调用统计（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._configs = defaultdict(lambda: {'requests': 0, 'success': 0, 'errors': 0, 'tokens': 0, 'latency': 0.0})
+
+    def record(self, config_id, success, token_count=0, latency=0.0):
+        """
+        记录一次调用
+
+        Args:
+            config_id: 实际使用的API配置ID
+            success: 是否成功
+            token_count: 消耗的token数
+            latency: 调用耗时（秒）
+        """
+        with self._lock:
+            stats = self._configs[config_id]
+            stats['requests'] += 1
+            stats['success' if success else 'errors'] += 1
+            stats['tokens'] += token_count or 0
+            stats['latency'] += latency
+
+    def snapshot(self):
+        """
+        获取各配置的吞吐量
+
+        Returns:
+            dict: 配置ID -> 请求数、成功/失败数、token数、平均延迟及每分钟请求数和token数
+        """
+        with self._lock:
+            minutes = max(time.monotonic() - self._started, 1.0) / 60
+            return {
+                config_id: {
+                    'requests': stats['requests'],
+                    'success': stats['success'],
+                    'errors': stats['errors'],
+                    'tokens': stats['tokens'],
+                    'avg_latency': round(stats['latency'] / stats['requests'], 3) if stats['requests'] else 0,
+                    'requests_per_minute': round(stats['requests'] / minutes, 1),
+                    'tokens_per_minute': round(stats['tokens'] / minutes, 1)
+                }
+                for config_id, stats in self._configs.items()
+            }
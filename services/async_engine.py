@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import httpx
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+class AsyncTaskEngine:
+    """基于asyncio的任务执行引擎
+
+    在单个事件循环中处理一个任务的全部行。每个在途的LLM请求只占用一个协程，
+    而不是一个操作系统线程，因此单个任务可以同时保持数千个在途请求。
+    """
+
+    def __init__(self, task_service):
+        """
+        初始化asyncio执行引擎
+
+        Args:
+            task_service: 任务管理服务，提供单行处理逻辑
+        """
+        self.task_service = task_service
+
+    def run(self, task, rows, row_indexes, stop_event, progress):
+        """
+        在当前线程中运行事件循环，直到所有行处理完毕或任务被停止
+
+        调用方需要已经推入Flask应用上下文，协程会继承该上下文
+
+        Args:
+            task: 任务对象
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            stop_event: 停止事件
+            progress: 任务进度计数器
+        """
+        asyncio.run(self._run(task, rows, row_indexes, stop_event, progress))
+
+    async def _run(self, task, rows, row_indexes, stop_event, progress):
+        """
+        事件循环中的任务主体：按并发上限逐行派发协程并记录结果
+
+        Args:
+            task: 任务对象
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            stop_event: 停止事件
+            progress: 任务进度计数器
+        """
+        max_concurrency = current_app.config.get('ASYNC_MAX_CONCURRENCY', 5000)
+        concurrency = max(1, min(task.concurrency, max_concurrency))
+        semaphore = asyncio.Semaphore(concurrency)
+        in_flight = set()
+
+        # 只有存在图片字段时才需要下载图片的HTTP客户端
+        http_client = None
+        if task.image_fields:
+            limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=min(concurrency, 100))
+            http_client = httpx.AsyncClient(follow_redirects=True, limits=limits)
+
+        logger.info(f"任务 {task.id} 使用asyncio引擎处理，并发数: {concurrency}")
+        budget = self.task_service.task_budgets.get(task.id)
+
+        try:
+            # 合并请求时每项是一组行
+            for row_index in self.task_service._pack_units(task, row_indexes):
+                if not await self._acquire_slot(semaphore, stop_event):
+                    break
+                # 接近预算时减少在途请求，用完预算后不再派发
+                if budget is not None and not await self._wait_budget(task, budget, concurrency, in_flight, stop_event):
+                    semaphore.release()
+                    break
+
+                if isinstance(row_index, list):
+                    future = asyncio.ensure_future(self.task_service._process_pack_async(task, rows, row_index))
+                else:
+                    future = asyncio.ensure_future(self.task_service._process_row_async(
+                        task,
+                        rows.row(row_index),
+                        row_index,
+                        http_client
+                    ))
+                in_flight.add(future)
+                future.add_done_callback(
+                    lambda f, index=row_index: self._on_row_done(f, index, task, semaphore, in_flight, progress)
+                )
+
+            # 等待剩余的在途请求，期间定期检查停止事件
+            while in_flight and not stop_event.is_set():
+                await asyncio.wait(set(in_flight), timeout=0.5)
+
+        finally:
+            # 任务被停止时取消所有在途请求
+            for future in list(in_flight):
+                future.cancel()
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+            if http_client is not None:
+                await http_client.aclose()
+            await self.task_service.llm_service.close_async_clients()
+
+    async def _acquire_slot(self, semaphore, stop_event):
+        """
+        获取一个并发槽位，等待期间响应停止事件
+
+        Returns:
+            bool: 是否成功获取（任务被停止时返回False）
+        """
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            if stop_event.is_set():
+                semaphore.release()
+                return False
+            return True
+        return False
+
+    async def _wait_budget(self, task, budget, concurrency, in_flight, stop_event):
+        """
+        等待在途请求数降到预算允许的数量以下
+
+        Returns:
+            bool: 是否可以派发下一个请求（预算用完或任务被停止时返回False）
+        """
+        while not stop_event.is_set():
+            limit = budget.allowed_in_flight(concurrency)
+            if not limit:
+                budget.pause(task.id)
+                return False
+            if len(in_flight) < limit:
+                return True
+            await asyncio.wait(set(in_flight), timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+        return False
+
+    def _on_row_done(self, future, row_index, task, semaphore, in_flight, progress):
+        """
+        单行协程完成回调：释放并发槽位并更新任务进度
+        """
+        in_flight.discard(future)
+        semaphore.release()
+
+        if future.cancelled():
+            return
+
+        if isinstance(row_index, list):
+            self.task_service._record_pack_outcomes(task, row_index, future, progress)
+            return
+
+        try:
+            result, is_success = future.result()
+        except Exception as e:
+            logger.error(f"处理行 {row_index} 结果时出错: {str(e)}")
+            result, is_success = f"处理错误: {str(e)}", False
+        if is_success is None:
+            # 任务停止或剩余预算不足而放弃的行，没有日志，续跑时处理
+            return
+
+        task.result_column[row_index] = result
+        progress.record(is_success)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import logging
+from flask import current_app
+from database.models import TaskLog, TaskBatch
+from services.llm_service import BATCH_ENDPOINT
+from services.response_cache import response_cache_key
+
+logger = logging.getLogger(__name__)
+
+# 批处理的终止状态
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchTaskEngine:
+    """基于服务商Batch API的任务执行引擎
+
+    不逐行同步调用LLM，而是把所有待处理行的请求写入JSONL文件，上传后创建批处理，
+    定期查询状态，完成后下载结果文件并按custom_id映射回行索引，写入任务日志和结果列。
+    适合不要求实时返回的大任务（服务商通常在24小时内完成，费用更低）。
+
+    请求体与call_api发送的相同。启用了请求去重时，相同的请求只提交一次；
+    API配置启用了响应缓存时，命中缓存的行不再提交。
+    提交的批处理ID和custom_id到行的映射保存在task_batches表中，结果写入任务日志后删除；
+    进程在批处理完成前重启时，续跑重新接管仍然有效的批处理，只提交其余没有成功日志的行。
+    任务被停止时取消尚未完成的批处理，续跑时重新提交这些行。
+    """
+
+    def __init__(self, task_service):
+        """
+        初始化批处理执行引擎
+
+        Args:
+            task_service: 任务管理服务
+        """
+        self.task_service = task_service
+        self.task_batches = {}  # 任务ID -> 该任务的批处理状态列表
+
+    def run(self, task, rows, row_indexes, stop_event, progress):
+        """
+        提交批处理并等待完成，直到所有行处理完毕或任务被停止
+
+        Args:
+            task: 任务对象
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            stop_event: 停止事件
+            progress: 任务进度计数器
+        """
+        llm_service = self.task_service.llm_service
+        config = llm_service.resolve_api_config(task.api_config_id)
+        start_time = time.time()
+
+        # 续跑时先接管上一次运行提交且仍然有效的批处理，其中的行不再提交
+        batches, requests = self._reattach_batches(task)
+        if requests:
+            # 上一次运行已写入成功日志的行不再重复记录
+            pending = set(row_indexes)
+            for request in requests.values():
+                request['rows'] = [row_index for row_index in request['rows'] if row_index in pending]
+            attached = {row_index for request in requests.values() for row_index in request['rows']}
+            row_indexes = [row_index for row_index in row_indexes if row_index not in attached]
+
+        new_requests = self._build_requests(task, config, rows, row_indexes, stop_event, progress)
+        requests.update(new_requests)
+        if stop_event.is_set() or not requests:
+            return
+
+        self.task_batches[task.id] = batches
+        try:
+            for chunk in self._split_requests(new_requests):
+                batch = llm_service.submit_batch(config, [
+                    {'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': new_requests[custom_id]['body']}
+                    for custom_id in chunk
+                ], metadata={'task_id': str(task.id)})
+                # 提交后立即记录，进程重启后据此接管该批处理
+                record = TaskBatch(
+                    task_id=task.id,
+                    batch_id=batch['id'],
+                    api_config_id=config.id,
+                    requests={
+                        custom_id: {'rows': new_requests[custom_id]['rows'], 'cache_key': new_requests[custom_id]['cache_key']}
+                        for custom_id in chunk
+                    }
+                )
+                record.save()
+                batches.append(self._batch_state(batch, chunk, config, record))
+                logger.info(f"任务 {task.id} 已提交批处理 {batch['id']}，包含 {len(chunk)} 个请求")
+
+            self._wait_batches(task, batches, requests, stop_event, progress, start_time)
+        finally:
+            self.task_batches.pop(task.id, None)
+
+    def _reattach_batches(self, task):
+        """
+        接管任务此前提交、尚未取回结果的批处理（进程在批处理完成前重启的情况）
+
+        已失败、过期或取消的批处理不再接管，其中的行重新提交；无法查询状态的批处理仍然接管，
+        等待时继续查询，避免重复提交
+
+        Returns:
+            tuple: (批处理状态列表, custom_id -> {'rows': 行索引, 'cache_key': 缓存键})
+        """
+        llm_service = self.task_service.llm_service
+        batches = []
+        requests = {}
+        for record in TaskBatch.get_by_task(task.id):
+            try:
+                config = llm_service.resolve_api_config(record.api_config_id)
+            except Exception as e:
+                logger.warning(f"批处理 {record.batch_id} 使用的API配置已不可用，重新提交其中的行: {str(e)}")
+                record.delete()
+                continue
+
+            try:
+                info = llm_service.get_batch(config, record.batch_id)
+            except Exception as e:
+                logger.warning(f"查询批处理 {record.batch_id} 的状态时出错，仍然接管: {str(e)}")
+                info = {'id': record.batch_id}
+
+            if info.get('status') in ('failed', 'expired', 'cancelled'):
+                logger.info(f"任务 {task.id} 的批处理 {record.batch_id} 状态为 {info['status']}，重新提交其中的行")
+                record.delete()
+                continue
+
+            batches.append(self._batch_state(info, list(record.requests), config, record))
+            requests.update(record.requests)
+            logger.info(f"任务 {task.id} 接管批处理 {record.batch_id}，包含 {len(record.requests)} 个请求")
+        return batches, requests
+
+    def get_task_batches(self, task_id):
+        """
+        获取任务当前的批处理状态
+
+        Args:
+            task_id: 任务ID
+
+        Returns:
+            list: 每个批处理的ID、状态和请求计数，没有批处理时返回None
+        """
+        batches = self.task_batches.get(task_id)
+        if not batches:
+            return None
+        return [
+            {'id': batch['id'], 'status': batch['status'], 'request_counts': batch['request_counts']}
+            for batch in batches
+        ]
+
+    def _build_requests(self, task, config, rows, row_indexes, stop_event, progress):
+        """
+        构建所有行的请求体，命中响应缓存的行直接记录结果
+
+        Returns:
+            dict: custom_id -> {'body': 请求体, 'cache_key': 缓存键, 'rows': 使用该结果的行索引}
+        """
+        llm_service = self.task_service.llm_service
+        excel_service = self.task_service.excel_service
+        image_service = self.task_service.image_service
+        cache_stats = self.task_service.task_cache_stats.get(task.id)
+        dedup = current_app.config.get('DEDUP_REQUESTS', True)
+
+        requests = {}
+        by_key = {}  # 请求键 -> custom_id
+        for row_index in row_indexes:
+            if stop_event.is_set():
+                break
+            try:
+                if task.prompts is not None:
+                    prompt = task.prompts[row_index]
+                else:
+                    prompt = excel_service.process_template(task.prompt_template, rows.row(row_index))
+
+                image_data = None
+                if task.image_fields:
+                    try:
+                        image_data = image_service.extract_image_data_from_row(rows.row(row_index), task.image_fields)
+                    except Exception as e:
+                        logger.warning(f"处理图片数据时出错: {str(e)}")
+
+                body = llm_service.build_request_body(config, prompt, image_data)
+                cache_key, cached = llm_service._lookup_response_cache(config, body, cache_stats)
+            except Exception as e:
+                logger.error(f"构建行 {row_index} 的请求时出错: {str(e)}")
+                self._record_error(task, [row_index], str(e), progress)
+                continue
+
+            if cached:
+                self._record_success(task, [row_index], cached[0], 0, 0, 0, progress)
+                continue
+
+            key = cache_key or response_cache_key(body)
+            if dedup and key in by_key:
+                requests[by_key[key]]['rows'].append(row_index)
+                continue
+
+            custom_id = f'row-{row_index}'
+            requests[custom_id] = {'body': body, 'cache_key': cache_key, 'rows': [row_index]}
+            by_key[key] = custom_id
+
+        return requests
+
+    def _split_requests(self, requests):
+        """按单个批处理的请求数和文件大小上限拆分请求"""
+        max_requests = current_app.config.get('BATCH_MAX_REQUESTS', 50000)
+        max_bytes = current_app.config.get('BATCH_MAX_FILE_BYTES', 100 * 1024 * 1024)
+
+        chunk = []
+        size = 0
+        for custom_id, request in requests.items():
+            line_size = len(json.dumps(request['body'], ensure_ascii=False).encode('utf-8')) + 100
+            if chunk and (len(chunk) >= max_requests or size + line_size > max_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(custom_id)
+            size += line_size
+        if chunk:
+            yield chunk
+
+    def _batch_state(self, batch, custom_ids, config, record):
+        """记录一个批处理的状态"""
+        return {
+            'id': batch['id'],
+            'status': batch.get('status'),
+            'request_counts': batch.get('request_counts') or {},
+            'custom_ids': custom_ids,
+            'config': config,
+            'record': record
+        }
+
+    def _wait_batches(self, task, batches, requests, stop_event, progress, start_time):
+        """
+        定期查询批处理状态，完成的批处理随即下载结果；任务被停止时取消未完成的批处理
+        """
+        llm_service = self.task_service.llm_service
+        poll_interval = current_app.config.get('BATCH_POLL_INTERVAL', 30)
+        active = list(batches)
+
+        while active:
+            if stop_event.wait(poll_interval):
+                for batch in active:
+                    try:
+                        llm_service.cancel_batch(batch['config'], batch['id'])
+                        batch['record'].delete()
+                        logger.info(f"任务 {task.id} 已停止，取消批处理 {batch['id']}")
+                    except Exception as e:
+                        logger.warning(f"取消批处理 {batch['id']} 时出错: {str(e)}")
+                return
+
+            for batch in list(active):
+                try:
+                    info = llm_service.get_batch(batch['config'], batch['id'])
+                except Exception as e:
+                    # 查询失败时下次继续查询，批处理仍在服务端执行
+                    logger.warning(f"查询批处理 {batch['id']} 的状态时出错: {str(e)}")
+                    continue
+
+                batch['status'] = info.get('status')
+                batch['request_counts'] = info.get('request_counts') or {}
+                if batch['status'] in BATCH_TERMINAL_STATUSES:
+                    active.remove(batch)
+                    logger.info(f"任务 {task.id} 的批处理 {batch['id']} 已结束，状态: {batch['status']}")
+                    self._collect_results(task, batch, info, requests, progress, time.time() - start_time)
+                    # 结果日志提交后才删除记录，进程在此之前重启时续跑仍会接管该批处理
+                    self.task_service.log_writer.flush()
+                    batch['record'].delete()
+
+    def _collect_results(self, task, batch, info, requests, progress, elapsed):
+        """
+        下载批处理的结果文件和错误文件，按custom_id写入各行的结果
+        """
+        llm_service = self.task_service.llm_service
+        config = batch['config']
+        remaining = set(batch['custom_ids'])
+
+        for file_id in (info.get('output_file_id'), info.get('error_file_id')):
+            if not file_id:
+                continue
+            try:
+                results = llm_service.get_batch_results(config, file_id)
+            except Exception as e:
+                logger.error(f"下载批处理 {batch['id']} 的结果文件 {file_id} 时出错: {str(e)}")
+                continue
+
+            for result in results:
+                custom_id = result.get('custom_id')
+                if custom_id not in remaining:
+                    continue
+                remaining.discard(custom_id)
+                request = requests[custom_id]
+                try:
+                    response_text, token_count, completion_tokens = llm_service.parse_batch_result(result)
+                except Exception as e:
+                    self._record_error(task, request['rows'], str(e), progress)
+                    continue
+                llm_service._store_response_cache(request['cache_key'], response_text, token_count)
+                self._record_success(
+                    task, request['rows'], response_text, token_count, completion_tokens, elapsed, progress
+                )
+
+        # 批处理失败、过期或被取消时，没有返回结果的请求记为失败
+        if remaining:
+            errors = (info.get('errors') or {}).get('data') or []
+            reason = '; '.join(error.get('message', '') for error in errors if isinstance(error, dict))
+            message = f"批处理 {batch['id']} 状态为 {batch['status']}，未返回该行结果" + (f": {reason}" if reason else '')
+            for custom_id in remaining:
+                self._record_error(task, requests[custom_id]['rows'], message, progress)
+
+    def _record_success(self, task, row_indexes, response_text, token_count, completion_tokens, processing_time,
+                        progress):
+        """
+        记录成功的结果，第一行计入token数，复用同一结果的其余行标记为去重
+        """
+        for position, row_index in enumerate(row_indexes):
+            log = TaskLog(
+                task_id=task.id,
+                row_index=row_index,
+                status=TaskLog.STATUS_SUCCESS,
+                processing_time=processing_time,
+                token_count=token_count if position == 0 else 0,
+                response_text=response_text,
+                completion_tokens=completion_tokens if position == 0 else 0
+            )
+            log.deduplicated = 1 if position > 0 else 0
+            self.task_service.log_writer.write(log)
+            task.result_column[row_index] = response_text
+            progress.record(True)
+
+    def _record_error(self, task, row_indexes, message, progress):
+        """记录失败的行"""
+        for row_index in row_indexes:
+            log = TaskLog(
+                task_id=task.id,
+                row_index=row_index,
+                status=TaskLog.STATUS_ERROR,
+                error_message=message
+            )
+            self.task_service.log_writer.write(log)
+            task.result_column[row_index] = f"处理错误: {message}"
+            progress.record(False)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from services.scheduler import SlotCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExhausted(SlotCancelled):
+    """剩余预算不足以发送请求，与任务停止时一样放弃该行且不记录日志（续跑时重新处理）"""
+
+
+class TaskBudget:
+    """一个任务的token和费用预算（线程安全）
+
+    每个请求结束时按服务商返回的token数累加用量（复用响应、命中缓存的请求token数为0，不计入）。
+    费用按API配置的每百万token价格和服务商返回的实际用量计算：输出token按输出价格，其余按输入价格；
+    服务商没有返回输入和输出的拆分时，全部token数都按输出价格计（宁可多计，不会超出费用预算）。
+    用量达到预算的slowdown_at后，派发器按剩余预算的比例降低在途请求上限；
+    用量达到预算后不再派发新的请求，在途请求完成后任务暂停。
+
+    实际用量在请求结束后才知道，因此每个请求发送前还要按预估用量预约预算（try_reserve），
+    已用量加上在途请求的预约量超过预算时等待在途请求结束；没有在途请求时剩余预算仍不足，
+    则放弃该请求并暂停任务。请求结束后在同一把锁内释放预约并计入实际用量（settle），
+    其他请求预约时不会看到既没有预约、也没有计入的用量。
+    每个请求的预估用量为已计入用量的每行平均token数和平均费用乘以请求的行数；还没有日志时为预估提示词token数加上completion_tokens，
+    这一预估可能远大于实际用量，因此没有在途请求时总是允许发送第一个请求，以得到实际用量。
+    """
+
+    def __init__(self, token_budget=0, cost_budget=0, input_price=0, output_price=0, prompt_tokens=0,
+                 slowdown_at=0.9, tokens_used=0, prompt_tokens_used=0, logs_used=0, completion_tokens=0):
+        """
+        初始化任务预算
+
+        Args:
+            token_budget: 最多消耗的token数，0表示不限制
+            cost_budget: 最多花费的费用，0表示不限制
+            input_price: 每百万输入token的价格
+            output_price: 每百万输出token的价格
+            prompt_tokens: 每个请求的预估提示词token数
+            slowdown_at: 用量达到预算的该比例后开始降低在途请求上限
+            tokens_used: 此前（续跑前）已消耗的token数
+            prompt_tokens_used: 此前已消耗的token数中已知的输入token数（其余按输出价格计）
+            logs_used: 此前token数不为0的日志数
+            completion_tokens: 还没有日志时每个请求的预估输出token数
+        """
+        self.token_budget = token_budget or 0
+        self.cost_budget = cost_budget or 0
+        self.input_price = input_price or 0
+        self.output_price = output_price or 0
+        self.prompt_tokens = max(0, int(prompt_tokens))
+        self.slowdown_at = min(max(slowdown_at, 0.0), 0.99)
+        self._lock = threading.Lock()
+        self.tokens_used = tokens_used
+        self.cost_used = self._cost(prompt_tokens_used, tokens_used - prompt_tokens_used)
+        self.completion_tokens = max(0, int(completion_tokens))
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self._logged_requests = logs_used  # 计入用量的行数（包括续跑前的日志数）
+        self._logged_tokens = tokens_used
+        self._logged_cost = self.cost_used
+        self.paused = False  # 派发器因用完预算而停止派发
+
+    def _cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.input_price + completion_tokens * self.output_price) / 1000000
+
+    def settle(self, reservation, token_count=0, completion_tokens=None, row_count=1):
+        """
+        请求结束后释放预约并计入实际用量（在同一把锁内完成）
+
+        Args:
+            reservation: try_reserve返回的预约，没有预约时为None（例如对冲中落后的请求）
+            token_count: 请求实际消耗的token数，请求失败时为0
+            completion_tokens: 其中的输出token数，None表示服务商没有返回拆分（全部按输出价格计）
+            row_count: 请求包含的行数（多行合并请求），预估每行用量时使用
+        """
+        token_count = token_count if token_count and token_count > 0 else 0
+        prompt_tokens = 0
+        if completion_tokens is not None:
+            prompt_tokens = token_count - min(max(completion_tokens, 0), token_count)
+        cost = self._cost(prompt_tokens, token_count - prompt_tokens)
+        with self._lock:
+            if reservation is not None:
+                tokens, reserved_cost = reservation
+                self.reserved_tokens -= tokens
+                self.reserved_cost -= reserved_cost
+            if token_count:
+                self.tokens_used += token_count
+                self.cost_used += cost
+                self._logged_requests += row_count
+                self._logged_tokens += token_count
+                self._logged_cost += cost
+
+    def try_reserve(self, task_id, row_count=1):
+        """
+        发送请求前按预估用量预约预算
+
+        Args:
+            task_id: 任务ID
+            row_count: 请求包含的行数（多行合并请求）
+
+        Returns:
+            tuple: 预约的(token数, 费用)，请求结束后传给settle；
+                   在途请求的预约占用了剩余预算时返回None，调用方稍后重试
+
+        Raises:
+            BudgetExhausted: 已暂停派发，或没有在途请求时剩余预算仍不足（同时暂停派发）
+        """
+        if self.paused:
+            raise BudgetExhausted(f"任务 {task_id} 的预算已用完")
+        with self._lock:
+            if self._logged_requests:
+                tokens = self._logged_tokens / self._logged_requests * row_count
+                cost = self._logged_cost / self._logged_requests * row_count
+            else:
+                tokens = (self.prompt_tokens + self.completion_tokens) * row_count
+                cost = self._cost(self.prompt_tokens * row_count, self.completion_tokens * row_count)
+            over_tokens = self.token_budget and self.tokens_used + self.reserved_tokens + tokens > self.token_budget
+            over_cost = self.cost_budget and self.cost_used + self.reserved_cost + cost > self.cost_budget
+            if not over_tokens and not over_cost:
+                self.reserved_tokens += tokens
+                self.reserved_cost += cost
+                return tokens, cost
+            if self.reserved_tokens > 0:
+                return None
+            if not self._logged_requests:
+                # 还没有实际用量，发送第一个请求
+                self.reserved_tokens += tokens
+                self.reserved_cost += cost
+                return tokens, cost
+        self.pause(task_id)
+        raise BudgetExhausted(f"任务 {task_id} 的剩余预算不足")
+
+    def used_fraction(self):
+        """
+        获取预算的使用比例（同时设置了token和费用预算时取较大者）
+
+        Returns:
+            float: 使用比例，1表示已用完
+        """
+        fractions = [0.0]
+        if self.token_budget:
+            fractions.append(self.tokens_used / self.token_budget)
+        if self.cost_budget:
+            fractions.append(self.cost_used / self.cost_budget)
+        return max(fractions)
+
+    def exhausted(self):
+        """预算是否已用完"""
+        return self.used_fraction() >= 1
+
+    def allowed_in_flight(self, limit):
+        """
+        按预算的使用比例计算当前允许的在途请求数
+
+        用量低于slowdown_at时不限制；之后随剩余预算线性降低，最少为1；用完后为0
+
+        Args:
+            limit: 不考虑预算时的在途请求上限
+
+        Returns:
+            int: 允许的在途请求数
+        """
+        fraction = self.used_fraction()
+        if fraction < self.slowdown_at:
+            return limit
+        if fraction >= 1:
+            return 0
+        return max(1, int(limit * (1 - fraction) / (1 - self.slowdown_at)))
+
+    def pause(self, task_id):
+        """派发器用完预算后停止派发时调用"""
+        if not self.paused:
+            self.paused = True
+            logger.warning(
+                f"任务 {task_id} 已用完预算（token: {self.tokens_used}/{self.token_budget or '不限'}，"
+                f"费用: {round(self.cost_used, 4)}/{self.cost_budget or '不限'}），在途请求完成后暂停"
+            )
+
+    def snapshot(self):
+        """
+        获取预算的使用情况
+
+        Returns:
+            dict: 预算、已用量、剩余量、使用比例及状态（normal、slowing或exhausted）
+        """
+        fraction = self.used_fraction()
+        if fraction >= 1 or self.paused:
+            state = 'exhausted'
+        elif fraction >= self.slowdown_at:
+            state = 'slowing'
+        else:
+            state = 'normal'
+        stats = {'used_fraction': round(fraction, 4), 'state': state, 'tokens_used': self.tokens_used}
+        if self.token_budget:
+            stats['token_budget'] = self.token_budget
+            stats['tokens_remaining'] = max(0, self.token_budget - self.tokens_used)
+        if self.cost_budget or self.input_price or self.output_price:
+            stats['cost_used'] = round(self.cost_used, 4)
+        if self.cost_budget:
+            stats['cost_budget'] = self.cost_budget
+            stats['cost_remaining'] = round(max(0.0, self.cost_budget - self.cost_used), 4)
+        return stats
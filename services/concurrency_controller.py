@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# call_api调用结果的分类
+OUTCOME_SUCCESS = 'success'
+OUTCOME_RATE_LIMIT = 'rate_limit'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_SERVER_ERROR = 'server_error'
+OUTCOME_ERROR = 'error'
+
+# 表示服务端拥塞、需要降低并发的结果类型
+CONGESTION_OUTCOMES = (OUTCOME_RATE_LIMIT, OUTCOME_TIMEOUT, OUTCOME_SERVER_ERROR)
+
+
+class AIMDController:
+    """单个API配置的AIMD并发控制器
+
+    - 成功且延迟正常：加性增加，每经过约一个"窗口"（limit次成功）上限加1
+    - 429、超时、5xx或短期延迟明显高于长期基线：乘性减少，上限乘以decrease_factor
+
+    两次减少之间至少间隔一个冷却期，避免同一批在途请求返回的多个429把上限一路压到最小值。
+    """
+
+    def __init__(self, config_id, initial_limit=8, min_limit=1, max_limit=1000,
+                 decrease_factor=0.5, latency_tolerance=2.0, history_size=50):
+        """
+        初始化控制器
+
+        Args:
+            config_id: API配置ID
+            initial_limit: 初始并发上限
+            min_limit: 最小并发上限
+            max_limit: 最大并发上限
+            decrease_factor: 乘性减少系数
+            latency_tolerance: 短期延迟超过长期基线多少倍时视为拥塞
+            history_size: 保留的上限变化记录条数
+        """
+        self.config_id = config_id
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+
+        self._lock = threading.Lock()
+        self._estimate = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self._short_latency = None   # 短期延迟EWMA
+        self._long_latency = None    # 长期延迟EWMA（基线）
+        self._last_decrease = 0.0
+        self._samples = 0
+        self.history = deque(maxlen=history_size)
+        self._record_history('initial')
+
+    @property
+    def limit(self):
+        """当前并发上限"""
+        return int(self._estimate)
+
+    def set_max_limit(self, max_limit):
+        """
+        更新最大并发上限（API配置的上限或全局上限变化时调用）
+
+        Returns:
+            bool: 当前上限是否因此变化
+        """
+        with self._lock:
+            old = self.limit
+            self.max_limit = max(self.min_limit, int(max_limit))
+            self._estimate = min(self._estimate, float(self.max_limit))
+            return self.limit != old
+
+    def on_result(self, latency, outcome):
+        """
+        记录一次API调用结果并调整并发上限
+
+        Args:
+            latency: 本次调用耗时（秒）
+            outcome: 结果类型（OUTCOME_*）
+
+        Returns:
+            bool: 并发上限是否发生变化
+        """
+        now = time.time()
+        with self._lock:
+            old = self.limit
+
+            if outcome == OUTCOME_SUCCESS and latency is not None:
+                self._samples += 1
+                if self._short_latency is None:
+                    self._short_latency = self._long_latency = latency
+                else:
+                    self._short_latency += 0.2 * (latency - self._short_latency)
+                    self._long_latency += 0.02 * (latency - self._long_latency)
+
+                # 积累足够样本后，短期延迟显著高于基线说明服务端开始排队
+                if (self._samples >= 20 and
+                        self._short_latency > self._long_latency * self.latency_tolerance):
+                    self._decrease(now, 'latency')
+                else:
+                    self._estimate = min(float(self.max_limit), self._estimate + 1.0 / max(1.0, self._estimate))
+                    if self.limit > old:
+                        self._record_history('increase')
+
+            elif outcome in CONGESTION_OUTCOMES:
+                self._decrease(now, outcome)
+
+            return self.limit != old
+
+    def _decrease(self, now, reason):
+        """乘性减少（在锁内调用）"""
+        cooldown = max(1.0, self._short_latency or 0.0)
+        if now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        self._estimate = max(float(self.min_limit), self._estimate * self.decrease_factor)
+        # 降低后以当前延迟作为新基线，避免连续因同一次延迟升高而减少
+        if self._short_latency is not None:
+            self._long_latency = self._short_latency
+        self._record_history(reason)
+        logger.warning(f"API配置 {self.config_id} 检测到拥塞({reason})，并发上限降为 {self.limit}")
+
+    def _record_history(self, reason):
+        self.history.append({
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'limit': self.limit,
+            'reason': reason
+        })
+
+    def snapshot(self):
+        """
+        获取控制器当前状态
+
+        Returns:
+            dict: 当前上限、延迟统计和上限变化历史
+        """
+        with self._lock:
+            return {
+                'config_id': self.config_id,
+                'limit': self.limit,
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'latency_short': round(self._short_latency, 3) if self._short_latency is not None else None,
+                'latency_baseline': round(self._long_latency, 3) if self._long_latency is not None else None,
+                'history': list(self.history)
+            }
+
+
+class AdaptiveConcurrencyRegistry:
+    """按API配置管理AIMD控制器，并在上限变化时通知监听方（例如全局调度器）"""
+
+    def __init__(self, initial_limit=8, min_limit=1, decrease_factor=0.5, latency_tolerance=2.0):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self._controllers = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        注册上限变化监听函数
+
+        Args:
+            listener: 回调函数 listener(config_id, limit)
+        """
+        self._listeners.append(listener)
+
+    def get(self, config_id, max_limit=None):
+        """
+        获取（必要时创建）API配置对应的控制器
+
+        Args:
+            config_id: API配置ID
+            max_limit: 最大并发上限，为None时保持不变
+
+        Returns:
+            AIMDController: 控制器
+        """
+        with self._lock:
+            controller = self._controllers.get(config_id)
+            if controller is None:
+                controller = AIMDController(
+                    config_id,
+                    initial_limit=self.initial_limit,
+                    min_limit=self.min_limit,
+                    max_limit=max_limit or 1000,
+                    decrease_factor=self.decrease_factor,
+                    latency_tolerance=self.latency_tolerance
+                )
+                self._controllers[config_id] = controller
+                return controller
+        if max_limit and controller.set_max_limit(max_limit):
+            self._notify(config_id, controller.limit)
+        return controller
+
+    def peek(self, config_id):
+        """获取已存在的控制器，不存在时返回None"""
+        return self._controllers.get(config_id)
+
+    def record(self, config_id, latency, outcome):
+        """
+        记录一次调用结果
+
+        Args:
+            config_id: API配置ID
+            latency: 调用耗时（秒）
+            outcome: 结果类型（OUTCOME_*）
+        """
+        controller = self._controllers.get(config_id)
+        if controller is None:
+            return
+        if controller.on_result(latency, outcome):
+            self._notify(config_id, controller.limit)
+
+    def _notify(self, config_id, limit):
+        for listener in self._listeners:
+            try:
+                listener(config_id, limit)
+            except Exception as e:
+                logger.error(f"通知并发上限变化时出错: {str(e)}")
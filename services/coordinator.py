@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hmac
+import logging
+import threading
+import pandas as pd
+from flask import current_app
+from database.models import Task, TaskLog, TaskJob
+from services.worker import TaskWorker
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLostError(Exception):
+    """租约已过期或已被其他Worker接管"""
+    pass
+
+
+def _json_safe(row_data):
+    """将DataFrame行转换为可以JSON序列化的字典（NaN转为None，numpy标量转为Python类型）"""
+    safe = {}
+    for key, value in row_data.items():
+        try:
+            if pd.isna(value):
+                value = None
+        except (TypeError, ValueError):
+            pass
+        if value is not None and not isinstance(value, (str, int, float, bool)):
+            value = value.item() if hasattr(value, 'item') else str(value)
+        safe[str(key)] = value
+    return safe
+
+
+class WorkerCoordinator:
+    """远程Worker协调服务
+
+    远程节点通过HTTP领取worker引擎任务的行批次（下发渲染后的提示词或原始行数据，
+    以及任务使用的API配置），在本地调用LLM后批量回传结果。Task和TaskLog仍是唯一的
+    数据来源：回传的结果写入task_logs，进度累加到tasks，批次状态保存在task_jobs中。
+    过期的租约在每次领取时重新入队；所有行批次完成后由协调端生成结果文件。
+    """
+
+    PAYLOAD_PROMPT = 'prompt'   # 下发渲染后的提示词（以及图片字段的值）
+    PAYLOAD_ROW = 'row'         # 下发原始行数据，由远程节点渲染提示词
+
+    def __init__(self, app):
+        """
+        初始化协调服务
+
+        Args:
+            app: Flask应用实例
+        """
+        self.app = app
+        self.task_service = app.task_service
+        # 用于读取任务数据和在协调端执行finalize任务
+        self._local_worker = TaskWorker(app, worker_id='coordinator')
+
+    def check_token(self, token):
+        """
+        校验远程Worker的共享令牌，未配置WORKER_TOKEN时拒绝所有请求
+
+        Args:
+            token: 请求头中的令牌
+
+        Returns:
+            bool: 是否通过校验
+        """
+        expected = current_app.config.get('WORKER_TOKEN')
+        if not expected or not token:
+            return False
+        return hmac.compare_digest(str(token), str(expected))
+
+    def lease(self, worker_id, max_jobs=1, payload=PAYLOAD_PROMPT):
+        """
+        为远程Worker领取行批次
+
+        Args:
+            worker_id: Worker标识
+            max_jobs: 最多领取的批次数
+            payload: 下发内容，prompt（渲染后的提示词）或row（原始行数据）
+
+        Returns:
+            dict: 领取到的批次列表和租约时长
+        """
+        lease_seconds = current_app.config.get('WORKER_LEASE_SECONDS', 60)
+
+        requeued = TaskJob.requeue_expired()
+        if requeued:
+            logger.info(f"{requeued} 个队列任务的租约已过期，重新入队")
+
+        # 协调端顺便处理已可执行的finalize任务（远程节点无法生成结果文件）
+        self._start_finalize()
+
+        jobs = []
+        for _ in range(max(1, min(int(max_jobs or 1), 10))):
+            job = TaskJob.claim(worker_id, lease_seconds, kind=TaskJob.KIND_ROWS)
+            if job is None:
+                break
+            try:
+                jobs.append(self._build_job_payload(job, payload))
+            except Exception as e:
+                logger.error(f"准备队列任务 {job.id} 的数据时出错: {str(e)}")
+                job.release()
+
+        if jobs:
+            logger.info(f"远程Worker {worker_id} 领取了 {len(jobs)} 个批次")
+        return {'jobs': jobs, 'lease_seconds': lease_seconds}
+
+    def _build_job_payload(self, job, payload):
+        """
+        构建下发给远程Worker的批次数据
+
+        Args:
+            job: 已领取的队列任务
+            payload: 下发内容类型
+
+        Returns:
+            dict: 批次数据
+        """
+        task = Task.get_by_id(job.task_id)
+        config = self.task_service.llm_service.resolve_api_config(task.api_config_id)
+        data = self._local_worker.get_task_data(task)
+
+        # 跳过已经成功的行（批次可能在上一个Worker失联前已部分完成）
+        succeeded = TaskLog.get_succeeded_rows(task.id, job.row_indexes)
+        rows = []
+        for row_index in job.row_indexes:
+            if row_index in succeeded or not 0 <= row_index < len(data):
+                continue
+            row_data = data.row(row_index)
+            item = {'row_index': row_index}
+            if payload == self.PAYLOAD_ROW:
+                item['row_data'] = _json_safe(row_data)
+            else:
+                item['prompt'] = self.task_service.excel_service.process_template(task.prompt_template, row_data)
+                if task.image_fields:
+                    item['row_data'] = _json_safe({field: row_data.get(field) for field in task.image_fields})
+            rows.append(item)
+
+        return {
+            'job_id': job.id,
+            'lease_token': job.lease_token,
+            'task_id': task.id,
+            'concurrency': task.concurrency,
+            'prompt_template': task.prompt_template,
+            'image_fields': task.image_fields,
+            'api_config': config.to_dict(),
+            'rows': rows
+        }
+
+    def heartbeat(self, job_id, lease_token):
+        """
+        续约
+
+        Args:
+            job_id: 队列任务ID
+            lease_token: 领取时下发的租约令牌
+
+        Returns:
+            bool: 任务是否仍在运行（已停止时远程Worker应放弃该批次）
+
+        Raises:
+            LeaseLostError: 租约已失效
+        """
+        job = self._get_leased_job(job_id, lease_token)
+        task = Task.get_by_id(job.task_id)
+        return bool(task) and task.status == Task.STATUS_RUNNING
+
+    def submit_results(self, job_id, lease_token, results, complete=False):
+        """
+        接收远程Worker批量回传的结果
+
+        Args:
+            job_id: 队列任务ID
+            lease_token: 租约令牌
+            results: 结果列表，每项包含row_index、status，以及response_text/token_count/
+                processing_time（成功）或error_message（失败）
+            complete: 批次是否已全部处理完
+
+        Returns:
+            int: 写入的结果条数
+
+        Raises:
+            LeaseLostError: 租约已失效（结果不会被写入，批次由新的持有者重新处理）
+        """
+        job = self._get_leased_job(job_id, lease_token)
+        allowed = set(job.row_indexes)
+
+        logs = []
+        success = 0
+        for item in results or []:
+            row_index = int(item.get('row_index', -1))
+            if row_index not in allowed:
+                continue
+            if item.get('status') == TaskLog.STATUS_SUCCESS:
+                success += 1
+                log = TaskLog(
+                    task_id=job.task_id,
+                    row_index=row_index,
+                    status=TaskLog.STATUS_SUCCESS,
+                    processing_time=item.get('processing_time') or 0,
+                    token_count=item.get('token_count') or 0,
+                    response_text=item.get('response_text'),
+                    completion_tokens=item.get('completion_tokens')
+                )
+            else:
+                log = TaskLog(
+                    task_id=job.task_id,
+                    row_index=row_index,
+                    status=TaskLog.STATUS_ERROR,
+                    error_message=item.get('error_message') or '远程Worker处理失败'
+                )
+            logs.append(log)
+
+        TaskLog.save_many(logs)
+        if logs:
+            Task.add_progress(job.task_id, len(logs), success, len(logs) - success)
+
+        if complete:
+            job.complete()
+            self._start_finalize(job.task_id)
+
+        return len(logs)
+
+    def _get_leased_job(self, job_id, lease_token):
+        """校验租约并续约，返回队列任务"""
+        job = TaskJob.get_by_id(job_id)
+        if not job or not lease_token or job.lease_token != lease_token:
+            raise LeaseLostError(f"队列任务 {job_id} 的租约已失效")
+        if not job.heartbeat(current_app.config.get('WORKER_LEASE_SECONDS', 60)):
+            raise LeaseLostError(f"队列任务 {job_id} 的租约已失效")
+        return job
+
+    def _start_finalize(self, task_id=None):
+        """
+        领取可执行的finalize任务，并在后台线程中生成结果文件
+
+        Args:
+            task_id: 只检查指定任务，为None时检查所有任务
+        """
+        job = TaskJob.claim(
+            self._local_worker.worker_id,
+            current_app.config.get('WORKER_LEASE_SECONDS', 60),
+            kind=TaskJob.KIND_FINALIZE,
+            task_id=task_id
+        )
+        if job is None:
+            return
+        logger.info(f"协调端开始生成任务 {job.task_id} 的结果文件")
+        threading.Thread(target=self._run_finalize, args=(job,), daemon=True).start()
+
+    def _run_finalize(self, job):
+        with self.app.app_context():
+            try:
+                self._local_worker.run_job(job)
+            except Exception as e:
+                logger.error(f"协调端处理队列任务 {job.id} 时出错: {str(e)}")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(config_key, prompt, image_data=None):
+    """
+    计算一次LLM请求的去重键
+
+    Args:
+        config_key: API配置标识（配置ID、模型及参数）
+        prompt: 渲染后的提示词
+        image_data: 图片的base64数据列表
+
+    Returns:
+        str: 请求内容的SHA-256
+    """
+    image_hashes = [
+        hashlib.sha256(image.encode('utf-8')).hexdigest() if image else None
+        for image in (image_data or [])
+    ]
+    payload = json.dumps([config_key, prompt, image_hashes], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class RequestCoalescer:
+    """任务内的请求去重与在途请求合并
+
+    同一任务中完全相同的请求（提示词、图片、API配置都相同）只调用一次LLM：
+    第一个请求负责调用，同时到达的相同请求等待它的结果，之后到达的相同请求直接复用
+    已成功的响应。调用失败的结果不会被缓存，之后到达的相同请求会重新调用。
+    结果通过concurrent.futures.Future传递，线程可以直接等待，协程通过asyncio.wrap_future等待。
+    """
+
+    def __init__(self, config_key):
+        """
+        初始化请求合并器
+
+        Args:
+            config_key: 任务使用的API配置标识（配置ID、模型及参数），参与计算请求键
+        """
+        self.config_key = config_key
+        self._futures = {}  # 请求键 -> Future
+        self._lock = threading.Lock()
+        self.unique_requests = 0
+        self.deduplicated = 0
+
+    def key_for(self, prompt, image_data=None):
+        """计算该任务中一次请求的去重键"""
+        return request_key(self.config_key, prompt, image_data)
+
+    def join(self, key):
+        """
+        加入一个请求
+
+        Args:
+            key: 请求键
+
+        Returns:
+            tuple: (Future, 是否由调用方负责调用LLM)
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._futures[key] = future
+            self.unique_requests += 1
+            return future, True
+
+    def resolve(self, key, future, result):
+        """
+        设置请求的结果，等待中的相同请求随即返回
+
+        Args:
+            key: 请求键
+            future: join()返回的Future
+            result: 调用结果
+        """
+        future.set_result(result)
+
+    def fail(self, key, future, error):
+        """
+        请求调用失败：通知等待中的相同请求，并移除该请求使之后的相同请求重新调用
+
+        Args:
+            key: 请求键
+            future: join()返回的Future
+            error: 异常
+        """
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+        if not future.done():
+            future.set_exception(error)
+
+    def snapshot(self):
+        """
+        获取去重统计
+
+        Returns:
+            dict: 实际调用数、复用响应数及复用比例
+        """
+        with self._lock:
+            total = self.unique_requests + self.deduplicated
+            return {
+                'unique_requests': self.unique_requests,
+                'deduplicated': self.deduplicated,
+                'ratio': round(self.deduplicated / total, 4) if total else 0
+            }
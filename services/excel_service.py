@@ -2,19 +2,191 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import hashlib
+import itertools
+import threading
+import numpy as np
 import pandas as pd
 import logging
 from flask import current_app
 from database.models import ExcelSchema
 
+# 导入pyarrow（可选，用于上传文件的列式缓存）
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# 模板中的字段标记：{{字段名}}，字段名中不能包含花括号
+PLACEHOLDER_PATTERN = re.compile(r'\{\{([^{}]+)\}\}')
+
+class TemplateError(ValueError):
+    """提示词模板引用了Excel中不存在的字段"""
+    
+    def __init__(self, unknown_fields):
+        self.unknown_fields = unknown_fields
+        super().__init__(f"提示词模板中的字段不存在于Excel文件中: {', '.join(unknown_fields)}")
+
+class CompiledTemplate:
+    """预编译的提示词模板
+
+    编译时把模板拆分为文本片段和字段引用交替的列表，渲染时只取模板引用的字段，
+    一次join生成提示词，而不是对行中的每个字段都在整个模板上执行一次str.replace。
+    行数据中不存在的字段保留原样的{{字段名}}标记。
+    """
+    
+    def __init__(self, template):
+        """
+        编译提示词模板
+        
+        Args:
+            template: 提示词模板
+        """
+        self.template = template or ''
+        # split后偶数位置是文本片段，奇数位置是字段名
+        parts = PLACEHOLDER_PATTERN.split(self.template)
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+    
+    def render(self, row_data):
+        """
+        用行数据渲染提示词
+        
+        Args:
+            row_data: 行数据字典
+            
+        Returns:
+            str: 渲染后的提示词
+        """
+        if not self.fields:
+            return self.template
+        
+        literals = self.literals
+        output = [literals[0]]
+        for position, field in enumerate(self.fields, 1):
+            if field in row_data:
+                output.append(_format_value(row_data[field]))
+            else:
+                output.append(f"{{{{{field}}}}}")
+            output.append(literals[position])
+        return ''.join(output)
+    
+    def field_values(self, row_data):
+        """
+        获取模板引用的各字段在该行中的文本值（多行合并为一个请求时使用）
+        
+        Args:
+            row_data: 行数据字典
+            
+        Returns:
+            dict: 字段名 -> 文本值（按模板中首次出现的顺序，行中不存在的字段不包含在内）
+        """
+        return {
+            field: _format_value(row_data[field])
+            for field in dict.fromkeys(self.fields)
+            if field in row_data
+        }
+
+def _format_value(value):
+    """将单元格的值转换为提示词中的文本：None、NaN和空白字符串统一为空字符串"""
+    if isinstance(value, str):
+        return value if value.strip() else ''
+    if value is None:
+        return ''
+    try:
+        if pd.isna(value):
+            return ''
+    except (TypeError, ValueError):
+        pass
+    return str(value)
+
+def _format_column(series):
+    """
+    将一整列转换为提示词中的文本，规则与_format_value一致
+    
+    Args:
+        series: 一列数据
+        
+    Returns:
+        ndarray: 字符串组成的object数组
+    """
+    dtype = series.dtype
+    is_numeric = pd.api.types.is_numeric_dtype(dtype)
+    if is_numeric or pd.api.types.is_string_dtype(dtype):
+        mask = series.isna().to_numpy(dtype=bool, copy=True)
+        if not is_numeric:
+            # 只包含空白字符的字符串视为空值（非字符串的值在.str中为NaN，不会被当作空白）
+            try:
+                mask |= series.str.strip().eq('').to_numpy(dtype=bool, na_value=False)
+            except AttributeError:
+                pass
+        text = series.astype(str).to_numpy(dtype=object, copy=True)
+        text[mask] = ''
+        return text
+    # 日期等其他类型按不重复的值逐个转换，保证与逐行渲染的结果一致
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    formatted = np.array([_format_value(value) for value in uniques.tolist()], dtype=object)
+    return formatted[codes]
+
+def _column_values(series):
+    """将一列转换为Python列表，可能包含pd.NA的列（对象类型和扩展类型）把pd.NA转换为None"""
+    values = series.tolist()
+    if series.dtype == object or isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        values = [None if value is pd.NA else value for value in values]
+    return values
+
+class RowAccessor:
+    """按列存储的行数据访问器
+
+    创建时把DataFrame的每一列转换为Python列表，之后按行索引组装行字典，
+    不再为每一行创建pandas Series（df.iloc[i].to_dict()）。
+
+    每个值保持其所在列的类型：df.iloc[i]会把整行转换为各列的公共类型，
+    例如同时有整数列和浮点数列时整数5变为5.0，这里仍为5（渲染的提示词为"5"而不是"5.0"）。
+    缺失值pd.NA与to_dict()一样转换为None。
+    """
+    
+    def __init__(self, df):
+        """
+        初始化行数据访问器
+        
+        Args:
+            df: 任务数据DataFrame
+        """
+        # 按位置取列，兼容重复的列名（与to_dict()一样，后面的同名列覆盖前面的）；
+        # 列名统一为字符串，与保存的字段名及模板中的{{字段名}}一致（表头可能是数字）
+        self._columns = [
+            (str(name), _column_values(df.iloc[:, position])) for position, name in enumerate(df.columns)
+        ]
+        self._length = len(df)
+    
+    def __len__(self):
+        return self._length
+    
+    def row(self, row_index):
+        """
+        获取一行数据
+        
+        Args:
+            row_index: 行索引（从0开始的位置）
+            
+        Returns:
+            dict: 字段名到值的映射
+        """
+        return {name: values[row_index] for name, values in self._columns}
+
 class ExcelService:
     """Excel文件处理服务"""
     
     def __init__(self):
         """初始化Excel服务"""
-        pass
+        self._compiled_templates = {}  # 提示词模板 -> CompiledTemplate
+        self._lock = threading.Lock()
     
     def parse_excel(self, file_path):
         """
@@ -24,26 +196,16 @@ class ExcelService:
             file_path: Excel文件路径
             
         Returns:
-            tuple: (字段列表, 预览数据)
+            tuple: (字段列表, 预览数据, 数据行数, 列式缓存信息)，缓存信息为
+                write_cache()的返回值，无法生成缓存时为None
         """
         try:
             logger.info(f"开始解析Excel文件: {file_path}")
             
-            # 根据文件扩展名决定如何读取文件
-            file_ext = os.path.splitext(file_path)[1].lower()
+            df = self._read_file(file_path)
             
-            if file_ext == '.csv':
-                # 尝试不同编码读取CSV
-                try:
-                    df = pd.read_csv(file_path, encoding='utf-8', keep_default_na=True)
-                except UnicodeDecodeError:
-                    try:
-                        df = pd.read_csv(file_path, encoding='gbk', keep_default_na=True)
-                    except UnicodeDecodeError:
-                        df = pd.read_csv(file_path, encoding='latin1', keep_default_na=True)
-            else:  # .xlsx 或 .xls
-                # 使用keep_default_na=True确保空值被正确处理为NaN
-                df = pd.read_excel(file_path, keep_default_na=True)
+            # 同时生成列式缓存，之后读取数据时不再解析原始文件
+            cache_info = self.write_cache(df, file_path)
             
             # 获取字段列表
             fields = df.columns.tolist()
@@ -68,22 +230,23 @@ class ExcelService:
                     logger.warning(f"检测到空字段名，已替换为默认值")
                     valid_fields.append(f"未命名字段_{len(valid_fields)}")
             
-            logger.info(f"成功解析Excel文件，获取到{len(valid_fields)}个字段")
-            return valid_fields, preview_data
+            logger.info(f"成功解析Excel文件，获取到{len(valid_fields)}个字段，{len(df)}行数据")
+            return valid_fields, preview_data, len(df), cache_info
             
         except Exception as e:
             logger.error(f"解析Excel文件时出错: {str(e)}")
             raise
     
-    def get_excel_data(self, schema_id):
+    def get_excel_data(self, schema_id, columns=None):
         """
         根据schema_id获取Excel数据
         
         Args:
             schema_id: Excel schema的ID
+            columns: 只加载指定的列（见get_task_columns），为None时加载所有列
             
         Returns:
-            tuple: (DataFrame, 字段列表)
+            tuple: (DataFrame, 字段列表)，字段列表始终包含所有字段
         """
         try:
             # 获取Excel schema
@@ -95,21 +258,22 @@ class ExcelService:
             if not os.path.exists(schema.file_path):
                 raise FileNotFoundError(f"找不到文件: {schema.file_path}")
             
-            # 根据文件扩展名决定如何读取文件
-            file_ext = os.path.splitext(schema.file_path)[1].lower()
-            
-            if file_ext == '.csv':
-                # 尝试不同编码读取CSV
-                try:
-                    df = pd.read_csv(schema.file_path, encoding='utf-8', keep_default_na=True)
-                except UnicodeDecodeError:
-                    try:
-                        df = pd.read_csv(schema.file_path, encoding='gbk', keep_default_na=True)
-                    except UnicodeDecodeError:
-                        df = pd.read_csv(schema.file_path, encoding='latin1', keep_default_na=True)
-            else:  # .xlsx 或 .xls
-                # 使用keep_default_na=True确保空值被正确处理为NaN
-                df = pd.read_excel(schema.file_path, keep_default_na=True)
+            # 优先读取列式缓存，缓存不存在或原始文件已变化时重新解析并更新缓存
+            df = self._load_cache(schema, columns)
+            if df is None and PYARROW_AVAILABLE:
+                # 缓存需要包含所有列，读取完整文件后再按列筛选
+                df = self._read_file(schema.file_path)
+                cache_info = self.write_cache(df, schema.file_path)
+                if cache_info:
+                    schema.cache_path = cache_info['cache_path']
+                    schema.source_mtime = cache_info['source_mtime']
+                    schema.source_hash = cache_info['source_hash']
+                    schema.save()
+                if columns is not None:
+                    wanted = set(columns)
+                    df = df[[column for column in df.columns if str(column) in wanted]]
+            elif df is None:
+                df = self._read_file(schema.file_path, columns)
             
             # 确保字段名不包含空值
             valid_fields = []
@@ -128,6 +292,173 @@ class ExcelService:
             raise
             raise
     
+    def _read_file(self, file_path, columns=None):
+        """
+        解析原始的Excel或CSV文件
+        
+        Args:
+            file_path: 文件路径
+            columns: 只读取指定的列，为None时读取所有列
+            
+        Returns:
+            DataFrame: 文件数据
+        """
+        # 按字符串比较列名，表头为数字时与保存的字段名一致
+        usecols = None
+        if columns is not None:
+            wanted = set(columns)
+            usecols = lambda column: str(column) in wanted
+        
+        # 根据文件扩展名决定如何读取文件
+        file_ext = os.path.splitext(file_path)[1].lower()
+        
+        if file_ext == '.csv':
+            # 尝试不同编码读取CSV
+            try:
+                df = pd.read_csv(file_path, encoding='utf-8', keep_default_na=True, usecols=usecols)
+            except UnicodeDecodeError:
+                try:
+                    df = pd.read_csv(file_path, encoding='gbk', keep_default_na=True, usecols=usecols)
+                except UnicodeDecodeError:
+                    df = pd.read_csv(file_path, encoding='latin1', keep_default_na=True, usecols=usecols)
+        else:  # .xlsx 或 .xls
+            # 使用keep_default_na=True确保空值被正确处理为NaN
+            df = pd.read_excel(file_path, keep_default_na=True, usecols=usecols)
+        
+        return df
+    
+    @staticmethod
+    def _file_hash(file_path):
+        """计算文件内容的SHA-256"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def write_cache(self, df, file_path):
+        """
+        在原始文件旁写入列式缓存（未压缩的Arrow IPC文件，读取时可以内存映射）
+        
+        Args:
+            df: 原始文件解析得到的DataFrame
+            file_path: 原始文件路径
+            
+        Returns:
+            dict: 缓存文件路径及原始文件的修改时间和SHA-256，未安装pyarrow或数据无法
+                转换为Arrow格式（如同一列中混有数字和文本）时返回None
+        """
+        if not PYARROW_AVAILABLE:
+            return None
+        
+        cache_path = f"{file_path}.arrow"
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            source_mtime = os.path.getmtime(file_path)
+            source_hash = self._file_hash(file_path)
+            
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            feather.write_feather(table, temp_path, compression='uncompressed')
+            # 先写临时文件再替换，并发读取时不会读到写了一半的缓存
+            os.replace(temp_path, cache_path)
+            
+            return {
+                'cache_path': cache_path,
+                'source_mtime': source_mtime,
+                'source_hash': source_hash
+            }
+        except Exception as e:
+            logger.warning(f"生成列式缓存失败，将继续读取原始文件: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+    
+    def _load_cache(self, schema, columns=None):
+        """
+        读取Excel schema的列式缓存
+        
+        原始文件的修改时间与记录一致时直接使用缓存；修改时间变化但内容的SHA-256未变
+        （如文件被复制或touch）时更新记录的修改时间后继续使用
+        
+        Args:
+            schema: Excel schema对象
+            columns: 只读取指定的列，为None时读取所有列
+            
+        Returns:
+            DataFrame: 缓存的数据，缓存不可用或已失效时返回None
+        """
+        if not PYARROW_AVAILABLE or not schema.cache_path or not os.path.exists(schema.cache_path):
+            return None
+        
+        try:
+            source_mtime = os.path.getmtime(schema.file_path)
+            if source_mtime != schema.source_mtime:
+                if self._file_hash(schema.file_path) != schema.source_hash:
+                    logger.info(f"原始文件已变化，列式缓存失效: {schema.file_path}")
+                    return None
+                schema.source_mtime = source_mtime
+                schema.save()
+            
+            table = feather.read_table(schema.cache_path, memory_map=True)
+            if columns is not None:
+                # 缓存未压缩且内存映射，未选取的列不会被读入内存（缓存中的列名都是字符串）
+                table = table.select([column for column in columns if column in table.column_names])
+            return table.to_pandas()
+        except Exception as e:
+            logger.warning(f"读取列式缓存失败，将重新解析原始文件: {str(e)}")
+            return None
+    
+    def get_task_columns(self, schema_id, prompt_template, image_fields=None):
+        """
+        找出任务需要加载的列：提示词模板中{{字段名}}引用的字段和图片字段
+        
+        Args:
+            schema_id: Excel schema的ID
+            prompt_template: 提示词模板
+            image_fields: 图片字段列表
+            
+        Returns:
+            list: 需要加载的列名，模板和图片字段都没有引用任何字段时返回None（加载所有列）
+        """
+        _, fields = self.get_row_count(schema_id)
+        image_fields = set(image_fields or [])
+        columns = [
+            field for field in fields
+            if f"{{{{{field}}}}}" in (prompt_template or '') or field in image_fields
+        ]
+        return columns or None
+    
+    def get_row_count(self, schema_id):
+        """
+        获取Excel数据的行数和字段列表，优先使用上传时保存的行数
+        
+        旧版本上传的文件没有保存行数，此时读取一次文件并回写到excel_schemas表
+        
+        Args:
+            schema_id: Excel schema的ID
+            
+        Returns:
+            tuple: (数据行数, 字段列表)
+        """
+        schema = ExcelSchema.get_by_id(schema_id)
+        if not schema:
+            raise ValueError(f"找不到ID为{schema_id}的Excel schema")
+        
+        if schema.row_count is None:
+            df, fields = self.get_excel_data(schema_id)
+            schema.row_count = len(df)
+            schema.save()
+            return schema.row_count, fields
+        
+        # 与get_excel_data一致地处理空字段名
+        fields = []
+        for field in schema.fields:
+            if field is not None and str(field).strip() != '':
+                fields.append(str(field))
+            else:
+                fields.append(f"未命名字段_{len(fields)}")
+        return schema.row_count, fields
+    
     def save_result(self, df, result_column, result_file_path):
         """
         将处理结果保存到Excel文件
@@ -201,28 +532,83 @@ class ExcelService:
             logger.warning("收到空行数据进行模板处理")
             return template
             
-        processed_template = template
-        
         # 确保row_data是有效的字典
         if not isinstance(row_data, dict):
             logger.warning(f"行数据不是字典类型: {type(row_data)}")
             return template
+        
+        return self.compile_template(template).render(row_data)
+    
+    def render_prompts(self, template, df):
+        """
+        批量渲染整个表格的提示词（结果与逐行调用process_template一致）
+        
+        按列处理：每个被引用的字段整列转换为文本并统一处理空值，再与模板的文本片段
+        按行join，不再逐行创建行字典
+        
+        Args:
+            template: 提示词模板
+            df: 任务数据DataFrame（通常只包含模板用到的列）
             
-        # 替换所有{{字段名}}的标记
-        for field, value in row_data.items():
-            if field is None or field == "":
-                logger.warning("检测到空字段名")
-                continue
-                
-            placeholder = f"{{{{{field}}}}}"
-            
-            # 将None值、NaN值和空字符串统一处理
-            if value is None or pd.isna(value) or (isinstance(value, str) and value.strip() == ""):
-                value = ""
-            # 将数值转换为字符串
-            elif isinstance(value, (int, float)):
-                value = str(value)
+        Returns:
+            list: 按行位置排列的提示词
+        """
+        compiled = self.compile_template(template)
+        if not compiled.fields:
+            return [compiled.template] * len(df)
+        
+        # 列名统一为字符串，重复的列名以后面的列为准
+        positions = {str(name): position for position, name in enumerate(df.columns)}
+        column_text = {}
+        
+        # 文本片段用repeat表示，字段用整列文本，逐行只做一次join
+        segments = [itertools.repeat(compiled.literals[0])]
+        for field, literal in zip(compiled.fields, compiled.literals[1:]):
+            if field in positions:
+                if field not in column_text:
+                    column_text[field] = _format_column(df.iloc[:, positions[field]])
+                segments.append(column_text[field])
+            else:
+                segments.append(itertools.repeat(f"{{{{{field}}}}}"))
+            segments.append(itertools.repeat(literal))
+        
+        if not column_text:
+            # 模板引用的字段都不在数据中，提示词与行无关
+            return [''.join(next(segment) for segment in segments)] * len(df)
+        return [''.join(parts) for parts in zip(*segments)]
+    
+    def compile_template(self, template):
+        """
+        获取预编译的提示词模板，同一个模板只编译一次
+        
+        Args:
+            template: 提示词模板
             
-            processed_template = processed_template.replace(placeholder, str(value))
+        Returns:
+            CompiledTemplate: 预编译的模板
+        """
+        compiled = self._compiled_templates.get(template)
+        if compiled is None:
+            compiled = CompiledTemplate(template)
+            with self._lock:
+                # 只缓存最近使用的模板
+                if len(self._compiled_templates) >= 64:
+                    self._compiled_templates.pop(next(iter(self._compiled_templates)))
+                self._compiled_templates[template] = compiled
+        return compiled
+    
+    def validate_template(self, template, fields):
+        """
+        检查提示词模板中的字段标记是否都存在于Excel字段中
         
-        return processed_template
\ No newline at end of file
+        Args:
+            template: 提示词模板
+            fields: Excel字段列表
+            
+        Raises:
+            TemplateError: 模板引用了不存在的字段
+        """
+        known = set(fields)
+        unknown = [field for field in self.compile_template(template).fields if field not in known]
+        if unknown:
+            raise TemplateError(unknown)
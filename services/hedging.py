@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class HedgePolicy:
+    """对冲请求策略（按API配置统计）
+
+    记录每个配置最近的首字节延迟（流式）或响应延迟（非流式），请求超过其中的指定百分位数
+    仍未收到首字节或响应时，再发送一个相同的请求（对冲请求），先返回的一方胜出，另一方被取消。
+    对冲请求数不超过请求数的max_rate，样本不足min_samples个时不对冲。
+    """
+
+    def __init__(self, percentile=95, max_rate=0.05, min_samples=20, min_delay=1.0, window=200):
+        """
+        初始化对冲策略
+
+        Args:
+            percentile: 对冲延迟取最近延迟的百分位数
+            max_rate: 对冲请求数占请求数的比例上限
+            min_samples: 至少有多少个延迟样本后才开始对冲
+            min_delay: 对冲延迟的下限（秒）
+            window: 每个配置保留的最近延迟样本数
+        """
+        self.percentile = min(100, max(1, percentile))
+        self.max_rate = max(0.0, max_rate)
+        self.min_samples = max(1, int(min_samples))
+        self.min_delay = min_delay
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._requests = defaultdict(int)    # 配置ID -> 启用对冲后的请求数
+        self._hedged = defaultdict(int)      # 配置ID -> 发出的对冲请求数
+        self._hedge_wins = defaultdict(int)  # 配置ID -> 对冲请求先返回的次数
+
+    def record_latency(self, config_id, latency):
+        """
+        记录一个首字节（流式）或响应（非流式）延迟样本
+
+        Args:
+            config_id: API配置ID
+            latency: 延迟（秒）
+        """
+        with self._lock:
+            self._samples[config_id].append(latency)
+
+    def hedge_delay(self, config_id):
+        """
+        获取配置当前的对冲延迟
+
+        Args:
+            config_id: API配置ID
+
+        Returns:
+            float: 请求发出后等待多少秒再发送对冲请求，样本不足时返回None
+        """
+        with self._lock:
+            return self._hedge_delay(config_id)
+
+    def _hedge_delay(self, config_id):
+        samples = self._samples.get(config_id)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def record_request(self, config_id):
+        """记录一次启用了对冲的请求"""
+        with self._lock:
+            self._requests[config_id] += 1
+
+    def try_hedge(self, config_id):
+        """
+        在对冲比例上限内申请发送一个对冲请求
+
+        Args:
+            config_id: 原请求的API配置ID
+
+        Returns:
+            bool: 是否可以发送
+        """
+        with self._lock:
+            if self._hedged[config_id] + 1 > self._requests[config_id] * self.max_rate:
+                return False
+            self._hedged[config_id] += 1
+            return True
+
+    def record_hedge_win(self, config_id):
+        """记录一次对冲请求先于原请求返回"""
+        with self._lock:
+            self._hedge_wins[config_id] += 1
+
+    def snapshot(self, config_id):
+        """
+        获取配置的对冲统计
+
+        Returns:
+            dict: 请求数、对冲请求数、对冲请求胜出次数、对冲比例及当前对冲延迟，没有请求时返回None
+        """
+        with self._lock:
+            requests = self._requests.get(config_id, 0)
+            if not requests:
+                return None
+            delay = self._hedge_delay(config_id)
+            return {
+                'requests': requests,
+                'hedged': self._hedged.get(config_id, 0),
+                'hedge_wins': self._hedge_wins.get(config_id, 0),
+                'hedge_rate': round(self._hedged.get(config_id, 0) / requests, 4),
+                'hedge_delay': round(delay, 3) if delay is not None else None
+            }
+
+
+class HedgeAttempt:
+    """一次可以被取消的请求尝试"""
+
+    def __init__(self, config):
+        self.config = config
+        self.started = time.monotonic()
+        self.first_byte = concurrent.futures.Future()  # 收到首字节或请求结束时完成，结果为延迟
+        self.cancel_event = threading.Event()          # 设置后流式请求停止读取并关闭连接
+        self.future = None                             # 请求本身的Future（线程）或Task（asyncio）
+
+    def bind(self, future):
+        """关联执行请求的Future或Task，请求结束时视为收到首字节"""
+        self.future = future
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.mark_first_byte()
+        # 读取异常，避免被取消的asyncio Task报告"exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+    def mark_first_byte(self):
+        """收到首字节（或请求结束）时调用"""
+        try:
+            self.first_byte.set_result(time.monotonic() - self.started)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def failed(self):
+        """请求是否已经失败结束"""
+        return self.future.done() and (self.future.cancelled() or self.future.exception() is not None)
+
+    def usage(self):
+        """
+        请求结束后实际消耗的token数
+
+        Returns:
+            tuple: (token数量, 输出token数量)，请求失败或被取消时为(0, None)
+        """
+        if self.failed():
+            return 0, None
+        result = self.future.result()
+        return result[1], result[2]
+
+    def cancel(self):
+        """取消请求：asyncio请求和流式请求随即关闭连接，线程中的非流式请求在后台完成后丢弃结果"""
+        self.cancel_event.set()
+        self.future.cancel()
+
+
+def pick_first(attempts):
+    """
+    等待最先收到首字节（或响应）的请求尝试
+
+    先结束但失败的尝试不算胜出，继续等待其余尝试；全部失败时返回最后结束的尝试。
+
+    Args:
+        attempts: HedgeAttempt列表
+
+    Returns:
+        HedgeAttempt: 胜出的尝试
+    """
+    pending = {attempt.first_byte: attempt for attempt in attempts}
+    while True:
+        done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+        for first_byte in done:
+            attempt = pending.pop(first_byte)
+            if not attempt.failed() or not pending:
+                return attempt
+
+
+async def pick_first_async(attempts):
+    """pick_first的协程版本（asyncio执行引擎使用）"""
+    pending = {asyncio.wrap_future(attempt.first_byte): attempt for attempt in attempts}
+    while True:
+        done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+        for first_byte in done:
+            attempt = pending.pop(first_byte)
+            if not attempt.failed() or not pending:
+                for waiter in pending:
+                    waiter.cancel()
+                return attempt
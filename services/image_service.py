@@ -4,7 +4,9 @@
 import os
 import io
 import time
+import asyncio
 import base64
+import httpx
 import requests
 from PIL import Image
 import logging
@@ -209,6 +211,25 @@ class ImageService:
             return []
         
         # 提取图片URL
+        image_urls = self._extract_image_urls(row_data, image_fields)
+        
+        # 下载并转换图片
+        if image_urls:
+            return self.download_multiple_images(image_urls)
+        
+        return []
+    
+    def _extract_image_urls(self, row_data, image_fields):
+        """
+        从行数据中提取图片URL列表
+        
+        Args:
+            row_data: 行数据字典
+            image_fields: 图片字段列表
+            
+        Returns:
+            list: 图片URL列表（缺失的字段为None）
+        """
         image_urls = []
         for field in image_fields:
             if field in row_data:
@@ -219,9 +240,86 @@ class ImageService:
                     image_urls.append(None)
             else:
                 image_urls.append(None)
+        return image_urls
+    
+    async def extract_image_data_from_row_async(self, row_data, image_fields, http_client):
+        """
+        从行数据中提取图片URL并异步下载转换，供asyncio执行引擎使用
         
-        # 下载并转换图片
-        if image_urls:
-            return self.download_multiple_images(image_urls)
+        Args:
+            row_data: 行数据字典
+            image_fields: 图片字段列表
+            http_client: httpx.AsyncClient实例
+            
+        Returns:
+            list: base64编码的图片数据列表
+        """
+        if not image_fields:
+            return []
+        
+        image_urls = self._extract_image_urls(row_data, image_fields)
+        result = []
+        errors = []
+        
+        for i, url in enumerate(image_urls):
+            try:
+                if not url:
+                    result.append(None)
+                    continue
+                
+                result.append(await self.download_image_to_base64_async(url, http_client))
+                
+                # 避免频繁请求
+                if i < len(image_urls) - 1:
+                    await asyncio.sleep(0.5)
+                    
+            except Exception as e:
+                logger.error(f"处理图片 {url} 时出错: {str(e)}")
+                errors.append(f"图片 {url}: {str(e)}")
+                result.append(None)
+        
+        if errors:
+            logger.warning(f"有 {len(errors)} 个图片处理失败: {errors}")
+        
+        return result
+    
+    async def download_image_to_base64_async(self, image_url, http_client):
+        """
+        异步下载图片并转换为base64编码
+        
+        Args:
+            image_url: 图片URL
+            http_client: httpx.AsyncClient实例
+            
+        Returns:
+            str: base64编码的图片数据
+        """
+        if image_url.startswith('data:image'):
+            if ',' in image_url:
+                return image_url.split(',', 1)[1]
+            return image_url
+        
+        headers = {
+            'User-Agent': self.user_agent,
+            'Accept': 'image/webp,image/*,*/*;q=0.8',
+            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+            'Referer': image_url
+        }
+        
+        try:
+            response = await http_client.get(image_url, headers=headers, timeout=self.download_timeout)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"下载图片时出错: {str(e)}")
+            raise ValueError(f"图片下载失败: {str(e)}")
+        
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            raise ValueError(f"不是有效的图片内容类型: {content_type}")
+        
+        if len(response.content) > self.max_size:
+            raise ValueError(f"图片太大: {len(response.content)} 字节, 最大允许 {self.max_size} 字节")
         
-        return []
\ No newline at end of file
+        # 图片压缩是CPU密集操作，放到线程池中执行，避免阻塞事件循环
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.optimize_image, response.content)
\ No newline at end of file
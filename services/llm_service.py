@@ -3,17 +3,30 @@
 
 import json
 import time
+import asyncio
+import concurrent.futures
 import base64
 import requests
+import httpx
 import logging
 import sys
 import platform
 from flask import current_app
 from database.models import APIConfig
+from services.concurrency_controller import (
+    AdaptiveConcurrencyRegistry, OUTCOME_SUCCESS, OUTCOME_RATE_LIMIT,
+    OUTCOME_TIMEOUT, OUTCOME_SERVER_ERROR, OUTCOME_ERROR
+)
+from services.rate_limiter import RateLimiterRegistry
+from services.response_cache import ResponseCache, response_cache_key
+from services.api_pool import ConfigHealthRegistry
+from services.hedging import HedgePolicy, HedgeAttempt, pick_first, pick_first_async
+from services.scheduler import SlotCancelled
+from services.tokenizer import Tokenizer
 
 # 导入OpenAI客户端库
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
     OPENAI_CLIENT_AVAILABLE = True
 except ImportError:
     OPENAI_CLIENT_AVAILABLE = False
@@ -21,6 +34,12 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# 批处理中每个请求调用的接口
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+# 每个请求附带的系统消息
+SYSTEM_PROMPT = "You are a helpful assistant."
+
 class LLMService:
     """大语言模型API调用服务 - 重构版"""
     
@@ -28,13 +47,60 @@ class LLMService:
         """初始化LLM服务"""
         # 添加调试模式标志，从应用配置中获取
         self.debug_mode = False
+        app_config = {}
         # 初始化时尝试从应用配置获取调试模式
         try:
             from flask import current_app
             self.debug_mode = current_app.config.get('DEBUG', False)
+            app_config = current_app.config
         except:
             # 未在Flask上下文中或无法获取配置时，默认为非调试模式
             pass
+        
+        # 按API配置的自适应并发控制器
+        self.adaptive_limits = AdaptiveConcurrencyRegistry(
+            initial_limit=app_config.get('ADAPTIVE_INITIAL_CONCURRENCY', 8),
+            min_limit=app_config.get('ADAPTIVE_MIN_CONCURRENCY', 1),
+            decrease_factor=app_config.get('ADAPTIVE_DECREASE_FACTOR', 0.5),
+            latency_tolerance=app_config.get('ADAPTIVE_LATENCY_TOLERANCE', 2.0)
+        )
+        
+        # 离线token计数器，用于限流预约、任务预估和流式响应缺少usage时的token数
+        self.tokenizer = Tokenizer(
+            app_config.get('TOKENIZER_ENCODING', 'cl100k_base'),
+            app_config.get('IMAGE_TOKEN_ESTIMATE', 765)
+        )
+        self._system_prompt_tokens = None
+        
+        # 按API配置的RPM/TPM令牌桶限流器
+        self.rate_limiter = RateLimiterRegistry(app_config.get('RATE_LIMIT_BURST_SECONDS', 10))
+        
+        # 按API配置的健康状况，API配置池据此移出连续失败的配置
+        self.config_health = ConfigHealthRegistry(
+            eject_failures=app_config.get('POOL_EJECT_FAILURES', 3),
+            eject_seconds=app_config.get('POOL_EJECT_SECONDS', 30)
+        )
+        
+        # 对冲请求策略（API配置启用"对冲请求"后生效）
+        self.hedging = HedgePolicy(
+            percentile=app_config.get('HEDGE_PERCENTILE', 95),
+            max_rate=app_config.get('HEDGE_MAX_RATE', 0.05),
+            min_samples=app_config.get('HEDGE_MIN_SAMPLES', 20),
+            min_delay=app_config.get('HEDGE_MIN_DELAY', 1.0)
+        )
+        # 启用对冲时请求在该线程池中发送，调用线程等待首字节或对冲延迟
+        self._hedge_executor = None
+        self._hedge_threads = app_config.get('GLOBAL_MAX_CONCURRENCY', 1000) * 2
+        
+        # 跨任务的持久化响应缓存（API配置启用"响应缓存"后生效）
+        self.response_cache = None
+        if app_config.get('RESPONSE_CACHE_PATH'):
+            self.response_cache = ResponseCache(
+                app_config['RESPONSE_CACHE_PATH'],
+                max_bytes=app_config.get('RESPONSE_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+                max_age=app_config.get('RESPONSE_CACHE_MAX_AGE', 30 * 86400),
+                busy_timeout=app_config.get('DB_BUSY_TIMEOUT', 30)
+            )
             
         # 添加配置缓存
         self._config_cache = {}          # ID为键的配置缓存
@@ -44,6 +110,9 @@ class LLMService:
         # 添加客户端连接池
         self._client_pool = {}           # 客户端连接池
         self._client_last_used = {}      # 客户端最后使用时间
+        
+        # 异步客户端连接池（按事件循环区分，异步客户端不能跨事件循环使用）
+        self._async_client_pool = {}
     
     def get_api_configs(self):
         """
@@ -67,6 +136,18 @@ class LLMService:
             raise ValueError("未找到默认API配置")
         return config
     
+    def resolve_api_config(self, config_id=None):
+        """
+        获取任务实际使用的API配置（带缓存）
+        
+        Args:
+            config_id: 配置ID，为None则返回默认配置
+            
+        Returns:
+            APIConfig: API配置对象
+        """
+        return self._get_config(config_id)
+    
     def save_api_config(self, config_data):
         """
         保存API配置
@@ -111,6 +192,28 @@ class LLMService:
             # 设置是否使用流式输出
             config.use_stream = 1 if config_data.get('use_stream') else 0
             
+            # 设置该配置的在途请求上限和自适应并发（未提交时保留原值）
+            config.max_concurrency = max(0, int(config_data.get('max_concurrency', config.max_concurrency) or 0))
+            config.adaptive_concurrency = 1 if config_data.get('adaptive_concurrency', config.adaptive_concurrency) else 0
+            
+            # 设置每分钟请求数和token数限额（未提交时保留原值）
+            config.rpm_limit = max(0, int(config_data.get('rpm_limit', config.rpm_limit) or 0))
+            config.tpm_limit = max(0, int(config_data.get('tpm_limit', config.tpm_limit) or 0))
+            
+            # 设置响应缓存及其有效期（未提交时保留原值）
+            config.cache_enabled = 1 if config_data.get('cache_enabled', config.cache_enabled) else 0
+            config.cache_ttl = max(0, int(config_data.get('cache_ttl', config.cache_ttl) or 0))
+            
+            # 设置是否对慢请求发送对冲请求（未提交时保留原值）
+            config.hedge_enabled = 1 if config_data.get('hedge_enabled', config.hedge_enabled) else 0
+            
+            # 设置在API配置池中的路由权重（未提交时保留原值）
+            config.route_weight = max(1, int(config_data.get('route_weight', config.route_weight) or 1))
+            
+            # 设置每百万输入/输出token的价格（未提交时保留原值）
+            config.input_price = max(0.0, float(config_data.get('input_price', config.input_price) or 0))
+            config.output_price = max(0.0, float(config_data.get('output_price', config.output_price) or 0))
+            
             # 保存配置
             config_id = config.save()
             
@@ -157,57 +260,79 @@ class LLMService:
             logger.error(f"删除API配置时出错: {str(e)}")
             raise
     
-    def call_api(self, prompt, image_data=None, config_id=None):
+    def call_api(self, prompt, image_data=None, config_id=None, cache_stats=None, max_attempts=None,
+                 hedge_config_id=None, lease=None, on_hedge_usage=None, stop_event=None):
         """
         统一的LLM API调用方法
         
+        API配置启用了响应缓存时先查找缓存，命中则直接返回缓存的响应（token数记为0）
+        
         Args:
             prompt: 提示词
             image_data: 图片数据（base64编码）
             config_id: API配置ID（为None则使用默认配置）
+            cache_stats: 记录响应缓存命中情况的ResponseCacheStats（可选）
+            max_attempts: 最多尝试次数，为None时使用API_RETRY_COUNT（API配置池换用其他配置重试时传1）
+            hedge_config_id: 对冲请求使用的API配置ID（为None则与原请求相同）
+            lease: 调用方占用的调度器槽位（SlotLease，可选），等待限流额度和重试间隔时归还，
+                   对冲请求通过它另外占用槽位
+            on_hedge_usage: 对冲中落后的请求结束时的回调 on_hedge_usage(token数量, 输出token数量)（可选）
+            stop_event: 任务停止事件（可选），设置后放弃等待并抛出SlotCancelled
             
         Returns:
-            tuple: (响应文本, token数量, 处理时间)
+            tuple: (响应文本, token数量, 输出token数量, 处理时间)，服务商没有返回输出token数量时为None
         """
         # 获取API配置
         try:
-            config = self._get_config(config_id)
-            
-            # 验证是否安装了OpenAI客户端库
-            if not OPENAI_CLIENT_AVAILABLE:
-                raise ImportError("OpenAI客户端库未安装，请使用pip install openai安装。")
-            
-            # 从配置获取重试参数
-            retry_count = current_app.config.get('API_RETRY_COUNT', 3)
-            timeout = current_app.config.get('API_REQUEST_TIMEOUT', 30)
-            retry_delay = current_app.config.get('API_RETRY_DELAY', 2)
-            
             # 开始计时
             start_time = time.time()
             
-            # 构建消息内容
-            messages = self._build_messages(prompt, image_data)
+            config, api_params, use_stream, retry_count, timeout, retry_delay = \
+                self._prepare_call(prompt, image_data, config_id)
+            if max_attempts:
+                retry_count = min(retry_count, max_attempts)
             
-            # 确定是否应该使用流式输出
-            use_stream = self._should_use_stream(config)
+            # 查找响应缓存
+            cache_key, cached = self._lookup_response_cache(config, api_params, cache_stats)
+            if cached:
+                return cached[0], 0, 0, time.time() - start_time
             
-            # 构建API请求参数
-            api_params = self._build_api_params(config, messages, use_stream)
+            # 预估本次请求的token数，用于TPM限流
+            estimated_tokens = self._estimate_request_tokens(api_params)
             
             # 尝试多次调用API
             for attempt in range(retry_count):
+                # 按API配置的RPM/TPM限额等待发送时机（等待期间归还调度器槽位）
+                reservation = self.rate_limiter.reserve(config, estimated_tokens)
+                try:
+                    if reservation and reservation.wait > 0:
+                        self._wait(reservation.wait, stop_event, lease)
+                    # 槽位在等待期间归还、或转交给了对冲中落后且仍在运行的请求时，重新获取
+                    if lease is not None and lease.slot is None:
+                        lease.acquire(stop_event)
+                except BaseException:
+                    self.rate_limiter.settle(config, reservation, 0)
+                    raise
+                
+                attempt_start = time.time()
                 try:
                     # 对于流式请求设置更长的超时时间
                     call_timeout = timeout * 2 if use_stream else timeout
                     
-                    # 使用OpenAI客户端库调用API
-                    response_text, token_count = self._call_with_client(config, api_params, call_timeout)
+                    # 使用OpenAI客户端库调用API（API配置启用对冲请求时可能同时发出对冲请求），
+                    # 每个请求结束时按其实际token数结算自己的RPM/TPM预约
+                    response_text, token_count, completion_tokens = self._call_with_hedging(
+                        config, api_params, call_timeout, reservation, hedge_config_id, lease, on_hedge_usage
+                    )
+                    self._record_outcome(config, time.time() - attempt_start, OUTCOME_SUCCESS)
+                    self._store_response_cache(cache_key, response_text, token_count)
                     
                     # 计算处理时间
                     processing_time = time.time() - start_time
-                    return response_text, token_count, processing_time
+                    return response_text, token_count, completion_tokens, processing_time
                     
                 except Exception as e:
+                    self._record_outcome(config, time.time() - attempt_start, self._classify_error(e))
                     error_type = type(e).__name__
                     error_details = str(e)
                     logger.error(f"API调用失败 (尝试 {attempt+1}/{retry_count}): [{error_type}] {error_details}")
@@ -218,11 +343,14 @@ class LLMService:
                     
                     if attempt < retry_count - 1:
                         logger.info(f"将在 {retry_delay} 秒后重试...")
-                        time.sleep(retry_delay)
+                        self._wait(retry_delay, stop_event, lease)
                     else:
                         # 最后一次尝试失败，抛出更详细的错误
                         raise
                         
+        except SlotCancelled:
+            # 等待期间任务停止，不是调用错误
+            raise
         except Exception as e:
             error_type = type(e).__name__
             error_details = str(e)
@@ -237,16 +365,397 @@ class LLMService:
             
             raise
     
+    async def call_api_async(self, prompt, image_data=None, config_id=None, cache_stats=None, max_attempts=None,
+                             hedge_config_id=None, lease=None, on_hedge_usage=None):
+        """
+        LLM API的异步调用方法，供asyncio执行引擎使用
+        
+        与call_api语义一致（相同的配置、消息构建和重试策略），
+        但使用异步客户端，等待响应时不占用线程
+        
+        Args:
+            prompt: 提示词
+            image_data: 图片数据（base64编码）
+            config_id: API配置ID（为None则使用默认配置）
+            cache_stats: 记录响应缓存命中情况的ResponseCacheStats（可选）
+            max_attempts: 最多尝试次数，为None时使用API_RETRY_COUNT（API配置池换用其他配置重试时传1）
+            hedge_config_id: 对冲请求使用的API配置ID（为None则与原请求相同）
+            lease: 调用方占用的调度器槽位（SlotLease，可选），等待限流额度和重试间隔时归还，
+                   对冲请求通过它另外占用槽位
+            on_hedge_usage: 对冲中落后的请求结束时的回调 on_hedge_usage(token数量, 输出token数量)（可选）
+            
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量, 处理时间)，服务商没有返回输出token数量时为None
+        """
+        try:
+            start_time = time.time()
+            
+            config, api_params, use_stream, retry_count, timeout, retry_delay = \
+                self._prepare_call(prompt, image_data, config_id)
+            if max_attempts:
+                retry_count = min(retry_count, max_attempts)
+            
+            # 响应缓存是同步的SQLite读写，放到线程池中执行，避免阻塞事件循环
+            loop = asyncio.get_running_loop()
+            cache_key, cached = await loop.run_in_executor(
+                None, self._lookup_response_cache, config, api_params, cache_stats
+            )
+            if cached:
+                return cached[0], 0, 0, time.time() - start_time
+            
+            estimated_tokens = self._estimate_request_tokens(api_params)
+            
+            for attempt in range(retry_count):
+                reservation = self.rate_limiter.reserve(config, estimated_tokens)
+                try:
+                    if reservation and reservation.wait > 0:
+                        await self._wait_async(reservation.wait, lease)
+                    if lease is not None and lease.slot is None:
+                        await lease.acquire_async()
+                except BaseException:
+                    self.rate_limiter.settle(config, reservation, 0)
+                    raise
+                
+                attempt_start = time.time()
+                try:
+                    call_timeout = timeout * 2 if use_stream else timeout
+                    response_text, token_count, completion_tokens = await self._call_with_hedging_async(
+                        config, api_params, call_timeout, reservation, hedge_config_id, lease, on_hedge_usage
+                    )
+                    self._record_outcome(config, time.time() - attempt_start, OUTCOME_SUCCESS)
+                    # 写入缓存不影响本次结果，不等待其完成
+                    if cache_key is not None:
+                        loop.run_in_executor(None, self._store_response_cache, cache_key, response_text, token_count)
+                    
+                    processing_time = time.time() - start_time
+                    return response_text, token_count, completion_tokens, processing_time
+                    
+                except Exception as e:
+                    self._record_outcome(config, time.time() - attempt_start, self._classify_error(e))
+                    error_type = type(e).__name__
+                    logger.error(f"异步API调用失败 (尝试 {attempt+1}/{retry_count}): [{error_type}] {str(e)}")
+                    
+                    if attempt < retry_count - 1:
+                        logger.info(f"将在 {retry_delay} 秒后重试...")
+                        await self._wait_async(retry_delay, lease)
+                    else:
+                        raise
+                        
+        except SlotCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"异步调用API时出错: [{type(e).__name__}] {str(e)}")
+            raise
+    
+    def _wait(self, seconds, stop_event=None, lease=None):
+        """
+        等待限流额度或重试间隔，等待期间归还调用方的调度器槽位（供其他请求使用），之后由调用方重新获取
+        
+        Args:
+            seconds: 等待秒数
+            stop_event: 任务停止事件（可选）
+            lease: 调用方占用的调度器槽位（SlotLease，可选）
+            
+        Raises:
+            SlotCancelled: 等待期间任务停止
+        """
+        if lease is not None:
+            lease.release()
+        if stop_event is None:
+            time.sleep(seconds)
+        elif stop_event.wait(seconds):
+            raise SlotCancelled("等待期间任务已停止")
+    
+    async def _wait_async(self, seconds, lease=None):
+        """_wait的协程版本（asyncio执行引擎停止时直接取消协程）"""
+        if lease is not None:
+            lease.release()
+        await asyncio.sleep(seconds)
+    
+    def build_request_body(self, config, prompt, image_data=None):
+        """
+        构建一次非流式请求的请求体（批处理引擎写入JSONL文件使用）
+        
+        Args:
+            config: API配置对象
+            prompt: 提示词
+            image_data: 图片数据（base64编码）
+            
+        Returns:
+            dict: 与call_api发送的请求参数相同（不含流式输出参数）
+        """
+        messages = self._build_messages(prompt, image_data)
+        params = self._build_api_params(config, messages, False)
+        params.pop('stream', None)
+        return params
+    
+    def submit_batch(self, config, lines, metadata=None):
+        """
+        上传请求文件并创建批处理（OpenAI兼容的/files和/batches接口）
+        
+        Args:
+            config: API配置对象
+            lines: 请求列表，每项包含custom_id、method、url和body
+            metadata: 附加到批处理上的元数据
+            
+        Returns:
+            dict: 服务端返回的批处理对象
+        """
+        content = ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines).encode('utf-8')
+        uploaded = self._batch_request(
+            config, 'POST', '/files',
+            data={'purpose': 'batch'},
+            files={'file': ('batch.jsonl', content, 'application/jsonl')}
+        )
+        logger.info(f"已上传批处理请求文件 {uploaded.get('id')}（{len(lines)} 个请求，{len(content)} 字节）")
+        
+        return self._batch_request(config, 'POST', '/batches', json={
+            'input_file_id': uploaded['id'],
+            'endpoint': BATCH_ENDPOINT,
+            'completion_window': current_app.config.get('BATCH_COMPLETION_WINDOW', '24h'),
+            'metadata': metadata or {}
+        })
+    
+    def get_batch(self, config, batch_id):
+        """
+        查询批处理状态
+        
+        Args:
+            config: API配置对象
+            batch_id: 批处理ID
+            
+        Returns:
+            dict: 服务端返回的批处理对象
+        """
+        return self._batch_request(config, 'GET', f'/batches/{batch_id}')
+    
+    def cancel_batch(self, config, batch_id):
+        """
+        取消批处理
+        
+        Args:
+            config: API配置对象
+            batch_id: 批处理ID
+            
+        Returns:
+            dict: 服务端返回的批处理对象
+        """
+        return self._batch_request(config, 'POST', f'/batches/{batch_id}/cancel')
+    
+    def get_batch_results(self, config, file_id):
+        """
+        下载批处理的结果文件或错误文件
+        
+        Args:
+            config: API配置对象
+            file_id: 文件ID
+            
+        Returns:
+            list: 文件中每一行解析后的字典
+        """
+        text = self._batch_request(config, 'GET', f'/files/{file_id}/content', raw=True)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    
+    def parse_batch_result(self, result):
+        """
+        解析批处理结果文件中的一行
+        
+        Args:
+            result: 结果行（包含custom_id、response和error）
+            
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)，服务商没有返回输出token数量时为None
+            
+        Raises:
+            ValueError: 该请求失败
+        """
+        error = result.get('error')
+        response = result.get('response') or {}
+        body = response.get('body') or {}
+        if error or response.get('status_code') != 200:
+            error = error or body.get('error') or {}
+            message = error.get('message') if isinstance(error, dict) else str(error)
+            raise ValueError(f"批处理请求失败 (状态码 {response.get('status_code')}): {message or body}")
+        
+        choices = body.get('choices') or []
+        if not choices:
+            raise ValueError("批处理响应中没有choices")
+        response_text = (choices[0].get('message') or {}).get('content') or ''
+        usage = body.get('usage') or {}
+        return response_text, usage.get('total_tokens') or 0, usage.get('completion_tokens')
+    
+    def _batch_request(self, config, method, path, raw=False, **kwargs):
+        """
+        调用批处理相关的REST接口
+        
+        Args:
+            config: API配置对象
+            method: HTTP方法
+            path: 相对于API基础URL的路径
+            raw: 是否返回原始文本（下载文件时使用）
+            **kwargs: 传给httpx的其他参数
+            
+        Returns:
+            dict或str: 解析后的JSON或原始文本
+        """
+        url = self._get_base_url(config).rstrip('/') + path
+        headers = {'Authorization': f'Bearer {config.api_key}'}
+        timeout = current_app.config.get('BATCH_REQUEST_TIMEOUT', 300)
+        
+        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
+            response = client.request(method, url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"批处理接口 {method} {path} 返回错误 {response.status_code}: {response.text[:500]}")
+        return response.text if raw else response.json()
+    
+    def _prepare_call(self, prompt, image_data, config_id):
+        """
+        准备一次API调用所需的配置和请求参数
+        
+        Args:
+            prompt: 提示词
+            image_data: 图片数据（base64编码）
+            config_id: API配置ID（为None则使用默认配置）
+            
+        Returns:
+            tuple: (配置, 请求参数, 是否流式, 重试次数, 超时时间, 重试间隔)
+        """
+        config = self._get_config(config_id)
+        
+        # 验证是否安装了OpenAI客户端库
+        if not OPENAI_CLIENT_AVAILABLE:
+            raise ImportError("OpenAI客户端库未安装，请使用pip install openai安装。")
+        
+        # 从配置获取重试参数
+        retry_count = current_app.config.get('API_RETRY_COUNT', 3)
+        timeout = current_app.config.get('API_REQUEST_TIMEOUT', 30)
+        retry_delay = current_app.config.get('API_RETRY_DELAY', 2)
+        
+        # 构建消息内容
+        messages = self._build_messages(prompt, image_data)
+        
+        # 确定是否应该使用流式输出
+        use_stream = self._should_use_stream(config)
+        
+        # 构建API请求参数
+        api_params = self._build_api_params(config, messages, use_stream)
+        
+        return config, api_params, use_stream, retry_count, timeout, retry_delay
+    
+    def _lookup_response_cache(self, config, api_params, cache_stats=None):
+        """
+        在响应缓存中查找本次请求
+        
+        Args:
+            config: API配置对象
+            api_params: API请求参数
+            cache_stats: 记录命中情况的ResponseCacheStats（可选）
+            
+        Returns:
+            tuple: (缓存键, 命中的(响应文本, token数))，配置未启用缓存时缓存键为None，未命中时响应为None
+        """
+        if self.response_cache is None or not config.cache_enabled:
+            return None, None
+        
+        cache_key = response_cache_key(api_params)
+        cached = self.response_cache.get(cache_key, config.cache_ttl)
+        if cache_stats is not None:
+            if cached:
+                cache_stats.record_hit(cached[0], cached[1])
+            else:
+                cache_stats.record_miss()
+        return cache_key, cached
+    
+    def _store_response_cache(self, cache_key, response_text, token_count):
+        """将成功的响应写入响应缓存（cache_key为None表示未启用缓存）"""
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response_text, token_count)
+    
+    def _estimate_request_tokens(self, api_params):
+        """
+        预估一次请求消耗的token数（提示词 + 最大输出），用于TPM限流预约
+        
+        Args:
+            api_params: API请求参数
+            
+        Returns:
+            int: 预估token数
+        """
+        prompt_tokens = self.tokenizer.count_messages(api_params.get('messages', []))
+        
+        max_tokens = api_params.get('max_tokens') or current_app.config.get('RATE_LIMIT_DEFAULT_COMPLETION_TOKENS', 500)
+        return prompt_tokens + int(max_tokens)
+    
+    def estimate_prompt_tokens(self, prompt):
+        """
+        预估一次纯文本请求的提示词token数（包括系统消息）
+        
+        Args:
+            prompt: 提示词
+            
+        Returns:
+            int: 预估token数
+        """
+        if self._system_prompt_tokens is None:
+            self._system_prompt_tokens = self.tokenizer.count(SYSTEM_PROMPT)
+        return self._system_prompt_tokens + self.tokenizer.count(prompt or '') + 8
+    
+    def _record_outcome(self, config, latency, outcome):
+        """
+        将一次调用结果反馈给自适应并发控制器和配置健康状况登记表
+        
+        Args:
+            config: API配置对象
+            latency: 本次尝试耗时（秒）
+            outcome: 结果类型
+        """
+        self.config_health.record(config.id, outcome == OUTCOME_SUCCESS)
+        if config.adaptive_concurrency:
+            self.adaptive_limits.record(config.id, latency, outcome)
+    
+    def _classify_error(self, error):
+        """
+        根据异常判断调用失败的类型
+        
+        会沿异常链向上查找原始的OpenAI异常，以获取HTTP状态码
+        
+        Args:
+            error: 异常对象
+            
+        Returns:
+            str: 结果类型（rate_limit、timeout、server_error或error）
+        """
+        current = error
+        seen = set()
+        while current is not None and id(current) not in seen:
+            seen.add(id(current))
+            status_code = getattr(current, 'status_code', None)
+            error_name = type(current).__name__.lower()
+            error_text = str(current).lower()
+            
+            if status_code == 429 or 'ratelimit' in error_name or 'http 429' in error_text or 'rate limit' in error_text:
+                return OUTCOME_RATE_LIMIT
+            if 'timeout' in error_name or 'timeout' in error_text or '超时' in error_text:
+                return OUTCOME_TIMEOUT
+            if isinstance(status_code, int) and status_code >= 500:
+                return OUTCOME_SERVER_ERROR
+            
+            current = current.__cause__ or current.__context__
+        return OUTCOME_ERROR
+    
     def _get_config(self, config_id):
         """
         获取API配置对象（带缓存）
         
         Args:
-            config_id: 配置ID，为None则返回默认配置
+            config_id: 配置ID，为None则返回默认配置；也可以直接传入APIConfig对象（远程Worker使用）
             
         Returns:
             APIConfig: API配置对象
         """
+        if isinstance(config_id, APIConfig):
+            return config_id
+        
         import time
         current_time = time.time()
         
@@ -356,7 +865,7 @@ class LLMService:
         """
         # 添加系统消息
         messages = [
-            {"role": "system", "content": "You are a helpful assistant."}
+            {"role": "system", "content": SYSTEM_PROMPT}
         ]
         
         # 根据API类型处理用户消息格式
@@ -580,7 +1089,189 @@ class LLMService:
             if key in self._client_last_used:
                 del self._client_last_used[key]
     
-    def _call_with_client(self, config, params, timeout):
+    def _call_with_hedging(self, config, api_params, timeout, reservation=None, hedge_config_id=None, lease=None,
+                           on_hedge_usage=None):
+        """
+        调用API，API配置启用了对冲请求时，超过对冲延迟仍未收到首字节（流式）或响应（非流式）
+        则再发送一个相同的请求，先返回的一方胜出，另一方被取消
+        
+        每个请求结束时（落后的一方可能在返回之后才结束）按其实际token数结算自己的RPM/TPM预约；
+        落后的一方的用量通过on_hedge_usage报告，原请求落后且仍在运行时，调用方的槽位随其转交
+        
+        Args:
+            config: API配置对象
+            api_params: API请求参数
+            timeout: 超时时间
+            reservation: 原请求的RPM/TPM预约
+            hedge_config_id: 对冲请求使用的API配置ID（为None则与原请求相同）
+            lease: 调用方占用的调度器槽位（SlotLease，可选）
+            on_hedge_usage: 落后的请求结束时的回调 on_hedge_usage(token数量, 输出token数量)（可选）
+            
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)
+        """
+        if not config.hedge_enabled:
+            try:
+                result = self._call_with_client(config, api_params, timeout)
+            except BaseException:
+                self.rate_limiter.settle(config, reservation, 0)
+                raise
+            self.rate_limiter.settle(config, reservation, result[1])
+            return result
+        
+        self.hedging.record_request(config.id)
+        delay = self.hedging.hedge_delay(config.id)
+        primary = self._start_attempt(config, api_params, timeout, reservation=reservation)
+        attempts = [primary]
+        if delay is not None:
+            done, _ = concurrent.futures.wait([primary.first_byte], timeout=delay)
+            if not done:
+                hedge = self._start_hedge(config, api_params, timeout, hedge_config_id, lease=lease)
+                if hedge is not None:
+                    attempts.append(hedge)
+        
+        winner = pick_first(attempts)
+        self._finish_hedging(config, primary, winner, attempts, lease, on_hedge_usage)
+        return winner.future.result()
+    
+    async def _call_with_hedging_async(self, config, api_params, timeout, reservation=None, hedge_config_id=None,
+                                       lease=None, on_hedge_usage=None):
+        """
+        _call_with_hedging的协程版本，被取消的一方随即关闭连接
+        
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)
+        """
+        if not config.hedge_enabled:
+            try:
+                result = await self._call_with_async_client(config, api_params, timeout)
+            except BaseException:
+                self.rate_limiter.settle(config, reservation, 0)
+                raise
+            self.rate_limiter.settle(config, reservation, result[1])
+            return result
+        
+        self.hedging.record_request(config.id)
+        delay = self.hedging.hedge_delay(config.id)
+        primary = self._start_attempt(config, api_params, timeout, use_async=True, reservation=reservation)
+        attempts = [primary]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait([asyncio.wrap_future(primary.first_byte)], timeout=delay)
+                if not done:
+                    hedge = self._start_hedge(config, api_params, timeout, hedge_config_id, use_async=True, lease=lease)
+                    if hedge is not None:
+                        attempts.append(hedge)
+            
+            winner = await pick_first_async(attempts)
+            self._finish_hedging(config, primary, winner, attempts, lease, on_hedge_usage)
+            return await winner.future
+        except asyncio.CancelledError:
+            for attempt in attempts:
+                attempt.cancel()
+            raise
+    
+    def _start_attempt(self, config, params, timeout, use_async=False, reservation=None):
+        """
+        在线程池（或当前事件循环）中发出一次请求，请求结束时按实际token数结算其RPM/TPM预约
+        
+        Returns:
+            HedgeAttempt: 请求尝试
+        """
+        attempt = HedgeAttempt(config)
+        if use_async:
+            attempt.bind(asyncio.ensure_future(
+                self._call_with_async_client(config, params, timeout, attempt.mark_first_byte)
+            ))
+        else:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._hedge_threads, thread_name_prefix='llm-hedge'
+                )
+            attempt.bind(self._hedge_executor.submit(
+                self._call_with_client, config, params, timeout, attempt.mark_first_byte, attempt.cancel_event
+            ))
+        attempt.future.add_done_callback(
+            lambda _: self.rate_limiter.settle(config, reservation, attempt.usage()[0])
+        )
+        return attempt
+    
+    def _start_hedge(self, config, api_params, timeout, hedge_config_id=None, use_async=False, lease=None):
+        """
+        在对冲比例上限、对冲配置的RPM/TPM额度和调度器槽位余量内发出对冲请求
+        
+        Returns:
+            HedgeAttempt: 对冲请求，不能发送时返回None
+        """
+        hedge_config, params = config, api_params
+        if hedge_config_id and hedge_config_id != config.id:
+            try:
+                hedge_config = self._get_config(hedge_config_id)
+                params = self._build_api_params(
+                    hedge_config, api_params['messages'], self._should_use_stream(hedge_config)
+                )
+            except Exception as e:
+                logger.warning(f"获取对冲请求的API配置 {hedge_config_id} 失败，使用原配置: {str(e)}")
+                hedge_config, params = config, api_params
+        
+        # 对冲请求同样占用RPM/TPM额度，需要等待额度时不对冲
+        reservation = self.rate_limiter.reserve(hedge_config, self._estimate_request_tokens(params))
+        if reservation and reservation.wait > 0:
+            self.rate_limiter.settle(hedge_config, reservation, 0)
+            return None
+        # 对冲请求同样占用调度器槽位，全局或对冲配置没有余量、或有请求在排队时不对冲
+        slot = None
+        if lease is not None:
+            slot = lease.try_acquire(hedge_config.id)
+            if slot is None:
+                self.rate_limiter.settle(hedge_config, reservation, 0)
+                return None
+        if not self.hedging.try_hedge(config.id):
+            if slot is not None:
+                lease.scheduler.release(slot)
+            self.rate_limiter.settle(hedge_config, reservation, 0)
+            return None
+        
+        logger.info(f"API配置 {config.id} 的请求超过对冲延迟仍未返回，使用API配置 {hedge_config.id} 发送对冲请求")
+        attempt = self._start_attempt(hedge_config, params, timeout, use_async, reservation)
+        
+        def finish(future):
+            if slot is not None:
+                lease.scheduler.release(slot)
+            # 对冲请求被取消时不反馈调用结果
+            if not attempt.cancel_event.is_set():
+                error = None if future.cancelled() else future.exception()
+                outcome = OUTCOME_SUCCESS if error is None else self._classify_error(error)
+                self._record_outcome(hedge_config, time.monotonic() - attempt.started, outcome)
+        
+        attempt.future.add_done_callback(finish)
+        return attempt
+    
+    def _finish_hedging(self, config, primary, winner, attempts, lease=None, on_hedge_usage=None):
+        """取消落后的请求（其结束后报告用量、归还槽位），记录对冲结果和延迟样本"""
+        for attempt in attempts:
+            if attempt is winner:
+                continue
+            attempt.cancel()
+            if on_hedge_usage is not None:
+                attempt.future.add_done_callback(lambda _, attempt=attempt: on_hedge_usage(*attempt.usage()))
+            if attempt is primary and lease is not None and not primary.future.done():
+                # 线程中的非流式请求不能中断，在其结束前继续占用调用方的槽位
+                lease.hand_over(primary.future)
+        
+        if winner.failed():
+            return
+        if winner is primary:
+            self.hedging.record_latency(config.id, primary.first_byte.result())
+            return
+        
+        self.hedging.record_hedge_win(config.id)
+        # 原请求被取消时记录其已等待的时间（实际延迟不低于该值），避免样本偏向快速的请求
+        self.hedging.record_latency(config.id, time.monotonic() - primary.started)
+        if winner.config.id != config.id:
+            self.hedging.record_latency(winner.config.id, winner.first_byte.result())
+    
+    def _call_with_client(self, config, params, timeout, on_first_byte=None, cancel_event=None):
         """
         使用OpenAI客户端库调用API
         
@@ -588,9 +1279,11 @@ class LLMService:
             config: API配置对象
             params: API请求参数
             timeout: 超时时间
+            on_first_byte: 收到流式响应第一个块时的回调（可选）
+            cancel_event: 设置后流式请求停止读取并关闭连接（可选）
             
         Returns:
-            tuple: (响应文本, token数量)
+            tuple: (响应文本, token数量, 输出token数量)
         """
         try:
             # 记录请求参数
@@ -602,7 +1295,7 @@ class LLMService:
             # 根据是否使用流式输出选择不同的处理方式
             if params.get("stream", False):
                 # 流式输出处理
-                return self._handle_streaming_response(client, params)
+                return self._handle_streaming_response(client, params, on_first_byte, cancel_event)
             else:
                 # 非流式输出处理
                 return self._handle_normal_response(client, params)
@@ -672,7 +1365,7 @@ class LLMService:
             params: API请求参数
             
         Returns:
-            tuple: (响应文本, token数量)
+            tuple: (响应文本, token数量, 输出token数量)
         """
         try:
             # 调用API获取响应
@@ -683,41 +1376,29 @@ class LLMService:
             
             # 获取token数量
             token_count = 0
+            completion_tokens = None
             if hasattr(response, "usage") and response.usage:
                 token_count = response.usage.total_tokens
+                completion_tokens = getattr(response.usage, 'completion_tokens', None)
             
-            return response_text, token_count
+            return response_text, token_count, completion_tokens
             
         except Exception as e:
-            error_type = type(e).__name__
-            error_details = str(e)
-            
-            # 提取错误详情
-            error_type, error_details, status_code, response_text = self._extract_error_details(e)
-                
-            logger.error(f"处理非流式响应时出错: [{error_type}] {error_details}")
-            logger.error(f"响应状态码: {status_code}, 响应内容: {response_text}")
-            
-            if "timeout" in error_details.lower():
-                raise ValueError(f"API请求超时: {error_details}")
-            elif "connection" in error_details.lower():
-                raise ValueError(f"API连接失败 [{error_type}]: {error_details} - 请检查网络连接和API基础URL")
-            elif status_code != 'N/A':
-                raise ValueError(f"API请求失败 [HTTP {status_code}]: {error_details} - {response_text}")
-            else:
-                raise ValueError(f"API调用失败 [{error_type}]: {error_details}")
+            raise self._wrap_response_error(e, stream=False)
     
     
-    def _handle_streaming_response(self, client, params):
+    def _handle_streaming_response(self, client, params, on_first_byte=None, cancel_event=None):
         """
         处理流式响应
         
         Args:
             client: OpenAI客户端
             params: API请求参数
+            on_first_byte: 收到第一个响应块时的回调（可选）
+            cancel_event: 设置后停止读取并关闭连接（可选）
             
         Returns:
-            tuple: (响应文本, token数量)
+            tuple: (响应文本, token数量, 输出token数量)
         """
         try:
             # 记录流式请求的详细信息
@@ -755,6 +1436,7 @@ class LLMService:
             # 收集所有内容（使用列表而非字符串拼接，提高效率）
             content_chunks = []
             token_count = 0
+            completion_tokens = None
             
             # 记录流式响应开始
             logger.info("开始接收流式响应...")
@@ -763,6 +1445,12 @@ class LLMService:
                 chunks_received = 0
                 for chunk in response_stream:
                     chunks_received += 1
+                    if chunks_received == 1 and on_first_byte is not None:
+                        on_first_byte()
+                    if cancel_event is not None and cancel_event.is_set():
+                        # 对冲请求中落后的一方被取消，结果会被丢弃
+                        response_stream.close()
+                        break
                     
                     # 添加详细的chunk处理日志（仅在调试模式下，降低记录频率）
                     if self.debug_mode and (chunks_received <= 2 or chunks_received % 100 == 0):
@@ -783,6 +1471,7 @@ class LLMService:
                     # 提取token使用情况（如果可用）
                     if hasattr(chunk, 'usage') and chunk.usage:
                         token_count = chunk.usage.total_tokens
+                        completion_tokens = getattr(chunk.usage, 'completion_tokens', None)
                 
                 # 一次性拼接所有内容，提高效率
                 full_content = ''.join(content_chunks)
@@ -792,7 +1481,9 @@ class LLMService:
                 
                 # 如果没有提取到token数量，则估算
                 if token_count == 0:
-                    token_count = len(full_content.split()) * 1.3  # 估算token数量
+                    # 服务商没有返回usage时，用离线token计数器估算提示词和输出的token数
+                    completion_tokens = self.tokenizer.count(full_content)
+                    token_count = self.tokenizer.count_messages(params.get('messages')) + completion_tokens
             except Exception as chunk_error:
                 # 捕获并记录处理单个chunk时的错误，但继续处理
                 error_type = type(chunk_error).__name__
@@ -813,23 +1504,179 @@ class LLMService:
                 full_content = ''.join(content_chunks)
                 logger.info(f"尽管连接中断，但成功拼接了{len(full_content)}个字符的内容")
             
-            return full_content, int(token_count)
+            return full_content, int(token_count), completion_tokens
             
         except Exception as e:
-            error_type = type(e).__name__
-            error_details = str(e)
+            raise self._wrap_response_error(e, stream=True)
+    
+    def _get_async_client(self, config, timeout):
+        """
+        获取当前事件循环对应的异步客户端
+        
+        Args:
+            config: API配置对象
+            timeout: 超时时间
             
-            # 提取错误详情
-            error_type, error_details, status_code, response_text = self._extract_error_details(e)
-                
-            logger.error(f"处理流式响应时出错: [{error_type}] {error_details}")
-            logger.error(f"响应状态码: {status_code}, 响应内容: {response_text}")
+        Returns:
+            AsyncOpenAI: 异步客户端实例
+        """
+        loop = asyncio.get_running_loop()
+        base_url = self._get_base_url(config)
+        client_key = (id(loop), base_url, config.api_key)
+        
+        client = self._async_client_pool.get(client_key)
+        if client is None:
+            client_options = {
+                "api_key": config.api_key,
+                "base_url": base_url,
+                # 重试由call_api_async统一控制
+                "max_retries": 0,
+            }
+            if timeout:
+                client_options["timeout"] = timeout * 2
+            if "dashscope" in base_url.lower() or "aliyun" in base_url.lower():
+                client_options["default_headers"] = {
+                    "User-Agent": "Python/OpenAI-Compatible-Client",
+                    "Accept": "application/json",
+                    "Content-Type": "application/json"
+                }
+            logger.info(f"创建异步客户端 - BaseURL: {base_url}, Timeout: {timeout}")
+            client = AsyncOpenAI(**client_options)
+            self._async_client_pool[client_key] = client
+        return client
+    
+    async def close_async_clients(self):
+        """
+        关闭当前事件循环创建的所有异步客户端
+        """
+        loop_id = id(asyncio.get_running_loop())
+        for key in [key for key in self._async_client_pool if key[0] == loop_id]:
+            client = self._async_client_pool.pop(key)
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"关闭异步客户端时出错: {str(e)}")
+    
+    async def _call_with_async_client(self, config, params, timeout, on_first_byte=None):
+        """
+        使用异步客户端调用API
+        
+        Args:
+            config: API配置对象
+            params: API请求参数
+            timeout: 超时时间
+            on_first_byte: 收到流式响应第一个块时的回调（可选）
             
-            if "timeout" in error_details.lower():
-                raise ValueError(f"API流式请求超时: {error_details}")
-            elif "connection" in error_details.lower():
-                raise ValueError(f"API流式连接失败 [{error_type}]: {error_details} - 请检查网络连接和API基础URL")
-            elif status_code != 'N/A':
-                raise ValueError(f"API流式请求失败 [HTTP {status_code}]: {error_details} - {response_text}")
-            else:
-                raise ValueError(f"API流式调用失败 [{error_type}]: {error_details}")
\ No newline at end of file
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)
+        """
+        client = self._get_async_client(config, timeout)
+        if params.get("stream", False):
+            return await self._handle_streaming_response_async(client, params, on_first_byte)
+        return await self._handle_normal_response_async(client, params)
+    
+    async def _handle_normal_response_async(self, client, params):
+        """
+        处理非流式响应（异步）
+        
+        Args:
+            client: AsyncOpenAI客户端
+            params: API请求参数
+            
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)
+        """
+        try:
+            response = await client.chat.completions.create(**params)
+            
+            response_text = response.choices[0].message.content
+            
+            token_count = 0
+            completion_tokens = None
+            if hasattr(response, "usage") and response.usage:
+                token_count = response.usage.total_tokens
+                completion_tokens = getattr(response.usage, 'completion_tokens', None)
+            
+            return response_text, token_count, completion_tokens
+            
+        except Exception as e:
+            raise self._wrap_response_error(e, stream=False)
+    
+    async def _handle_streaming_response_async(self, client, params, on_first_byte=None):
+        """
+        处理流式响应（异步）
+        
+        Args:
+            client: AsyncOpenAI客户端
+            params: API请求参数
+            on_first_byte: 收到第一个响应块时的回调（可选）
+            
+        Returns:
+            tuple: (响应文本, token数量, 输出token数量)
+        """
+        try:
+            response_stream = await client.chat.completions.create(**params)
+            
+            content_chunks = []
+            token_count = 0
+            completion_tokens = None
+            try:
+                async for chunk in response_stream:
+                    if on_first_byte is not None:
+                        on_first_byte()
+                        on_first_byte = None
+                    if hasattr(chunk, 'choices') and chunk.choices:
+                        choice = chunk.choices[0]
+                        if hasattr(choice, 'delta') and hasattr(choice.delta, 'content') and choice.delta.content is not None:
+                            content_chunks.append(choice.delta.content)
+                        elif hasattr(choice, 'message') and hasattr(choice.message, 'content') and choice.message.content is not None:
+                            content_chunks.append(choice.message.content)
+                    
+                    if hasattr(chunk, 'usage') and chunk.usage:
+                        token_count = chunk.usage.total_tokens
+                        completion_tokens = getattr(chunk.usage, 'completion_tokens', None)
+            except asyncio.CancelledError:
+                # 对冲请求中落后的一方被取消时关闭连接
+                await response_stream.close()
+                raise
+            except Exception as chunk_error:
+                # 与同步版本一致：连接中断时尽量返回已收集的内容
+                logger.error(f"处理异步响应块时出错: [{type(chunk_error).__name__}] {str(chunk_error)}")
+                if not content_chunks:
+                    raise
+            
+            full_content = ''.join(content_chunks)
+            if token_count == 0:
+                completion_tokens = self.tokenizer.count(full_content)
+                token_count = self.tokenizer.count_messages(params.get('messages')) + completion_tokens
+            
+            return full_content, int(token_count), completion_tokens
+            
+        except Exception as e:
+            raise self._wrap_response_error(e, stream=True)
+    
+    def _wrap_response_error(self, error, stream):
+        """
+        将API调用异常转换为带排查信息的ValueError
+        
+        Args:
+            error: 原始异常
+            stream: 是否为流式请求
+            
+        Returns:
+            ValueError: 转换后的异常
+        """
+        error_type, error_details, status_code, response_text = self._extract_error_details(error)
+        mode = "流式" if stream else ""
+        
+        logger.error(f"处理{mode}响应时出错: [{error_type}] {error_details}")
+        logger.error(f"响应状态码: {status_code}, 响应内容: {response_text}")
+        
+        if "timeout" in error_details.lower():
+            return ValueError(f"API{mode}请求超时: {error_details}")
+        elif "connection" in error_details.lower():
+            return ValueError(f"API{mode}连接失败 [{error_type}]: {error_details} - 请检查网络连接和API基础URL")
+        elif status_code != 'N/A':
+            return ValueError(f"API{mode}请求失败 [HTTP {status_code}]: {error_details} - {response_text}")
+        else:
+            return ValueError(f"API{mode}调用失败 [{error_type}]: {error_details}")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import logging
+import threading
+from flask import g
+from database.db import get_db_connection
+from database.models import TaskLog
+
+logger = logging.getLogger(__name__)
+
+
+class TaskLogWriter:
+    """后台批量写入任务日志
+
+    处理线程和协程只把日志放入队列，由进程内唯一的写入线程用一个数据库连接
+    以executemany批量插入，每批一次提交。一批最多包含batch_size条日志，
+    第一条日志入队后最多等待max_latency秒就会写入。
+
+    顺序：单个写入线程按入队顺序写入，同一任务的日志在task_logs中的id顺序与入队顺序一致。
+    持久性：日志在所在批次提交后才写入数据库，进程崩溃时最多丢失尚未提交的一批；
+    续跑和重试以成功日志为准，丢失日志的行会被重新处理（至少处理一次）。
+    任务完成、停止或批次结束前调用flush()，保证此前入队的日志都已提交。
+    """
+
+    def __init__(self, app, batch_size=200, max_latency=0.5):
+        """
+        初始化日志写入器
+
+        Args:
+            app: Flask应用实例（写入线程在其应用上下文中使用独立的数据库连接）
+            batch_size: 每批最多写入的日志条数
+            max_latency: 日志入队后最多等待多少秒写入
+        """
+        self.app = app
+        self.batch_size = max(1, int(batch_size))
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, log):
+        """
+        将日志放入写入队列（不阻塞，可以在事件循环中调用）
+
+        Args:
+            log: 任务日志对象
+        """
+        self._ensure_thread()
+        self._queue.put(log)
+
+    def flush(self, timeout=None):
+        """
+        等待此前入队的日志全部提交
+
+        Args:
+            timeout: 最长等待秒数，None表示一直等待
+
+        Returns:
+            bool: 是否在超时前完成
+        """
+        if self._thread is None:
+            return True
+        self._ensure_thread()
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def _ensure_thread(self):
+        """首次写入时启动写入线程，写入线程意外退出时重新启动（队列中的日志和flush标记由新线程处理）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    logger.error("任务日志写入线程已退出，重新启动")
+                self._thread = threading.Thread(target=self._run, name='task-log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """写入线程：攒批后写入，遇到flush标记时立即写入当前批次"""
+        with self.app.app_context():
+            while True:
+                item = self._queue.get()
+                batch = []
+                markers = []
+                deadline = time.monotonic() + self.max_latency
+
+                while True:
+                    if isinstance(item, threading.Event):
+                        markers.append(item)
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+
+                # 写入失败不能让写入线程退出，否则之后的日志不再写入，flush()也会一直等待
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f"写入 {len(batch)} 条任务日志失败: {str(e)}")
+                finally:
+                    for marker in markers:
+                        marker.set()
+
+    def _write_batch(self, batch):
+        """批量写入，整批失败时逐条重试，避免一条坏数据导致整批丢失"""
+        if not batch:
+            return
+        try:
+            TaskLog.save_many(batch)
+            return
+        except Exception as e:
+            logger.error(f"批量写入 {len(batch)} 条任务日志失败，改为逐条写入: {str(e)}")
+            self._rollback()
+
+        for log in batch:
+            try:
+                log.save()
+            except Exception as e:
+                logger.error(f"写入任务 {log.task_id} 行 {log.row_index} 的日志失败: {str(e)}")
+
+    def _rollback(self):
+        """回滚写入线程的数据库连接，连接已不可用时关闭，下次写入时重新连接"""
+        try:
+            get_db_connection().rollback()
+        except Exception as e:
+            logger.error(f"回滚任务日志写入失败，重新连接数据库: {str(e)}")
+            db = g.pop('_database', None)
+            if db is not None:
+                try:
+                    db.close()
+                except Exception:
+                    pass
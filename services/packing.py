@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PACK_PROMPT = """请对下面JSON数组中的每一条数据分别完成以下任务，任务中的{{{{字段名}}}}表示该条数据中对应字段的值，各条数据相互独立。
+
+任务：
+{template}
+
+数据：
+{records}
+
+请只返回一个JSON数组，每条数据对应数组中的一个元素，格式为{{"id": 该条数据的id, "result": 该条数据的处理结果（字符串）}}，不要返回其他内容。"""
+
+# 模型有时会把JSON包在```json代码块中
+_CODE_FENCE = re.compile(r'^```[a-zA-Z]*\s*|\s*```$')
+
+
+def build_pack_prompt(template, records):
+    """
+    把多行合并为一个请求的提示词：模板只出现一次，各行以JSON数组给出模板引用的字段值
+
+    Args:
+        template: 提示词模板
+        records: [(行索引, 字段值字典)]，行索引作为数据的id
+
+    Returns:
+        str: 合并后的提示词
+    """
+    data = [dict({'id': row_index}, **values) for row_index, values in records]
+    return PACK_PROMPT.format(template=template, records=json.dumps(data, ensure_ascii=False, indent=1))
+
+
+def parse_pack_response(response_text, row_indexes):
+    """
+    把合并请求的响应拆分回各行的结果
+
+    Args:
+        response_text: 模型返回的文本
+        row_indexes: 该请求包含的行索引
+
+    Returns:
+        dict: 行索引 -> 结果文本，只包含响应中找到的行
+
+    Raises:
+        ValueError: 响应不是符合约定的JSON数组
+    """
+    text = _CODE_FENCE.sub('', (response_text or '').strip())
+    start, end = text.find('['), text.rfind(']')
+    if start < 0 or end < start:
+        raise ValueError("合并请求的响应中没有JSON数组")
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"合并请求的响应无法解析为JSON: {str(e)}")
+    if not isinstance(items, list):
+        raise ValueError("合并请求的响应不是JSON数组")
+
+    expected = set(row_indexes)
+    results = {}
+    for item in items:
+        if not isinstance(item, dict) or 'id' not in item or 'result' not in item:
+            continue
+        try:
+            row_index = int(item['id'])
+        except (TypeError, ValueError):
+            continue
+        if row_index not in expected or row_index in results:
+            continue
+        result = item['result']
+        results[row_index] = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+    return results
+
+
+class PackStats:
+    """一个任务的多行合并请求统计（线程安全）
+
+    逐行请求并没有实际发生，其token数按预估换算：每行单独请求的预估提示词token数（任务开始时计算一次），
+    加上该行在合并请求中分摊的输出token数（服务商返回的实际值，没有返回时为合并请求的实际token数减去其预估提示词token数）。
+    模板很短时合并请求增加的说明文字可能多于节省的部分，此时节省比例为负数。
+    """
+
+    def __init__(self, pack_size, row_prompt_tokens):
+        """
+        初始化合并请求统计
+
+        Args:
+            pack_size: 每个合并请求包含的行数
+            row_prompt_tokens: 行索引 -> 该行单独请求时的预估提示词token数
+        """
+        self.pack_size = pack_size
+        self.row_prompt_tokens = row_prompt_tokens
+        self.packs = 0             # 发出的合并请求数
+        self.packed_rows = 0       # 从合并请求中拆分出结果的行数
+        self.fallback_rows = 0     # 回退为逐行请求的行数
+        self.pack_tokens = 0       # 合并请求的实际token数
+        self.unpacked_tokens = 0   # 这些行逐行请求时的预估token数
+        self._lock = threading.Lock()
+
+    def record_pack(self, row_indexes, packed, token_count, completion_tokens):
+        """
+        记录一个合并请求的结果
+
+        Args:
+            row_indexes: 合并请求包含的行索引
+            packed: 从响应中拆分出结果的行索引（其余行回退为逐行请求）
+            token_count: 合并请求的实际token数
+            completion_tokens: 合并请求的输出token数
+        """
+        single_prompt_tokens = sum(self.row_prompt_tokens.get(row_index, 0) for row_index in packed)
+        completion_tokens = max(0, completion_tokens)
+        with self._lock:
+            self.packs += 1
+            self.packed_rows += len(packed)
+            self.fallback_rows += len(row_indexes) - len(packed)
+            self.pack_tokens += token_count
+            self.unpacked_tokens += single_prompt_tokens + completion_tokens * len(packed) // max(1, len(row_indexes))
+
+    def snapshot(self):
+        """
+        获取合并请求统计
+
+        Returns:
+            dict: 合并请求数、合并/回退的行数、每行实际token数、逐行请求时的预估每行token数及节省比例
+        """
+        with self._lock:
+            stats = {
+                'pack_size': self.pack_size,
+                'packs': self.packs,
+                'packed_rows': self.packed_rows,
+                'fallback_rows': self.fallback_rows
+            }
+            if self.packed_rows:
+                stats['tokens_per_row'] = round(self.pack_tokens / self.packed_rows, 1)
+                stats['unpacked_tokens_per_row'] = round(self.unpacked_tokens / self.packed_rows, 1)
+                if self.unpacked_tokens:
+                    stats['token_saving'] = round(1 - self.pack_tokens / self.unpacked_tokens, 4)
+            return stats
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from database.models import Task
+
+logger = logging.getLogger(__name__)
+
+
+class TaskProgress:
+    """任务进度计数器
+
+    每完成一行只在内存中累加计数（同步到Task对象的计数字段），按时间间隔或累计行数
+    合并写入tasks表，写入时只更新三个计数列。任务结束或停止时调用flush()写入最终进度。
+    运行中的任务状态直接读取snapshot()，不依赖数据库中的计数。
+    """
+
+    def __init__(self, task, flush_interval=1.0, flush_rows=100):
+        """
+        初始化进度计数器
+
+        Args:
+            task: 任务对象，计数从其当前的进度开始（续跑时不为0）
+            flush_interval: 两次写入数据库之间的最短间隔（秒）
+            flush_rows: 累计完成多少行后立即写入
+        """
+        self.task = task
+        self.flush_interval = flush_interval
+        self.flush_rows = max(1, int(flush_rows))
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        # 保证写入按计数的先后顺序进行，避免较旧的计数覆盖较新的计数
+        self._flush_lock = threading.Lock()
+
+    def record(self, is_success):
+        """
+        记录一行的处理结果，达到写入间隔或行数阈值时写入数据库
+
+        Args:
+            is_success: 该行是否处理成功
+        """
+        with self._lock:
+            self.task.processed_count += 1
+            if is_success:
+                self.task.success_count += 1
+            else:
+                self.task.error_count += 1
+            self._unflushed += 1
+            due = (self._unflushed >= self.flush_rows or
+                   time.monotonic() - self._last_flush >= self.flush_interval)
+
+        if due:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"更新任务 {self.task.id} 进度时出错: {str(e)}")
+
+    def flush(self):
+        """将尚未写入的进度写入数据库"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._unflushed:
+                    return
+                counts = (self.task.processed_count, self.task.success_count, self.task.error_count)
+                self._unflushed = 0
+                self._last_flush = time.monotonic()
+            Task.update_progress(self.task.id, *counts)
+
+    def snapshot(self):
+        """
+        获取当前的进度计数
+
+        Returns:
+            dict: processed_count、success_count和error_count
+        """
+        with self._lock:
+            return {
+                'processed_count': self.task.processed_count,
+                'success_count': self.task.success_count,
+                'error_count': self.task.error_count
+            }
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """预约式令牌桶
+
+    reserve()立即扣除令牌并返回需要等待的秒数，余额允许为负（即"预支"），
+    后来的调用方会按顺序排在前面的预支之后，因此线程和协程都能公平地共享同一个桶，
+    而不需要在锁内等待。
+    """
+
+    def __init__(self, rate_per_minute, burst_seconds=10):
+        """
+        初始化令牌桶
+
+        Args:
+            rate_per_minute: 每分钟补充的令牌数
+            burst_seconds: 桶容量相当于多少秒的补充量（允许的突发量）
+        """
+        self.rate_per_minute = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate_per_second * burst_seconds)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """按流逝的时间补充令牌（在锁内调用）"""
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+            self._updated = now
+
+    def reserve(self, amount):
+        """
+        预约令牌
+
+        Args:
+            amount: 需要的令牌数
+
+        Returns:
+            float: 需要等待的秒数（0表示可以立即发送）
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate_per_second
+
+    def adjust(self, delta):
+        """
+        修正已预约的令牌数（实际用量与预估不同时调用）
+
+        Args:
+            delta: 需要额外扣除的令牌数，负数表示退还
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+    def available(self):
+        """当前可用令牌数（可能为负）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+class RateLimitReservation:
+    """一次请求的限流预约，用于在收到响应后修正token用量"""
+
+    def __init__(self, config_id, estimated_tokens, wait):
+        self.config_id = config_id
+        self.estimated_tokens = estimated_tokens
+        self.wait = wait
+
+
+class RateLimiterRegistry:
+    """按API配置管理RPM/TPM令牌桶
+
+    进程内所有任务、所有工作线程和事件循环共享同一组令牌桶。
+    """
+
+    def __init__(self, burst_seconds=10):
+        """
+        初始化限流器注册表
+
+        Args:
+            burst_seconds: 令牌桶容量相当于多少秒的补充量
+        """
+        self.burst_seconds = burst_seconds
+        self._buckets = {}   # API配置ID -> (rpm, tpm, RPM桶, TPM桶)
+        self._stats = {}     # API配置ID -> 统计信息
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, config):
+        """获取配置对应的令牌桶，限额变化时重新创建"""
+        rpm = int(config.rpm_limit or 0)
+        tpm = int(config.tpm_limit or 0)
+        with self._lock:
+            entry = self._buckets.get(config.id)
+            if entry is None or entry[0] != rpm or entry[1] != tpm:
+                entry = (
+                    rpm, tpm,
+                    TokenBucket(rpm, self.burst_seconds) if rpm > 0 else None,
+                    TokenBucket(tpm, self.burst_seconds) if tpm > 0 else None
+                )
+                self._buckets[config.id] = entry
+                self._stats.setdefault(config.id, {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0})
+            return entry
+
+    def reserve(self, config, estimated_tokens):
+        """
+        为一次请求预约RPM和TPM额度
+
+        Args:
+            config: API配置对象
+            estimated_tokens: 预估的token数（提示词+最大输出）
+
+        Returns:
+            RateLimitReservation: 预约结果，wait为发送前需要等待的秒数；
+            配置未设置限额时返回None
+        """
+        _, _, rpm_bucket, tpm_bucket = self._get_buckets(config)
+        if rpm_bucket is None and tpm_bucket is None:
+            return None
+
+        wait = 0.0
+        if rpm_bucket is not None:
+            wait = max(wait, rpm_bucket.reserve(1))
+        if tpm_bucket is not None:
+            wait = max(wait, tpm_bucket.reserve(estimated_tokens))
+
+        with self._lock:
+            stats = self._stats[config.id]
+            stats['requests'] += 1
+            if wait > 0:
+                stats['throttled'] += 1
+                stats['wait_seconds'] += wait
+
+        if wait > 0:
+            logger.info(f"API配置 {config.id} 触发限流，等待 {wait:.2f} 秒后发送")
+        return RateLimitReservation(config.id, estimated_tokens, wait)
+
+    def settle(self, config, reservation, actual_tokens):
+        """
+        用实际token用量修正预约
+
+        Args:
+            config: API配置对象
+            reservation: reserve返回的预约
+            actual_tokens: 实际使用的token数（请求失败时传0，退还预估额度）
+        """
+        if reservation is None:
+            return
+        _, _, _, tpm_bucket = self._get_buckets(config)
+        if tpm_bucket is not None:
+            tpm_bucket.adjust((actual_tokens or 0) - reservation.estimated_tokens)
+
+    def snapshot(self, config):
+        """
+        获取配置的限流状态
+
+        Args:
+            config: API配置对象
+
+        Returns:
+            dict: 限额、当前可用额度和限流统计，未设置限额时返回None
+        """
+        rpm, tpm, rpm_bucket, tpm_bucket = self._get_buckets(config)
+        if rpm_bucket is None and tpm_bucket is None:
+            return None
+        with self._lock:
+            stats = dict(self._stats.get(config.id, {}))
+        stats['wait_seconds'] = round(stats.get('wait_seconds', 0.0), 2)
+        return {
+            'rpm_limit': rpm,
+            'tpm_limit': tpm,
+            'rpm_available': round(rpm_bucket.available(), 2) if rpm_bucket else None,
+            'tpm_available': round(tpm_bucket.available(), 2) if tpm_bucket else None,
+            **stats
+        }
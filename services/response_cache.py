@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 不影响响应内容的请求参数，不参与计算缓存键
+_IGNORED_PARAMS = ('stream', 'stream_options')
+
+
+def response_cache_key(api_params):
+    """
+    计算一次API请求的缓存键
+
+    缓存键由模型、其他参数和消息内容决定，消息中的图片以内容的SHA-256代替，
+    流式输出相关的参数不参与计算。
+
+    Args:
+        api_params: _build_api_params构建的API请求参数
+
+    Returns:
+        str: 请求内容的SHA-256
+    """
+    params = {key: value for key, value in api_params.items() if key not in _IGNORED_PARAMS}
+    messages = []
+    for message in params.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                url = (part.get('image_url') or {}).get('url') if part.get('type') == 'image_url' else None
+                if url:
+                    part = {'type': 'image_url', 'image_sha256': hashlib.sha256(url.encode('utf-8')).hexdigest()}
+                parts.append(part)
+            message = dict(message, content=parts)
+        messages.append(message)
+    params['messages'] = messages
+    payload = json.dumps(params, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCacheStats:
+    """一个任务的响应缓存命中统计（线程安全）"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0   # 命中时未重新下载的响应字节数
+        self.tokens_saved = 0  # 命中时节省的token数
+        self._lock = threading.Lock()
+
+    def record_hit(self, response_text, token_count):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += len((response_text or '').encode('utf-8'))
+            self.tokens_saved += token_count or 0
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def snapshot(self):
+        """
+        获取命中统计
+
+        Returns:
+            dict: 命中数、未命中数、节省的字节数和token数
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'tokens_saved': self.tokens_saved
+            }
+
+
+class ResponseCache:
+    """跨任务的持久化LLM响应缓存
+
+    响应保存在独立的SQLite文件中（不占用业务数据库的写锁），多个进程可以共用同一个文件。
+    缓存总大小超过max_bytes时按最近使用时间（LRU）淘汰，超过max_age秒未被使用的条目
+    定期清理；API配置的cache_ttl限制单个条目自写入起的有效期。
+    命中时只在内存中记录使用时间，随下一次写入或每隔TOUCH_FLUSH_INTERVAL秒批量更新，
+    进程退出时尚未写入的使用时间会丢失（只影响淘汰顺序）。
+    只缓存成功的响应。每个任务的命中统计也保存在该文件中，任务结束后仍可查询。
+    """
+
+    # 定期清理过期条目的间隔（秒）
+    PURGE_INTERVAL = 60
+    # 批量写入命中条目使用时间的间隔（秒）
+    TOUCH_FLUSH_INTERVAL = 5
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_age=30 * 86400, busy_timeout=30):
+        """
+        初始化响应缓存（首次使用时才创建文件）
+
+        Args:
+            path: 缓存数据库文件路径
+            max_bytes: 缓存的最大总字节数，0表示不限制
+            max_age: 条目最久多少秒未使用后被清理，0表示不限制
+            busy_timeout: 等待其他进程释放写锁的秒数
+        """
+        self.path = path
+        self.max_bytes = max_bytes or 0
+        self.max_age = max_age or 0
+        self.busy_timeout = busy_timeout
+        self._conn = None
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._last_purge = 0
+        self._touches = {}  # 命中后尚未写入的使用时间：缓存键 -> 时间
+        self._last_touch_flush = time.time()
+
+    def _connection(self):
+        """获取（必要时创建）缓存数据库连接，调用方需持有self._lock"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response_text TEXT,
+                token_count INTEGER DEFAULT 0,
+                size INTEGER DEFAULT 0,
+                created_at REAL,
+                last_used_at REAL
+            )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used_at)")
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_stats (
+                task_id INTEGER PRIMARY KEY,
+                hits INTEGER DEFAULT 0,
+                misses INTEGER DEFAULT 0,
+                bytes_saved INTEGER DEFAULT 0,
+                tokens_saved INTEGER DEFAULT 0
+            )
+            ''')
+            conn.commit()
+            self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, key, ttl=0):
+        """
+        查找缓存的响应
+
+        Args:
+            key: 缓存键
+            ttl: 条目自写入起的有效秒数，0表示不限制
+
+        Returns:
+            tuple: (响应文本, token数)，未命中时返回None
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT response_text, token_count, size, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                response_text, token_count, size, created_at = row
+                if ttl and created_at < now - ttl:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    conn.commit()
+                    self._total_bytes -= size or 0
+                    return None
+                # 使用时间攒批写入，命中时不提交事务
+                self._touches[key] = now
+                if now - self._last_touch_flush >= self.TOUCH_FLUSH_INTERVAL:
+                    self._flush_touches(conn, now)
+                    conn.commit()
+                return response_text, token_count or 0
+            except sqlite3.Error as e:
+                logger.warning(f"读取响应缓存失败: {str(e)}")
+                return None
+
+    def put(self, key, response_text, token_count):
+        """
+        保存一次成功的响应，必要时淘汰旧条目
+
+        Args:
+            key: 缓存键
+            response_text: 响应文本
+            token_count: 响应消耗的token数
+        """
+        now = time.time()
+        size = len(key) + len((response_text or '').encode('utf-8'))
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    """INSERT OR REPLACE INTO responses (key, response_text, token_count, size, created_at, last_used_at)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    (key, response_text, token_count or 0, size, now, now)
+                )
+                self._total_bytes += size
+                self._touches.pop(key, None)
+                self._flush_touches(conn, now)
+                if now - self._last_purge >= self.PURGE_INTERVAL:
+                    self._purge_expired(conn, now)
+                if self.max_bytes and self._total_bytes > self.max_bytes:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"写入响应缓存失败: {str(e)}")
+
+    def _flush_touches(self, conn, now):
+        """写入命中条目的使用时间（调用方负责提交）"""
+        self._last_touch_flush = now
+        if self._touches:
+            conn.executemany(
+                "UPDATE responses SET last_used_at = ? WHERE key = ?",
+                [(used_at, key) for key, used_at in self._touches.items()]
+            )
+            self._touches.clear()
+
+    def _purge_expired(self, conn, now):
+        """清理超过max_age秒未使用的条目"""
+        self._last_purge = now
+        if self.max_age:
+            conn.execute("DELETE FROM responses WHERE last_used_at < ?", (now - self.max_age,))
+        # 其他进程也在写入同一文件，定期校正总大小
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self, conn):
+        """按最近使用时间淘汰条目，直到总大小降到上限的90%以下"""
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self._total_bytes <= target:
+            return
+
+        keys = []
+        freed = 0
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used_at"):
+            keys.append((key,))
+            freed += size or 0
+            if self._total_bytes - freed <= target:
+                break
+        conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self._total_bytes -= freed
+        logger.info(f"响应缓存超过上限，淘汰了 {len(keys)} 个最久未使用的条目（{freed} 字节）")
+
+    def add_task_stats(self, task_id, stats):
+        """
+        累加一个任务的命中统计
+
+        Args:
+            task_id: 任务ID
+            stats: ResponseCacheStats.snapshot()的结果
+        """
+        if not stats or not (stats['hits'] or stats['misses']):
+            return
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    """INSERT INTO task_stats (task_id, hits, misses, bytes_saved, tokens_saved) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(task_id) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses,
+                    bytes_saved = bytes_saved + excluded.bytes_saved, tokens_saved = tokens_saved + excluded.tokens_saved""",
+                    (task_id, stats['hits'], stats['misses'], stats['bytes_saved'], stats['tokens_saved'])
+                )
+                # 任务结束时一并写入命中条目的使用时间
+                self._flush_touches(conn, time.time())
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"保存任务 {task_id} 的响应缓存统计失败: {str(e)}")
+
+    def get_task_stats(self, task_id):
+        """
+        获取一个任务已保存的命中统计
+
+        Args:
+            task_id: 任务ID
+
+        Returns:
+            dict: 命中统计，没有记录时返回None
+        """
+        with self._lock:
+            try:
+                row = self._connection().execute(
+                    "SELECT hits, misses, bytes_saved, tokens_saved FROM task_stats WHERE task_id = ?", (task_id,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"读取任务 {task_id} 的响应缓存统计失败: {str(e)}")
+                return None
+        if row is None:
+            return None
+        return {'hits': row[0], 'misses': row[1], 'bytes_saved': row[2], 'tokens_saved': row[3]}
+
+    def delete_task_stats(self, task_id):
+        """删除任务的命中统计（任务被删除时调用）"""
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("DELETE FROM task_stats WHERE task_id = ?", (task_id,))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"删除任务 {task_id} 的响应缓存统计失败: {str(e)}")
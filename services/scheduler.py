@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import threading
+from collections import deque, defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class SlotCancelled(Exception):
+    """等待调度槽位期间任务被注销（停止）"""
+    pass
+
+
+class _Waiter:
+    """等待调度槽位的请求，线程和协程共用同一种授予方式"""
+
+    def __init__(self, task_id, loop=None, exclude=None, config_id=None):
+        self.task_id = task_id
+        self.exclude = exclude or ()  # 配置池中尽量避开的API配置（本次请求已失败的配置）
+        self.required = config_id     # 只接受该API配置的槽位（重新获取转交出去的槽位时使用）
+        self.config_id = None         # 授予槽位时选中的API配置
+        self.state = None
+        self.granted = False
+        self.cancelled = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+        else:
+            self._future = loop.create_future()
+
+    def grant(self, state, config_id):
+        """授予槽位（在调度器锁内调用）"""
+        self.state = state
+        self.config_id = config_id
+        self.granted = True
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def cancel(self):
+        """任务注销时唤醒等待方（在调度器锁内调用）"""
+        self.cancelled = True
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+
+class ConcurrencyScheduler:
+    """全局并发调度器
+
+    进程内所有任务的LLM调用都要先从这里获取槽位，调度器同时限制：
+
+    - 全局在途请求数（GLOBAL_MAX_CONCURRENCY）
+    - 每个API配置的在途请求数（APIConfig.max_concurrency，0表示不限制）
+
+    槽位按加权公平排队（start-time fair queuing）分配：每个任务维护一个虚拟时间，
+    每获得一个槽位增加 1/weight，空闲槽位总是授予虚拟时间最小、且其API配置仍有余量的任务。
+    新加入的任务从当前最小虚拟时间开始计算，不会因为"补偿"而长期独占槽位。
+
+    使用API配置池的任务在授予槽位时选择配置：跳过被移出配置池的配置（全部被移出时不跳过），
+    在仍有余量的配置中选择 (在途请求数 + 1) / 路由权重 最小的一个（加权最少在途请求）。
+    """
+
+    def __init__(self, global_limit, health=None):
+        """
+        初始化调度器
+
+        Args:
+            global_limit: 全局最大在途请求数
+            health: API配置健康状况登记表（ConfigHealthRegistry），用于配置池跳过被移出的配置
+        """
+        self.global_limit = max(1, int(global_limit))
+        self.health = health
+        self._lock = threading.Lock()
+        self._tasks = {}                        # 任务ID -> 调度状态
+        self._config_limits = {}                # API配置ID -> 在途上限（0表示不限制）
+        self._config_in_flight = defaultdict(int)
+        self._in_flight = 0
+
+    def register_task(self, task_id, config_id, weight=1, config_limit=0, pool=None):
+        """
+        注册一个参与调度的任务
+
+        Args:
+            task_id: 任务ID
+            config_id: 任务使用的API配置ID（使用配置池时为主配置）
+            weight: 调度权重，权重越大获得的槽位份额越大
+            config_limit: 该API配置的在途上限（0表示不限制）
+            pool: API配置池，配置ID -> (在途上限, 路由权重)；为None时只使用config_id
+        """
+        pool = pool or {config_id: (config_limit, 1)}
+        with self._lock:
+            active = [state['virtual_time'] for state in self._tasks.values()]
+            self._tasks[task_id] = {
+                'config_id': config_id,
+                'configs': {cid: max(1, int(route_weight or 1)) for cid, (_, route_weight) in pool.items()},
+                'config_in_flight': defaultdict(int),
+                'weight': max(1, int(weight or 1)),
+                'in_flight': 0,
+                'granted': 0,
+                'waiters': deque(),
+                'virtual_time': min(active) if active else 0.0,
+            }
+            for cid, (limit, _) in pool.items():
+                self._config_limits[cid] = max(0, int(limit or 0))
+        logger.info(f"调度器注册任务 {task_id}，API配置: {list(pool)}，权重: {weight}")
+
+    def unregister_task(self, task_id):
+        """
+        注销任务，唤醒其所有等待中的请求（它们会收到SlotCancelled）
+
+        Args:
+            task_id: 任务ID
+        """
+        with self._lock:
+            state = self._tasks.pop(task_id, None)
+            if state is None:
+                return
+            while state['waiters']:
+                state['waiters'].popleft().cancel()
+            # 已经发出的请求仍然会调用release，这里先归还它们占用的配额
+            self._in_flight -= state['in_flight']
+            for config_id, in_flight in state['config_in_flight'].items():
+                self._config_in_flight[config_id] -= in_flight
+            self._dispatch()
+
+    def set_config_limit(self, config_id, limit):
+        """
+        更新某个API配置的在途上限
+
+        Args:
+            config_id: API配置ID
+            limit: 在途上限（0表示不限制）
+        """
+        with self._lock:
+            self._config_limits[config_id] = max(0, int(limit or 0))
+            self._dispatch()
+
+    def acquire(self, task_id, stop_event=None, exclude=None, config_id=None):
+        """
+        阻塞获取一个槽位（线程执行引擎使用）
+
+        Args:
+            task_id: 任务ID
+            stop_event: 任务停止事件，设置后放弃等待
+            exclude: 配置池中尽量避开的API配置ID
+            config_id: 只接受该API配置的槽位，为None时由调度器选择
+
+        Returns:
+            object: 槽位凭证（config_id为选中的API配置），用完后传给release归还
+
+        Raises:
+            SlotCancelled: 任务已注销或已停止
+        """
+        waiter = _Waiter(task_id, exclude=exclude, config_id=config_id)
+        self._enqueue(task_id, waiter)
+        while not waiter._event.wait(0.5):
+            if stop_event is not None and stop_event.is_set():
+                self._abandon(task_id, waiter)
+                break
+        if not waiter.granted or waiter.cancelled:
+            raise SlotCancelled(f"任务 {task_id} 已停止调度")
+        return waiter
+
+    async def acquire_async(self, task_id, exclude=None, config_id=None):
+        """
+        异步获取一个槽位（asyncio执行引擎使用）
+
+        Args:
+            task_id: 任务ID
+            exclude: 配置池中尽量避开的API配置ID
+            config_id: 只接受该API配置的槽位，为None时由调度器选择
+
+        Returns:
+            object: 槽位凭证（config_id为选中的API配置），用完后传给release归还
+
+        Raises:
+            SlotCancelled: 任务已注销
+        """
+        waiter = _Waiter(task_id, asyncio.get_running_loop(), exclude, config_id)
+        self._enqueue(task_id, waiter)
+        try:
+            await waiter._future
+        except asyncio.CancelledError:
+            self._abandon(task_id, waiter)
+            raise
+        if not waiter.granted or waiter.cancelled:
+            raise SlotCancelled(f"任务 {task_id} 已停止调度")
+        return waiter
+
+    def try_acquire(self, task_id, config_id):
+        """
+        不等待地为任务占用指定API配置的一个槽位（用于对冲请求）
+
+        只有全局和该配置都还有余量、且没有任何请求在排队时才授予，对冲请求不会挤占排队中的请求
+
+        Args:
+            task_id: 任务ID
+            config_id: API配置ID
+
+        Returns:
+            object: 槽位凭证，用完后传给release归还；不能授予时返回None
+        """
+        with self._lock:
+            state = self._tasks.get(task_id)
+            if state is None or config_id not in state['configs']:
+                return None
+            if self._in_flight >= self.global_limit or not self._config_has_room(config_id):
+                return None
+            if any(other['waiters'] for other in self._tasks.values()):
+                return None
+            waiter = _Waiter(task_id)
+            self._grant(state, waiter, config_id)
+            return waiter
+
+    def release(self, slot):
+        """
+        归还一个槽位
+
+        Args:
+            slot: acquire返回的槽位凭证
+        """
+        with self._lock:
+            state = self._tasks.get(slot.task_id)
+            if state is None or state is not slot.state:
+                # 任务已注销（或已重新注册），占用的配额在注销时已经归还
+                return
+            self._return_slot(state, slot.config_id)
+            self._dispatch()
+
+    def get_task_share(self, task_id):
+        """
+        获取任务在调度器中的份额信息
+
+        Args:
+            task_id: 任务ID
+
+        Returns:
+            dict: 调度份额信息，任务未注册时返回None
+        """
+        with self._lock:
+            state = self._tasks.get(task_id)
+            if state is None:
+                return None
+            total_weight = sum(s['weight'] for s in self._tasks.values())
+            config_id = state['config_id']
+            return {
+                'weight': state['weight'],
+                'in_flight': state['in_flight'],
+                'waiting': len(state['waiters']),
+                'granted': state['granted'],
+                'share': round(state['in_flight'] / self._in_flight, 4) if self._in_flight else 0,
+                'fair_share': round(state['weight'] / total_weight, 4) if total_weight else 0,
+                'running_tasks': len(self._tasks),
+                'global_limit': self.global_limit,
+                'global_in_flight': self._in_flight,
+                'config_id': config_id,
+                'config_limit': self._config_limits.get(config_id, 0),
+                'config_in_flight': self._config_in_flight[config_id],
+                'configs': {
+                    cid: {
+                        'route_weight': route_weight,
+                        'limit': self._config_limits.get(cid, 0),
+                        'in_flight': self._config_in_flight[cid],
+                        'task_in_flight': state['config_in_flight'][cid],
+                    }
+                    for cid, route_weight in state['configs'].items()
+                },
+            }
+
+    def _enqueue(self, task_id, waiter):
+        """将等待请求加入任务队列并尝试立即分配"""
+        with self._lock:
+            state = self._tasks.get(task_id)
+            if state is None:
+                waiter.cancel()
+                return
+            state['waiters'].append(waiter)
+            self._dispatch()
+
+    def _abandon(self, task_id, waiter):
+        """等待方放弃等待：未授予则移出队列，已授予则归还槽位"""
+        with self._lock:
+            state = self._tasks.get(task_id)
+            if state is None:
+                return
+            if waiter.granted:
+                waiter.cancelled = True
+                if state is not waiter.state:
+                    return
+                self._return_slot(state, waiter.config_id)
+                self._dispatch()
+            else:
+                try:
+                    state['waiters'].remove(waiter)
+                except ValueError:
+                    pass
+
+    def pick_config(self, task_id, exclude=()):
+        """
+        不占用槽位，按路由规则为任务选择一个API配置（用于对冲请求）
+
+        Args:
+            task_id: 任务ID
+            exclude: 尽量避开的API配置ID
+
+        Returns:
+            int: API配置ID，任务未注册或所有配置都没有余量时返回None
+        """
+        with self._lock:
+            state = self._tasks.get(task_id)
+            if state is None:
+                return None
+            return self._route(state, exclude)
+
+    def _return_slot(self, state, config_id):
+        """归还一个已授予的槽位占用的配额（在锁内调用）"""
+        state['in_flight'] -= 1
+        state['config_in_flight'][config_id] -= 1
+        self._in_flight -= 1
+        self._config_in_flight[config_id] -= 1
+
+    def _config_has_room(self, config_id):
+        limit = self._config_limits.get(config_id, 0)
+        return limit <= 0 or self._config_in_flight[config_id] < limit
+
+    def _route(self, state, exclude, required=None):
+        """
+        为任务的下一个请求选择API配置（在锁内调用）
+
+        Returns:
+            int: 选中的API配置ID，所有可用配置（或指定的配置required）都没有余量时返回None
+        """
+        if required is not None:
+            return required if self._config_has_room(required) else None
+        configs = state['configs']
+        if len(configs) == 1:
+            config_id = next(iter(configs))
+            return config_id if self._config_has_room(config_id) else None
+
+        usable = [cid for cid in configs if not (self.health and self.health.is_ejected(cid))] or list(configs)
+        preferred = [cid for cid in usable if cid not in exclude] or usable
+        best, best_score = None, None
+        for config_id in preferred:
+            if not self._config_has_room(config_id):
+                continue
+            score = (self._config_in_flight[config_id] + 1) / configs[config_id]
+            if best is None or score < best_score:
+                best, best_score = config_id, score
+        return best
+
+    def _dispatch(self):
+        """按加权公平原则分配空闲槽位（在锁内调用）"""
+        while self._in_flight < self.global_limit:
+            candidate = None
+            candidate_config = None
+            for state in self._tasks.values():
+                if not state['waiters']:
+                    continue
+                if candidate is not None and state['virtual_time'] >= candidate['virtual_time']:
+                    continue
+                head = state['waiters'][0]
+                config_id = self._route(state, head.exclude, head.required)
+                if config_id is None:
+                    continue
+                candidate, candidate_config = state, config_id
+            if candidate is None:
+                return
+
+            self._grant(candidate, candidate['waiters'].popleft(), candidate_config)
+
+    def _grant(self, state, waiter, config_id):
+        """授予槽位并计入任务和API配置的在途请求数（在锁内调用）"""
+        state['in_flight'] += 1
+        state['config_in_flight'][config_id] += 1
+        state['granted'] += 1
+        state['virtual_time'] += 1.0 / state['weight']
+        self._in_flight += 1
+        self._config_in_flight[config_id] += 1
+        waiter.grant(state, config_id)
+
+
+class SlotLease:
+    """一次LLM调用占用的调度器槽位
+
+    调用方获取槽位后把租约传给LLM服务：对冲请求通过它另外占用一个槽位，结束后归还；
+    对冲中落后的原请求仍在运行时，槽位随其转交（hand_over），原请求结束后才归还，
+    此后需要槽位时重新获取同一API配置的槽位。这样在途请求数始终不超过调度器的限制。
+    """
+
+    def __init__(self, scheduler, task_id):
+        self.scheduler = scheduler
+        self.task_id = task_id
+        self.slot = None
+        self.config_id = None  # 首次获取槽位时选中的API配置，之后重新获取时只接受该配置
+
+    def acquire(self, stop_event=None, exclude=None):
+        """
+        阻塞获取槽位（参数同ConcurrencyScheduler.acquire）
+
+        Returns:
+            object: 槽位凭证
+        """
+        self.slot = self.scheduler.acquire(self.task_id, stop_event, exclude, self.config_id)
+        self.config_id = self.slot.config_id
+        return self.slot
+
+    async def acquire_async(self, exclude=None):
+        """acquire的协程版本（asyncio执行引擎使用）"""
+        self.slot = await self.scheduler.acquire_async(self.task_id, exclude, self.config_id)
+        self.config_id = self.slot.config_id
+        return self.slot
+
+    def release(self):
+        """归还槽位（已转交或未持有时什么也不做）"""
+        slot, self.slot = self.slot, None
+        if slot is not None:
+            self.scheduler.release(slot)
+
+    def hand_over(self, future):
+        """
+        把槽位转交给仍在运行的请求，请求结束时归还
+
+        Args:
+            future: 请求的Future（线程）或Task（asyncio）
+        """
+        slot, self.slot = self.slot, None
+        if slot is not None:
+            future.add_done_callback(lambda _: self.scheduler.release(slot))
+
+    def try_acquire(self, config_id):
+        """
+        不等待地另外占用一个指定API配置的槽位（对冲请求使用）
+
+        Returns:
+            object: 槽位凭证，用完后传给scheduler.release归还；不能授予时返回None
+        """
+        return self.scheduler.try_acquire(self.task_id, config_id)
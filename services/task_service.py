@@ -3,6 +3,7 @@
 
 import os
 import time
+import asyncio
 import threading
 import queue
 import concurrent.futures
@@ -10,7 +11,18 @@ import pandas as pd
 import logging
 from datetime import datetime
 from flask import current_app, Flask
-from database.models import Task, TaskLog, Template
+from database.models import Task, TaskLog, TaskJob, Template
+from services.async_engine import AsyncTaskEngine
+from services.batch_engine import BatchTaskEngine
+from services.progress import TaskProgress
+from services.log_writer import TaskLogWriter
+from services.excel_service import RowAccessor
+from services.dedup import RequestCoalescer
+from services.response_cache import ResponseCacheStats
+from services.packing import PackStats, build_pack_prompt, parse_pack_response
+from services.scheduler import ConcurrencyScheduler, SlotCancelled, SlotLease
+from services.api_pool import RoutingStats
+from services.budget import TaskBudget
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +46,26 @@ class TaskService:
         self.task_threads = {}   # 任务线程
         self.task_executors = {} # 任务执行器
         self.task_stop_events = {}  # 任务停止事件
+        self.task_progress = {}  # 运行中任务的内存进度计数器
+        self.task_dedup = {}     # 任务内的请求去重与在途请求合并
+        self.task_cache_stats = {}  # 运行中任务的响应缓存命中统计
+        self.task_packing = {}   # 运行中任务的多行合并请求统计
+        self.task_routing = {}   # 使用API配置池的运行中任务在各配置上的调用统计
+        self.task_budgets = {}   # 设置了预算的运行中任务的token和费用用量
+        
+        # asyncio执行引擎
+        self.async_engine = AsyncTaskEngine(self)
+        
+        # Batch API执行引擎
+        self.batch_engine = BatchTaskEngine(self)
+        
+        # 全局并发调度器，所有任务的LLM调用共享其槽位
+        self.scheduler = ConcurrencyScheduler(
+            current_app.config.get('GLOBAL_MAX_CONCURRENCY', 1000), self.llm_service.config_health
+        )
+        
+        # 自适应并发控制器调整上限后，同步到调度器的API配置上限
+        self.llm_service.adaptive_limits.add_listener(self.scheduler.set_config_limit)
         
         # 延迟加载配置
         self._result_folder = None
@@ -43,6 +75,13 @@ class TaskService:
         from app import app
         self.app = app
         
+        # 任务日志由后台线程批量写入
+        self.log_writer = TaskLogWriter(
+            app,
+            current_app.config.get('LOG_WRITE_BATCH_SIZE', 200),
+            current_app.config.get('LOG_WRITE_MAX_LATENCY', 0.5)
+        )
+        
     @property
     def result_folder(self):
         """获取结果存储目录"""
@@ -56,7 +95,9 @@ class TaskService:
         self.task_executors = {} # 任务执行器
         self.task_stop_events = {}  # 任务停止事件
     
-    def create_task(self, schema_id, prompt_template, concurrency=1, image_fields=None):
+    def create_task(self, schema_id, prompt_template, concurrency=1, image_fields=None, engine=None,
+                    api_config_id=None, weight=1, pack_size=1, api_config_ids=None, row_order=None,
+                    token_budget=None, cost_budget=None):
         """
         创建新任务
         
@@ -65,13 +106,58 @@ class TaskService:
             prompt_template: 提示词模板
             concurrency: 并发数
             image_fields: 图片字段列表
+            engine: 执行引擎（thread、async、worker或batch，为None则使用配置的默认引擎）
+            api_config_id: API配置ID（为None则使用默认配置）
+            weight: 全局调度器中的权重
+            pack_size: 每个LLM请求合并的行数（1表示逐行请求）
+            api_config_ids: API配置池（多个API配置ID），请求按路由权重分配到各配置，
+                            失败时换用其他配置重试；提供时忽略api_config_id
+            row_order: 行的处理顺序（fifo或longest_first，为None则按文件顺序）
+            token_budget: 最多消耗的token数（为None或0则不限制）
+            cost_budget: 最多花费的费用，按API配置的价格计算（为None或0则不限制）
             
         Returns:
             int: 任务ID
         """
         try:
-            # 加载Excel数据
-            df, fields = self.excel_service.get_excel_data(schema_id)
+            # 验证执行引擎
+            engine = engine or current_app.config.get('DEFAULT_TASK_ENGINE', Task.ENGINE_THREAD)
+            if engine not in Task.ENGINES:
+                raise ValueError(f"不支持的执行引擎: {engine}")
+            
+            # 验证API配置
+            api_config_ids = self._validate_config_pool(api_config_ids, engine)
+            if api_config_ids:
+                api_config_id = api_config_ids[0]
+            if api_config_id:
+                self.llm_service.resolve_api_config(api_config_id)
+            
+            # 验证多行合并请求的行数
+            pack_size = int(pack_size or 1)
+            max_pack_size = current_app.config.get('PACK_MAX_SIZE', 50)
+            if not 1 <= pack_size <= max_pack_size:
+                raise ValueError(f"每个请求合并的行数必须在1到{max_pack_size}之间")
+            if pack_size > 1:
+                if engine not in (Task.ENGINE_THREAD, Task.ENGINE_ASYNC):
+                    raise ValueError("多行合并请求只支持thread和async执行引擎")
+                if image_fields:
+                    raise ValueError("包含图片字段的任务不支持多行合并请求")
+            
+            # 验证行的处理顺序
+            row_order = row_order or Task.ROW_ORDER_FIFO
+            if row_order not in Task.ROW_ORDERS:
+                raise ValueError(f"不支持的处理顺序: {row_order}")
+            if row_order != Task.ROW_ORDER_FIFO and engine not in (Task.ENGINE_THREAD, Task.ENGINE_ASYNC):
+                raise ValueError("按预估耗时排序只支持thread和async执行引擎")
+            
+            # 验证预算
+            token_budget, cost_budget = self._validate_budget(
+                token_budget, cost_budget, engine, self._resolve_task_configs(api_config_id, api_config_ids)
+            )
+            
+
+            # 获取数据行数（上传时已统计，不需要读取文件）
+            row_count, fields = self.excel_service.get_row_count(schema_id)
             
             # 验证图片字段
             if image_fields:
@@ -79,16 +165,27 @@ class TaskService:
                     if field not in fields:
                         raise ValueError(f"图片字段 '{field}' 不存在于Excel文件中")
             
+            # 验证提示词模板引用的字段
+            self.excel_service.validate_template(prompt_template, fields)
+            
             # 创建任务记录
             task = Task(
                 schema_id=schema_id,
                 prompt_template=prompt_template,
-                total_count=len(df),
+                total_count=row_count,
                 concurrency=concurrency,
-                image_fields=image_fields or []
+                image_fields=image_fields or [],
+                engine=engine,
+                api_config_id=api_config_id or None,
+                weight=max(1, int(weight or 1)),
+                pack_size=pack_size,
+                api_config_ids=api_config_ids,
+                row_order=row_order,
+                token_budget=token_budget,
+                cost_budget=cost_budget
             )
             task_id = task.save()
-            logger.info(f"创建任务成功: ID={task_id}, 总条数={len(df)}")
+            logger.info(f"创建任务成功: ID={task_id}, 总条数={row_count}, 执行引擎={engine}")
             
             return task_id
             
@@ -96,12 +193,151 @@ class TaskService:
             logger.error(f"创建任务失败: {str(e)}")
             raise
     
-    def start_task(self, task_id):
+    def estimate_task(self, schema_id, prompt_template, concurrency=1, image_fields=None,
+                      api_config_id=None, api_config_ids=None):
+        """
+        不调用LLM，预估任务的token数、费用和耗时
+        
+        批量渲染所有行的提示词，用离线token计数器计算输入token数（启用请求去重时相同的请求只计一次）；
+        输出token数按API配置other_params中的max_tokens计算（未设置时为默认值），是上限；
+        每个请求的耗时取该配置最近成功请求的平均处理时间，没有记录时使用ESTIMATE_DEFAULT_LATENCY，
+        再按并发数和RPM/TPM限额推算总耗时。使用API配置池时请求按路由权重分配到各配置
+        
+        Args:
+            schema_id: Excel schema ID
+            prompt_template: 提示词模板
+            concurrency: 并发数
+            image_fields: 图片字段列表
+            api_config_id: API配置ID（为None则使用默认配置）
+            api_config_ids: API配置池（多个API配置ID），提供时忽略api_config_id
+        
+        Returns:
+            dict: 预估的请求数、输入/输出token数、费用、耗时及其限制因素
+        """
+        concurrency = int(concurrency or 1)
+        if concurrency < 1:
+            raise ValueError("并发数必须大于0")
+        
+        # 验证API配置
+        api_config_ids = self._validate_config_pool(api_config_ids, Task.ENGINE_THREAD)
+        configs = self._resolve_task_configs(api_config_id, api_config_ids)
+        
+        # 验证图片字段和提示词模板引用的字段
+        row_count, fields = self.excel_service.get_row_count(schema_id)
+        image_fields = image_fields or []
+        for field in image_fields:
+            if field not in fields:
+                raise ValueError(f"图片字段 '{field}' 不存在于Excel文件中")
+        self.excel_service.validate_template(prompt_template, fields)
+        
+        # 只加载模板和图片字段用到的列，批量渲染提示词
+        columns = self.excel_service.get_task_columns(schema_id, prompt_template, image_fields)
+        df, _ = self.excel_service.get_excel_data(schema_id, columns)
+        prompts = self.excel_service.render_prompts(prompt_template, df)
+        
+        # 每行非空图片的数量及图片字段的值（请求去重的键包括图片）
+        image_counts = [0] * len(df)
+        image_values = [()] * len(df)
+        if image_fields:
+            images = df[image_fields]
+            present = images.notna() & images.astype(str).apply(lambda column: column.str.strip() != '')
+            image_counts = present.sum(axis=1).tolist()
+            image_values = list(images.astype(str).itertuples(index=False, name=None))
+        
+        # 计算输入token数，启用请求去重时相同的请求只计一次
+        dedup = current_app.config.get('DEDUP_REQUESTS', True)
+        image_tokens = self.llm_service.tokenizer.image_tokens
+        seen = set()
+        requests = input_tokens = max_request_tokens = 0
+        for prompt, image_count, values in zip(prompts, image_counts, image_values):
+            if dedup:
+                key = (prompt, values)
+                if key in seen:
+                    continue
+                seen.add(key)
+            tokens = self.llm_service.estimate_prompt_tokens(prompt) + image_tokens * image_count
+            requests += 1
+            input_tokens += tokens
+            max_request_tokens = max(max_request_tokens, tokens)
+        
+        # 按路由权重把请求分配到各配置，分别计算输出token数、费用、耗时和限额
+        default_completion = current_app.config.get('RATE_LIMIT_DEFAULT_COMPLETION_TOKENS', 500)
+        default_latency = current_app.config.get('ESTIMATE_DEFAULT_LATENCY', 5.0)
+        total_weight = sum(config.route_weight for config in configs)
+        config_estimates = []
+        for config in configs:
+            share = config.route_weight / total_weight
+            max_tokens = config.other_params.get('max_tokens')
+            latency, samples = TaskLog.get_recent_latency(config.id, bool(config.is_default))
+            config_input = input_tokens * share
+            config_output = requests * share * int(max_tokens or default_completion)
+            
+            estimate = {
+                'config_id': config.id,
+                'name': config.name,
+                'share': round(share, 4),
+                'requests': round(requests * share),
+                'input_tokens': round(config_input),
+                'output_tokens': round(config_output),
+                'max_tokens': int(max_tokens or default_completion),
+                'output_tokens_source': 'max_tokens' if max_tokens else 'default',
+                'latency': round(latency if samples else default_latency, 3),
+                'latency_source': 'history' if samples else 'default',
+                'latency_samples': samples,
+                'cost': None
+            }
+            if config.input_price or config.output_price:
+                estimate['cost'] = round(
+                    (config_input * config.input_price + config_output * config.output_price) / 1000000, 4
+                )
+            
+            # 按RPM/TPM限额发送完该配置分到的请求所需的最短时间
+            estimate['rpm_time'] = requests * share / config.rpm_limit * 60 if config.rpm_limit else 0
+            estimate['tpm_time'] = (config_input + config_output) / config.tpm_limit * 60 if config.tpm_limit else 0
+            config_estimates.append(estimate)
+        
+        # 实际并发数受任务并发数、全局上限和各配置的在途请求上限（0表示不限制）约束
+        limits = [self._config_concurrency_limit(config) for config in configs]
+        capacity = sum(limits) if all(limits) else concurrency
+        effective_concurrency = min(concurrency, self.scheduler.global_limit or concurrency, capacity)
+        latency = sum(estimate['latency'] * estimate['share'] for estimate in config_estimates)
+        waves = -(-requests // effective_concurrency)
+        bounds = {
+            'concurrency': waves * latency,
+            'rpm': max(estimate.pop('rpm_time') for estimate in config_estimates),
+            'tpm': max(estimate.pop('tpm_time') for estimate in config_estimates)
+        }
+        limited_by = max(bounds, key=bounds.get)
+        wall_time = bounds[limited_by]
+        
+        costs = [estimate['cost'] for estimate in config_estimates]
+        output_tokens = sum(estimate['output_tokens'] for estimate in config_estimates)
+        return {
+            'row_count': row_count,
+            'requests': requests,
+            'deduplicated_rows': len(prompts) - requests,
+            'tokenizer': self.llm_service.tokenizer.name,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+            'avg_input_tokens': round(input_tokens / requests, 1) if requests else 0,
+            'max_input_tokens': max_request_tokens,
+            'cost': round(sum(costs), 4) if None not in costs else None,
+            'concurrency': effective_concurrency,
+            'latency': round(latency, 3),
+            'wall_time': round(wall_time, 1),
+            'wall_time_text': self._format_time(wall_time),
+            'limited_by': limited_by,
+            'configs': config_estimates
+        }
+    
+    def start_task(self, task_id, resume=False):
         """
         启动任务处理
         
         Args:
             task_id: 任务ID
+            resume: 是否为续跑（跳过已有成功日志的行）
         """
         try:
             # 检查任务是否存在且未在运行
@@ -116,6 +352,10 @@ class TaskService:
             # 标记任务为运行中
             task.status = Task.STATUS_RUNNING
             task.started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            
+            # worker引擎只写入任务队列，由独立Worker进程处理
+            if task.engine == Task.ENGINE_WORKER:
+                self._enqueue_worker_task(task, resume)
             task.save()
             
             # 创建结果目录
@@ -123,6 +363,10 @@ class TaskService:
             if not os.path.exists(result_dir):
                 os.makedirs(result_dir)
             
+            if task.engine == Task.ENGINE_WORKER:
+                logger.info(f"任务 {task_id} 已加入任务队列，等待Worker进程处理")
+                return
+            
             # 准备任务停止事件
             stop_event = threading.Event()
             self.task_stop_events[task_id] = stop_event
@@ -130,7 +374,7 @@ class TaskService:
             # 启动任务线程
             thread = threading.Thread(
                 target=self._process_task,
-                args=(task_id, stop_event),
+                args=(task_id, stop_event, resume),
                 daemon=True
             )
             thread.start()
@@ -138,7 +382,7 @@ class TaskService:
             self.task_threads[task_id] = thread
             self.running_tasks[task_id] = task
             
-            logger.info(f"任务 {task_id} 已启动，并发数: {task.concurrency}")
+            logger.info(f"任务 {task_id} 已启动，并发数: {task.concurrency}，执行引擎: {task.engine}")
             
         except Exception as e:
             logger.error(f"启动任务 {task_id} 失败: {str(e)}")
@@ -149,13 +393,14 @@ class TaskService:
                 task.save()
             raise
     
-    def _process_task(self, task_id, stop_event):
+    def _process_task(self, task_id, stop_event, resume=False):
         """
         处理任务的工作线程
         
         Args:
             task_id: 任务ID
             stop_event: 停止事件
+            resume: 是否为续跑
         """
         # 在应用上下文中运行任务处理代码
         with self.app.app_context():
@@ -163,103 +408,105 @@ class TaskService:
                 # 获取任务信息
                 task = Task.get_by_id(task_id)
                 
-                # 加载Excel数据
-                df, fields = self.excel_service.get_excel_data(task.schema_id)
+                # 加载Excel数据（每个任务只读取一次，只加载模板和图片字段用到的列），按列转换后供各行使用
+                columns = self.excel_service.get_task_columns(task.schema_id, task.prompt_template, task.image_fields)
+                df, fields = self.excel_service.get_excel_data(task.schema_id, columns)
+                rows = RowAccessor(df)
+                
+                # 批量渲染所有行的提示词，处理各行时直接使用
+                task.prompts = self.excel_service.render_prompts(task.prompt_template, df)
                 
                 # 初始化结果列
                 task.result_column = [None] * len(df)
                 
-                # 创建任务队列
-                task_queue = queue.Queue()
-                self.task_queues[task_id] = task_queue
+                # 确定需要处理的行（重试失败行的任务只处理指定的行）
+                if task.row_indexes is not None:
+                    row_indexes = [i for i in task.row_indexes if 0 <= i < len(df)]
+                else:
+                    row_indexes = range(len(df))
                 
-                # 添加所有行到队列
-                for i in range(len(df)):
-                    task_queue.put(i)
+                # 续跑时用成功日志恢复结果列，只处理缺失或失败的行
+                if resume:
+                    row_indexes = self._restore_completed_rows(task, row_indexes)
                 
-                # 创建线程池
-                executor = concurrent.futures.ThreadPoolExecutor(max_workers=task.concurrency)
-                self.task_executors[task_id] = executor
+                # 按任务的处理顺序排列待处理的行（结果按行索引写入，结果文件仍按原始行顺序）
+                if task.row_order == Task.ROW_ORDER_LONGEST_FIRST:
+                    row_indexes = self._order_longest_first(task, rows, row_indexes)
                 
-                # 创建进度跟踪变量
-                processed = 0
-                success = 0
-                error = 0
+                # 进度先在内存中累加，按间隔合并写入数据库
+                progress = TaskProgress(
+                    task,
+                    current_app.config.get('PROGRESS_FLUSH_INTERVAL', 1.0),
+                    current_app.config.get('PROGRESS_FLUSH_ROWS', 100)
+                )
+                self.task_progress[task_id] = progress
                 
-                # 处理开始时间
-                start_time = time.time()
+                # 在全局调度器中注册任务
+                config = self.register_scheduler_task(task)
                 
-                # 提交所有处理任务
-                futures = []
-                while not task_queue.empty() and not stop_event.is_set():
-                    row_index = task_queue.get()
-                    future = executor.submit(
-                        self._process_row,
-                        task_id,
-                        df.iloc[row_index].to_dict(),
-                        task.prompt_template,
-                        task.image_fields,
-                        row_index
+                # 任务内的请求去重（API配置相同，只需比较提示词和图片）
+                if current_app.config.get('DEDUP_REQUESTS', True):
+                    self.task_dedup[task_id] = RequestCoalescer((config.id, config.model_name, config.other_params))
+                
+                # 跨任务的响应缓存命中统计
+                self.start_cache_stats(task_id, config)
+                
+                # 多行合并请求统计
+                if task.pack_size > 1:
+                    self.task_packing[task_id] = PackStats(
+                        task.pack_size, self._row_prompt_tokens(task, rows, row_indexes)
                     )
-                    futures.append((future, row_index))
-                    
-                    # 防止提交过多任务
-                    if len(futures) >= task.concurrency * 2:
-                        # 等待一些任务完成
-                        for future, index in list(futures):
-                            if future.done():
-                                try:
-                                    result, is_success = future.result()
-                                    task.result_column[index] = result
-                                    processed += 1
-                                    if is_success:
-                                        success += 1
-                                    else:
-                                        error += 1
-                                    
-                                    # 更新任务状态
-                                    task.processed_count = processed
-                                    task.success_count = success
-                                    task.error_count = error
-                                    task.save()
-                                    
-                                    futures.remove((future, index))
-                                except Exception as e:
-                                    logger.error(f"处理行 {index} 结果时出错: {str(e)}")
-                                    
-                        # 检查是否需要停止
-                        if stop_event.is_set():
-                            break
-                
-                # 等待所有任务完成
-                for future, index in futures:
-                    if not stop_event.is_set():
-                        try:
-                            result, is_success = future.result()
-                            task.result_column[index] = result
-                            processed += 1
-                            if is_success:
-                                success += 1
-                            else:
-                                error += 1
-                        except Exception as e:
-                            logger.error(f"处理行 {index} 结果时出错: {str(e)}")
-                            error += 1
-                            
-                        # 更新任务状态
-                        task.processed_count = processed
-                        task.success_count = success
-                        task.error_count = error
-                        task.save()
                 
-                # 关闭线程池
-                executor.shutdown(wait=False)
+                # token和费用预算
+                self.start_budget(task)
+                
+                # 根据任务选择的执行引擎处理所有行
+                if task.engine == Task.ENGINE_ASYNC:
+                    self.async_engine.run(task, rows, row_indexes, stop_event, progress)
+                elif task.engine == Task.ENGINE_BATCH:
+                    self.batch_engine.run(task, rows, row_indexes, stop_event, progress)
+                else:
+                    self._run_thread_engine(task, rows, row_indexes, stop_event, progress)
+                
+                # 写入尚未提交的日志和最终进度（随后的task.save()也会写入计数，这里保证停止时进度不丢失）
+                self.log_writer.flush()
+                progress.flush()
+                
+                # 随任务状态一起保存多行合并请求的统计
+                if task_id in self.task_packing:
+                    task.pack_stats = self.task_packing[task_id].snapshot()
+                    logger.info(f"任务 {task_id} 的多行合并请求统计: {task.pack_stats}")
+                
+                # 随任务状态一起保存预算的使用情况
+                budget = self.task_budgets.get(task_id)
+                paused = budget is not None and budget.paused
+                if budget is not None:
+                    task.budget_stats = budget.snapshot()
+                
+                # 结果文件需要包含原始文件的所有列
+                if columns is not None and not stop_event.is_set() and not paused:
+                    df, _ = self.excel_service.get_excel_data(task.schema_id)
                 
                 # 检查是否被终止
                 if stop_event.is_set():
                     task.status = Task.STATUS_STOPPED
                     task.save()
                     logger.info(f"任务 {task_id} 已停止")
+                elif paused:
+                    # 用完预算，剩余的行在提高预算后续跑
+                    task.status = Task.STATUS_PAUSED
+                    task.save()
+                    logger.info(f"任务 {task_id} 已用完预算并暂停，提高预算后可以续跑")
+                elif task.parent_task_id:
+                    # 重试任务的结果合并回原任务的结果文件
+                    result_file = self._merge_retry_results(task, df)
+                    
+                    task.status = Task.STATUS_COMPLETED
+                    task.completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    task.result_path = result_file
+                    task.save()
+                    
+                    logger.info(f"重试任务 {task_id} 已完成，结果已合并到原任务 {task.parent_task_id}: {result_file}")
                 else:
                     # 生成结果文件
                     result_file = os.path.join(
@@ -284,8 +531,6 @@ class TaskService:
                     del self.task_queues[task_id]
                 if task_id in self.running_tasks:
                     del self.running_tasks[task_id]
-                if task_id in self.task_threads:
-                    del self.task_threads[task_id]
                 if task_id in self.task_stop_events:
                     del self.task_stop_events[task_id]
                     
@@ -294,6 +539,9 @@ class TaskService:
                 
                 # 更新任务状态为错误
                 try:
+                    self.log_writer.flush()
+                    if task_id in self.task_progress:
+                        self.task_progress[task_id].flush()
                     task = Task.get_by_id(task_id)
                     if task:
                         task.status = Task.STATUS_ERROR
@@ -303,6 +551,7 @@ class TaskService:
                     logger.error("无法更新任务状态")
             
             # 清理资源
+            self.scheduler.unregister_task(task_id)
             if task_id in self.task_executors:
                 self.task_executors[task_id].shutdown(wait=False)
                 del self.task_executors[task_id]
@@ -310,25 +559,745 @@ class TaskService:
                 del self.task_queues[task_id]
             if task_id in self.running_tasks:
                 del self.running_tasks[task_id]
-            if task_id in self.task_threads:
-                del self.task_threads[task_id]
             if task_id in self.task_stop_events:
                 del self.task_stop_events[task_id]
+            self.task_progress.pop(task_id, None)
+            self.task_dedup.pop(task_id, None)
+            self.save_cache_stats(task_id)
+            self.task_packing.pop(task_id, None)
+            self.task_routing.pop(task_id, None)
+            self.task_budgets.pop(task_id, None)
+            # 最后移除线程记录，续跑据此判断上一次运行是否已经完全退出
+            if self.task_threads.get(task_id) is threading.current_thread():
+                del self.task_threads[task_id]
     
-    def _process_row(self, task_id, row_data, prompt_template, image_fields, row_index):
+    def _validate_config_pool(self, api_config_ids, engine):
         """
-        处理单行数据
+        验证任务的API配置池
+        
+        Args:
+            api_config_ids: API配置ID列表
+            engine: 任务的执行引擎
+            
+        Returns:
+            list: 去重后的API配置ID列表，少于两个配置时返回空列表（不使用配置池）
+        """
+        if not api_config_ids:
+            return []
+        if not isinstance(api_config_ids, (list, tuple)):
+            raise ValueError("API配置池必须是API配置ID的列表")
+        
+        config_ids = []
+        for config_id in api_config_ids:
+            config_id = int(config_id)
+            if config_id not in config_ids:
+                self.llm_service.resolve_api_config(config_id)
+                config_ids.append(config_id)
+        if len(config_ids) < 2:
+            return []
+        if engine == Task.ENGINE_BATCH:
+            raise ValueError("batch执行引擎不支持API配置池")
+        return config_ids
+    
+    def _resolve_task_configs(self, api_config_id, api_config_ids):
+        """
+        获取任务使用的API配置
+        
+        Args:
+            api_config_id: API配置ID（为None则使用默认配置）
+            api_config_ids: API配置池，不为空时忽略api_config_id
+            
+        Returns:
+            list: API配置对象列表，第一个为主配置
+        """
+        if api_config_ids:
+            return [self.llm_service.resolve_api_config(config_id) for config_id in api_config_ids]
+        return [self.llm_service.resolve_api_config(api_config_id)]
+    
+    def _validate_budget(self, token_budget, cost_budget, engine, configs):
+        """
+        验证任务的token和费用预算
+        
+        Args:
+            token_budget: 最多消耗的token数
+            cost_budget: 最多花费的费用
+            engine: 任务的执行引擎
+            configs: 任务使用的API配置
+            
+        Returns:
+            tuple: (token预算, 费用预算)，0表示不限制
+        """
+        token_budget = int(token_budget or 0)
+        cost_budget = float(cost_budget or 0)
+        if token_budget < 0 or cost_budget < 0:
+            raise ValueError("预算不能为负数")
+        if not token_budget and not cost_budget:
+            return 0, 0
+        if engine not in (Task.ENGINE_THREAD, Task.ENGINE_ASYNC):
+            raise ValueError("预算限制只支持thread和async执行引擎")
+        if cost_budget and not any(config.input_price or config.output_price for config in configs):
+            raise ValueError("API配置没有设置价格，无法按费用限制预算")
+        return token_budget, cost_budget
+    
+    def start_budget(self, task):
+        """
+        开始统计设置了预算的任务的用量，续跑时从任务日志中已有的token数开始累计
+        
+        Args:
+            task: 任务对象（prompts为批量渲染的提示词）
+        """
+        if not task.token_budget and not task.cost_budget:
+            return
+        
+        # 使用API配置池时按池中最高的价格计算费用
+        configs = self._resolve_task_configs(task.api_config_id, task.api_config_ids)
+        prompt_tokens = self._sample_prompt_tokens(task)
+        tokens_used, prompt_tokens_used, logs_used = TaskLog.get_token_totals(task.id)
+        # 还没有日志时每个请求的预估输出token数（max_tokens较大时按默认值，避免预约过多）
+        default_completion = current_app.config.get('RATE_LIMIT_DEFAULT_COMPLETION_TOKENS', 500)
+        completion_tokens = max(
+            min(int(config.other_params.get('max_tokens') or default_completion), default_completion)
+            for config in configs
+        )
+        self.task_budgets[task.id] = TaskBudget(
+            token_budget=task.token_budget,
+            cost_budget=task.cost_budget,
+            input_price=max(config.input_price for config in configs),
+            output_price=max(config.output_price for config in configs),
+            prompt_tokens=prompt_tokens,
+            slowdown_at=current_app.config.get('BUDGET_SLOWDOWN_AT', 0.9),
+            tokens_used=tokens_used,
+            prompt_tokens_used=prompt_tokens_used,
+            logs_used=logs_used,
+            completion_tokens=completion_tokens
+        )
+        logger.info(f"任务 {task.id} 的预算: {self.task_budgets[task.id].snapshot()}")
+    
+    def _sample_prompt_tokens(self, task, samples=200):
+        """
+        按均匀抽样的行预估任务每个请求的提示词token数（包括图片字段的预估token数）
+        
+        Args:
+            task: 任务对象
+            samples: 最多抽样的行数
+            
+        Returns:
+            int: 预估的平均提示词token数
+        """
+        if not task.prompts:
+            return 0
+        step = max(1, len(task.prompts) // samples)
+        sampled = task.prompts[::step]
+        tokens = sum(self.llm_service.estimate_prompt_tokens(prompt) for prompt in sampled) // len(sampled)
+        return tokens + len(task.image_fields) * self.llm_service.tokenizer.image_tokens
+    
+    def register_scheduler_task(self, task):
+        """
+        在全局调度器中注册任务，使用API配置池的任务同时注册池中所有配置并开始统计各配置的调用
+        
+        Args:
+            task: 任务对象
+            
+        Returns:
+            APIConfig: 任务的主配置（API配置池中的第一个配置）
+        """
+        configs = self._resolve_task_configs(task.api_config_id, task.api_config_ids)
+        pool = {config.id: (self._config_concurrency_limit(config), config.route_weight) for config in configs}
+        config = configs[0]
+        self.scheduler.register_task(
+            task.id, config.id, task.weight, pool[config.id][0], pool if len(pool) > 1 else None
+        )
+        if len(pool) > 1:
+            self.task_routing[task.id] = RoutingStats()
+        return config
+    
+    def get_routing_stats(self, task):
+        """
+        获取使用API配置池的运行中任务在各配置上的吞吐量和健康状况
+        
+        Args:
+            task: 任务对象
+            
+        Returns:
+            list: 每个配置的调用统计、路由权重、在途请求数和健康状况，任务未使用配置池或未在运行时返回None
+        """
+        routing = self.task_routing.get(task.id)
+        if routing is None:
+            return None
+        
+        share = self.scheduler.get_task_share(task.id) or {}
+        pool = share.get('configs', {})
+        stats = routing.snapshot()
+        result = []
+        for config_id in task.api_config_ids:
+            try:
+                name = self.llm_service.resolve_api_config(config_id).name
+            except ValueError:
+                name = None
+            entry = {'config_id': config_id, 'name': name}
+            entry.update(pool.get(config_id, {}))
+            entry.update(stats.get(config_id, {}))
+            entry.update(self.llm_service.config_health.snapshot(config_id))
+            hedging = self.llm_service.hedging.snapshot(config_id)
+            if hedging:
+                entry['hedging'] = hedging
+            result.append(entry)
+        return result
+    
+    def start_cache_stats(self, task_id, config):
+        """
+        开始统计任务的响应缓存命中情况（API配置未启用响应缓存时不统计）
         
         Args:
             task_id: 任务ID
+            config: 任务使用的API配置
+        """
+        if self.llm_service.response_cache is not None and config.cache_enabled:
+            self.task_cache_stats.setdefault(task_id, ResponseCacheStats())
+    
+    def save_cache_stats(self, task_id):
+        """
+        将任务在本进程中的命中统计累加到响应缓存文件中并停止统计
+        
+        Args:
+            task_id: 任务ID
+        """
+        stats = self.task_cache_stats.pop(task_id, None)
+        if stats is not None:
+            self.llm_service.response_cache.add_task_stats(task_id, stats.snapshot())
+    
+    def get_cache_stats(self, task_id):
+        """
+        获取任务的响应缓存命中统计
+        
+        Args:
+            task_id: 任务ID
+            
+        Returns:
+            dict: 命中数、未命中数、节省的字节数和token数及命中率，没有统计时返回None
+        """
+        if self.llm_service.response_cache is None:
+            return None
+        
+        stats = self.llm_service.response_cache.get_task_stats(task_id)
+        live = self.task_cache_stats.get(task_id)
+        if live is not None:
+            snapshot = live.snapshot()
+            stats = {key: value + (stats or {}).get(key, 0) for key, value in snapshot.items()}
+        if not stats or not (stats['hits'] or stats['misses']):
+            return None
+        
+        stats['hit_ratio'] = round(stats['hits'] / (stats['hits'] + stats['misses']), 4)
+        return stats
+    
+    def _restore_completed_rows(self, task, row_indexes):
+        """
+        根据任务日志恢复已成功处理的行，并返回仍需处理的行
+        
+        Args:
+            task: 任务对象（result_column已初始化）
+            row_indexes: 任务需要处理的全部行索引
+            
+        Returns:
+            list: 缺失或失败、需要重新处理的行索引
+        """
+        completed = TaskLog.get_success_results(task.id)
+        pending = []
+        for row_index in row_indexes:
+            if row_index in completed:
+                task.result_column[row_index] = completed[row_index]
+            else:
+                pending.append(row_index)
+        
+        # 失败的行会重新处理，进度从已成功的行开始计算
+        task.processed_count = len(row_indexes) - len(pending)
+        task.success_count = task.processed_count
+        task.error_count = 0
+        task.save()
+        
+        logger.info(f"任务 {task.id} 续跑：已完成 {task.processed_count} 行，待处理 {len(pending)} 行")
+        return pending
+    
+    def _enqueue_worker_task(self, task, resume=False):
+        """
+        将任务待处理的行按批次写入任务队列（worker执行引擎）
+        
+        Args:
+            task: 任务对象
+            resume: 是否为续跑（跳过已有成功日志的行）
+        """
+        row_indexes = task.row_indexes if task.row_indexes is not None else list(range(task.total_count))
+        
+        pending = row_indexes
+        if resume:
+            completed = TaskLog.get_success_results(task.id)
+            pending = [i for i in row_indexes if i not in completed]
+        
+        # 续跑时进度从已成功的行开始计算
+        task.processed_count = len(row_indexes) - len(pending)
+        task.success_count = task.processed_count
+        task.error_count = 0
+        
+        batch_size = max(1, int(current_app.config.get('WORKER_BATCH_SIZE', 50)))
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        TaskJob.enqueue(task.id, batches)
+        
+        logger.info(f"任务 {task.id} 写入任务队列：{len(pending)} 行，{len(batches)} 个批次")
+    
+    def finalize_worker_task(self, task):
+        """
+        所有行批次完成后生成结果文件并标记任务完成（由Worker进程调用）
+        
+        进度按任务日志重新统计，修正Worker重新领取批次时可能产生的重复计数
+        
+        Args:
+            task: 任务对象
+            
+        Returns:
+            str: 结果文件路径
+        """
+        df, _ = self.excel_service.get_excel_data(task.schema_id)
+        row_indexes = task.row_indexes if task.row_indexes is not None else range(len(df))
+        succeeded, failed = TaskLog.get_row_results(task.id)
+        
+        if task.parent_task_id:
+            # 重试任务的结果合并回原任务的结果文件
+            result_file = self._merge_retry_results(task, df)
+        else:
+            result_column = [None] * len(df)
+            for row_index, error_message in failed.items():
+                if 0 <= row_index < len(df):
+                    result_column[row_index] = f"处理错误: {error_message}"
+            for row_index, response_text in succeeded.items():
+                if 0 <= row_index < len(df):
+                    result_column[row_index] = response_text
+            
+            result_file = os.path.join(
+                self.result_folder,
+                str(task.id),
+                f"result_{datetime.now().strftime('%Y%m%d%H%M%S')}.xlsx"
+            )
+            self.excel_service.save_result(df, result_column, result_file)
+        
+        task.success_count = sum(1 for i in row_indexes if i in succeeded)
+        task.error_count = sum(1 for i in row_indexes if i in failed)
+        task.processed_count = task.success_count + task.error_count
+        task.status = Task.STATUS_COMPLETED
+        task.completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        task.result_path = result_file
+        task.save()
+        
+        logger.info(f"任务 {task.id} 已完成，结果保存到: {result_file}")
+        return result_file
+    
+    def _merge_retry_results(self, task, df):
+        """
+        将重试任务的结果与原任务已成功的结果合并，生成原任务的新结果文件并更新其统计
+        
+        Args:
+            task: 已完成的重试任务
+            df: 任务数据DataFrame
+            
+        Returns:
+            str: 合并后的结果文件路径
+        """
+        parent = Task.get_by_id(task.parent_task_id)
+        if not parent:
+            raise ValueError(f"找不到ID为{task.parent_task_id}的原任务")
+        
+        # 原任务及其所有重试任务的日志中，成功结果优先，其余行保留最近一次的错误信息
+        succeeded, failed = TaskLog.get_row_results(parent.id, include_retries=True)
+        result_column = [None] * len(df)
+        for row_index, error_message in failed.items():
+            if 0 <= row_index < len(df):
+                result_column[row_index] = f"处理错误: {error_message}"
+        for row_index, response_text in succeeded.items():
+            if 0 <= row_index < len(df):
+                result_column[row_index] = response_text
+        
+        result_file = os.path.join(
+            self.result_folder,
+            str(parent.id),
+            f"result_{datetime.now().strftime('%Y%m%d%H%M%S')}_retry{task.id}.xlsx"
+        )
+        self.excel_service.save_result(df, result_column, result_file)
+        
+        # 更新原任务的结果文件和成功/失败统计
+        parent.result_path = result_file
+        parent.success_count = len(succeeded)
+        parent.error_count = max(0, parent.processed_count - parent.success_count)
+        parent.save()
+        
+        return result_file
+    
+    def _config_concurrency_limit(self, config):
+        """
+        计算调度器中API配置的在途请求上限
+        
+        启用自适应并发的配置使用AIMD控制器的当前上限，
+        其最大值为配置的max_concurrency（未设置时为全局上限）
+        
+        Args:
+            config: API配置对象
+            
+        Returns:
+            int: 在途请求上限（0表示不限制）
+        """
+        if config.adaptive_concurrency:
+            max_limit = config.max_concurrency or self.scheduler.global_limit
+            return self.llm_service.adaptive_limits.get(config.id, max_limit).limit
+        return config.max_concurrency
+    
+    def _run_thread_engine(self, task, rows, row_indexes, stop_event, progress):
+        """
+        使用线程池处理任务的指定行（默认执行引擎）
+        
+        Args:
+            task: 任务对象
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            stop_event: 停止事件
+            progress: 任务进度计数器
+        """
+        task_id = task.id
+        
+        # 创建任务队列
+        task_queue = queue.Queue()
+        self.task_queues[task_id] = task_queue
+        
+        # 添加待处理的行到队列（合并请求时每项是一组行）
+        for unit in self._pack_units(task, row_indexes):
+            task_queue.put(unit)
+        
+        # 创建线程池
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=task.concurrency)
+        self.task_executors[task_id] = executor
+        
+        # 在途窗口：保持线程池中最多有并发数两倍的行（正在处理或排队），完成一行补充一行
+        window = max(1, task.concurrency * 2)
+        pending = {}  # future -> 行索引
+        budget = self.task_budgets.get(task_id)
+        
+        while pending or (not task_queue.empty() and not stop_event.is_set() and not (budget and budget.paused)):
+            # 接近预算时按剩余预算缩小在途窗口，用完预算后不再派发，等待在途行完成后暂停
+            limit = window
+            if budget is not None:
+                limit = budget.allowed_in_flight(window)
+                if not limit and not task_queue.empty():
+                    budget.pause(task_id)
+            
+            # 补满在途窗口
+            while len(pending) < limit and not task_queue.empty() and not stop_event.is_set():
+                row_index = task_queue.get()
+                if isinstance(row_index, list):
+                    future = executor.submit(self._process_pack, task, rows, row_index, stop_event)
+                else:
+                    future = executor.submit(
+                        self._process_row,
+                        task,
+                        rows.row(row_index),
+                        row_index,
+                        stop_event
+                    )
+                pending[future] = row_index
+            
+            # 阻塞等待任意一行完成，超时只用于定期检查停止事件
+            done, _ = concurrent.futures.wait(
+                pending, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            
+            # 按完成顺序记录结果
+            for future in done:
+                self._record_unit_outcome(task, pending.pop(future), future, progress)
+            
+            if stop_event.is_set():
+                break
+        
+        # 关闭线程池：任务被停止时取消尚未开始的行，并等待正在调用API的行结束（它们仍会写入日志）。
+        # 任务线程在此之前退出的话，续跑会把这些行再发送一次
+        executor.shutdown(wait=True, cancel_futures=True)
+        
+        # 记录停止时仍在途的行的结果，使保存的进度与任务日志一致
+        for future, index in pending.items():
+            if not future.cancelled():
+                self._record_unit_outcome(task, index, future, progress)
+    
+    def _record_unit_outcome(self, task, index, future, progress):
+        """
+        记录线程池中完成的一行（或一组合并请求）的结果并更新进度
+        
+        Args:
+            task: 任务对象
+            index: 行索引（合并请求时为该组的行索引列表）
+            future: _process_row或_process_pack的Future
+            progress: 任务进度计数器
+        """
+        if isinstance(index, list):
+            self._record_pack_outcomes(task, index, future, progress)
+            return
+        try:
+            result, is_success = future.result()
+            if is_success is None:
+                # 任务停止或剩余预算不足而放弃的行，没有日志，续跑时处理
+                return
+            task.result_column[index] = result
+        except Exception as e:
+            logger.error(f"处理行 {index} 结果时出错: {str(e)}")
+            is_success = False
+        
+        # 更新任务进度
+        progress.record(is_success)
+    
+    def _order_longest_first(self, task, rows, row_indexes):
+        """
+        按预估耗时从高到低排列待处理的行，预估耗时相同的行保持文件顺序
+        
+        每行的预估耗时为提示词的预估token数加上图片字段中非空图片的预估token数，
+        耗时长的行先发出，与耗时短的行重叠执行，缩短任务末尾只剩少数慢行的时间
+        
+        Args:
+            task: 任务对象（prompts为批量渲染的提示词）
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            
+        Returns:
+            list: 排序后的行索引
+        """
+        image_tokens = current_app.config.get('IMAGE_TOKEN_ESTIMATE', 765)
+        
+        def cost(row_index):
+            if task.prompts is not None:
+                prompt = task.prompts[row_index]
+            else:
+                prompt = self.excel_service.process_template(task.prompt_template, rows.row(row_index))
+            tokens = self.llm_service.estimate_prompt_tokens(prompt)
+            if task.image_fields:
+                row_data = rows.row(row_index)
+                tokens += image_tokens * sum(
+                    1 for field in task.image_fields
+                    if not pd.isna(row_data.get(field)) and str(row_data.get(field)).strip()
+                )
+            return tokens
+        
+        costs = {row_index: cost(row_index) for row_index in row_indexes}
+        ordered = sorted(row_indexes, key=lambda row_index: -costs[row_index])
+        if ordered:
+            logger.info(
+                f"任务 {task.id} 按预估耗时排序 {len(ordered)} 行，"
+                f"预估token数最多 {costs[ordered[0]]}，最少 {costs[ordered[-1]]}"
+            )
+        return ordered
+    
+    def _pack_units(self, task, row_indexes):
+        """
+        按任务的合并行数把待处理的行分组
+        
+        Args:
+            task: 任务对象
+            row_indexes: 需要处理的行索引
+            
+        Returns:
+            iterable: 逐行请求时为行索引本身，合并请求时为行索引列表
+        """
+        if task.pack_size <= 1:
+            return row_indexes
+        row_indexes = list(row_indexes)
+        return [row_indexes[i:i + task.pack_size] for i in range(0, len(row_indexes), task.pack_size)]
+    
+    def _record_pack_outcomes(self, task, row_indexes, future, progress):
+        """
+        记录一组合并请求的各行结果并更新进度
+        
+        Args:
+            task: 任务对象
+            row_indexes: 该组的行索引
+            future: _process_pack或_process_pack_async的结果
+            progress: 任务进度计数器
+        """
+        try:
+            outcomes = future.result()
+        except Exception as e:
+            logger.error(f"处理行 {row_indexes[0]}-{row_indexes[-1]} 结果时出错: {str(e)}")
+            outcomes = [(index, f"处理错误: {str(e)}", False) for index in row_indexes]
+        for index, result, is_success in outcomes:
+            task.result_column[index] = result
+            progress.record(is_success)
+    
+    def _build_pack(self, task, rows, row_indexes):
+        """
+        构建一组行的合并请求提示词
+        
+        Returns:
+            str: 合并后的提示词
+        """
+        compiled = self.excel_service.compile_template(task.prompt_template)
+        records = [(row_index, compiled.field_values(rows.row(row_index))) for row_index in row_indexes]
+        return build_pack_prompt(task.prompt_template, records)
+    
+    def _record_pack_results(self, task, row_indexes, prompt, results, token_count, processing_time,
+                             completion_tokens=None):
+        """
+        写入从合并请求中拆分出结果的各行日志，并记录合并请求统计
+        
+        合并请求的token数和输出token数平均分摊到拆分出结果的各行（余数计入第一行）
+        
+        Args:
+            task: 任务对象
+            row_indexes: 该组的行索引
+            prompt: 合并请求的提示词
+            results: 行索引 -> 结果文本
+            token_count: 合并请求的token数
+            processing_time: 合并请求的处理时间
+            completion_tokens: 合并请求的输出token数（服务商没有返回时为None）
+            
+        Returns:
+            list: [(行索引, 结果, 是否成功)]
+        """
+        outcomes = []
+        packed = [row_index for row_index in row_indexes if row_index in results]
+        share, remainder = divmod(token_count, len(packed)) if packed else (0, 0)
+        completion_share, completion_remainder = (
+            divmod(completion_tokens, len(packed)) if packed and completion_tokens is not None else (None, 0)
+        )
+        for position, row_index in enumerate(packed):
+            log = TaskLog(
+                task_id=task.id,
+                row_index=row_index,
+                status=TaskLog.STATUS_SUCCESS,
+                processing_time=processing_time,
+                token_count=share + (remainder if position == 0 else 0),
+                response_text=results[row_index],
+                completion_tokens=(
+                    completion_share + (completion_remainder if position == 0 else 0)
+                    if completion_share is not None else None
+                )
+            )
+            self.log_writer.write(log)
+            outcomes.append((row_index, results[row_index], True))
+        
+        stats = self.task_packing.get(task.id)
+        if stats is not None:
+            if completion_tokens is None:
+                # 服务商没有返回输出token数时，按实际token数减去合并请求的预估提示词token数估算
+                completion_tokens = token_count - self.llm_service.estimate_prompt_tokens(prompt)
+            stats.record_pack(row_indexes, packed, token_count, completion_tokens)
+        return outcomes
+    
+    def _row_prompt_tokens(self, task, rows, row_indexes):
+        """
+        预估各行单独请求时的提示词token数（多行合并请求统计使用，任务开始时计算一次）
+        
+        Args:
+            task: 任务对象（prompts为批量渲染的提示词）
+            rows: 任务数据的行访问器
+            row_indexes: 需要处理的行索引
+            
+        Returns:
+            dict: 行索引 -> 预估提示词token数
+        """
+        return {
+            row_index: self.llm_service.estimate_prompt_tokens(
+                task.prompts[row_index] if task.prompts is not None
+                else self.excel_service.process_template(task.prompt_template, rows.row(row_index))
+            )
+            for row_index in row_indexes
+        }
+    
+    def _process_pack(self, task, rows, row_indexes, stop_event=None):
+        """
+        把一组行合并为一个LLM请求处理，响应无法拆分的行回退为逐行请求
+        
+        Args:
+            task: 任务对象
+            rows: 任务数据的行访问器
+            row_indexes: 该组的行索引
+            stop_event: 任务停止事件
+            
+        Returns:
+            list: [(行索引, 处理结果, 是否成功)]，任务停止时放弃的行不包含在内
+        """
+        with self.app.app_context():
+            prompt = self._build_pack(task, rows, row_indexes)
+            results = {}
+            token_count = processing_time = 0
+            completion_tokens = None
+            try:
+                response_text, token_count, completion_tokens, processing_time, _ = self._call_llm(
+                    task, prompt, None, stop_event, row_count=len(row_indexes)
+                )
+                results = parse_pack_response(response_text, row_indexes)
+            except SlotCancelled:
+                return []
+            except Exception as e:
+                logger.warning(f"行 {row_indexes[0]}-{row_indexes[-1]} 的合并请求失败，改为逐行请求: {str(e)}")
+            
+            outcomes = self._record_pack_results(
+                task, row_indexes, prompt, results, token_count, processing_time, completion_tokens
+            )
+            
+            # 响应中缺少的行逐行请求
+            for row_index in row_indexes:
+                if row_index in results:
+                    continue
+                if stop_event is not None and stop_event.is_set():
+                    break
+                result, is_success = self._process_row(task, rows.row(row_index), row_index, stop_event)
+                if is_success is not None:
+                    outcomes.append((row_index, result, is_success))
+            return outcomes
+    
+    async def _process_pack_async(self, task, rows, row_indexes):
+        """
+        _process_pack的协程版本（asyncio执行引擎使用）
+        
+        Returns:
+            list: [(行索引, 处理结果, 是否成功)]
+        """
+        prompt = self._build_pack(task, rows, row_indexes)
+        results = {}
+        token_count = processing_time = 0
+        completion_tokens = None
+        try:
+            response_text, token_count, completion_tokens, processing_time, _ = await self._call_llm_async(
+                task, prompt, None, row_count=len(row_indexes)
+            )
+            results = parse_pack_response(response_text, row_indexes)
+        except asyncio.CancelledError:
+            raise
+        except SlotCancelled:
+            return []
+        except Exception as e:
+            logger.warning(f"行 {row_indexes[0]}-{row_indexes[-1]} 的合并请求失败，改为逐行请求: {str(e)}")
+        
+        outcomes = self._record_pack_results(
+            task, row_indexes, prompt, results, token_count, processing_time, completion_tokens
+        )
+        
+        for row_index in row_indexes:
+            if row_index in results:
+                continue
+            result, is_success = await self._process_row_async(task, rows.row(row_index), row_index)
+            if is_success is not None:
+                outcomes.append((row_index, result, is_success))
+        return outcomes
+    
+    def _process_row(self, task, row_data, row_index, stop_event=None):
+        """
+        处理单行数据
+        
+        Args:
+            task: 任务对象
             row_data: 行数据
-            prompt_template: 提示词模板
-            image_fields: 图片字段列表
             row_index: 行索引
+            stop_event: 任务停止事件
             
         Returns:
             tuple: (处理结果, 是否成功)
         """
+        task_id = task.id
+        prompt_template = task.prompt_template
+        image_fields = task.image_fields
+        
         # 在应用上下文中执行数据库操作
         with self.app.app_context():
             try:
@@ -340,7 +1309,7 @@ class TaskService:
                     logger.warning(error_msg)
                     log.status = TaskLog.STATUS_ERROR
                     log.error_message = error_msg
-                    log.save()
+                    self.log_writer.write(log)
                     return error_msg, False
                 
                 # 处理空值行
@@ -353,8 +1322,11 @@ class TaskService:
                 if not has_valid_data:
                     logger.warning(f"行 {row_index} 所有字段均为空值")
                 
-                # 处理提示词模板
-                prompt = self.excel_service.process_template(prompt_template, row_data)
+                # 处理提示词模板（任务开始时已批量渲染的直接使用）
+                if task.prompts is not None:
+                    prompt = task.prompts[row_index]
+                else:
+                    prompt = self.excel_service.process_template(prompt_template, row_data)
                 
                 # 处理图片数据
                 image_data = None
@@ -364,18 +1336,25 @@ class TaskService:
                     except Exception as e:
                         logger.warning(f"处理图片数据时出错: {str(e)}")
                 
-                # 调用LLM API
-                response_text, token_count, processing_time = self.llm_service.call_api(prompt, image_data)
+                # 调用LLM API（同一任务中相同的请求只调用一次）
+                response_text, token_count, completion_tokens, processing_time, deduplicated = self._call_llm(
+                    task, prompt, image_data, stop_event
+                )
                 
                 # 记录日志
                 log.status = TaskLog.STATUS_SUCCESS
                 log.processing_time = processing_time
                 log.token_count = token_count
+                log.completion_tokens = completion_tokens
                 log.response_text = response_text  # 保存处理结果到日志中
-                log.save()
+                log.deduplicated = deduplicated
+                self.log_writer.write(log)
                 
                 return response_text, True
                 
+            except SlotCancelled:
+                # 任务已停止或剩余预算不足（BudgetExhausted），放弃该行且不记录日志，不计入进度，续跑时处理
+                return None, None
             except Exception as e:
                 logger.error(f"处理行 {row_index} 时出错: {str(e)}")
                 
@@ -387,12 +1366,342 @@ class TaskService:
                         status=TaskLog.STATUS_ERROR,
                         error_message=str(e)
                     )
-                    log.save()
+                    self.log_writer.write(log)
                 except Exception as inner_e:
                     logger.error(f"记录错误日志失败: {str(inner_e)}")
                 
                 return f"处理错误: {str(e)}", False
     
+    def _call_llm(self, task, prompt, image_data, stop_event=None, row_count=1):
+        """
+        从全局调度器获取槽位后调用LLM API
+        
+        任务启用了请求去重时，相同的请求只有第一个实际调用，同时到达的相同请求等待其结果，
+        之后到达的直接复用已成功的响应（不占用调度器槽位，token数记为0）。
+        任务设置了预算时，实际调用前按预估用量预约预算，剩余预算不足时抛出BudgetExhausted；
+        调用结束后立即按实际用量结算预约（不等任务日志写入）
+        
+        Args:
+            task: 任务对象
+            prompt: 提示词
+            image_data: 图片数据
+            stop_event: 停止事件
+            row_count: 请求包含的行数（多行合并请求）
+            
+        Returns:
+            tuple: (响应文本, token数, 输出token数（服务商没有返回时为None）, 处理时间, 是否复用了相同请求的响应)
+        """
+        coalescer = self.task_dedup.get(task.id)
+        if coalescer is not None:
+            key = coalescer.key_for(prompt, image_data)
+            future, is_leader = coalescer.join(key)
+            if not is_leader:
+                start_time = time.time()
+                response_text = future.result()[0]
+                return response_text, 0, 0, time.time() - start_time, True
+        
+        budget = self.task_budgets.get(task.id)
+        reservation = None
+        on_hedge_usage = self._hedge_usage_callback(budget, row_count)
+        try:
+            if budget is not None:
+                reservation = self._reserve_budget(budget, task.id, row_count, stop_event)
+            if task.id in self.task_routing:
+                result = self._call_llm_pool(task, prompt, image_data, stop_event, on_hedge_usage)
+            else:
+                lease = SlotLease(self.scheduler, task.id)
+                lease.acquire(stop_event)
+                try:
+                    result = self.llm_service.call_api(
+                        prompt, image_data, task.api_config_id, self.task_cache_stats.get(task.id),
+                        lease=lease, on_hedge_usage=on_hedge_usage, stop_event=stop_event
+                    )
+                finally:
+                    lease.release()
+        except BaseException as e:
+            if reservation is not None:
+                budget.settle(reservation)
+            if coalescer is not None:
+                coalescer.fail(key, future, e)
+            raise
+        
+        if reservation is not None:
+            # 释放预约的同时计入实际用量，其他请求预约时不会基于偏低的已用量
+            budget.settle(reservation, result[1], result[2], row_count)
+        
+        if coalescer is not None:
+            coalescer.resolve(key, future, result)
+        response_text, token_count, completion_tokens, processing_time = result
+        return response_text, token_count, completion_tokens, processing_time, False
+    
+    async def _call_llm_async(self, task, prompt, image_data, row_count=1):
+        """
+        _call_llm的协程版本（asyncio执行引擎使用）
+        
+        Returns:
+            tuple: (响应文本, token数, 输出token数（服务商没有返回时为None）, 处理时间, 是否复用了相同请求的响应)
+        """
+        coalescer = self.task_dedup.get(task.id)
+        if coalescer is not None:
+            key = coalescer.key_for(prompt, image_data)
+            future, is_leader = coalescer.join(key)
+            if not is_leader:
+                start_time = time.time()
+                # shield：等待方被取消时不取消共享的结果
+                response_text = (await asyncio.shield(asyncio.wrap_future(future)))[0]
+                return response_text, 0, 0, time.time() - start_time, True
+        
+        budget = self.task_budgets.get(task.id)
+        reservation = None
+        on_hedge_usage = self._hedge_usage_callback(budget, row_count)
+        try:
+            if budget is not None:
+                reservation = await self._reserve_budget_async(budget, task.id, row_count)
+            if task.id in self.task_routing:
+                result = await self._call_llm_pool_async(task, prompt, image_data, on_hedge_usage)
+            else:
+                lease = SlotLease(self.scheduler, task.id)
+                await lease.acquire_async()
+                try:
+                    result = await self.llm_service.call_api_async(
+                        prompt, image_data, task.api_config_id, self.task_cache_stats.get(task.id),
+                        lease=lease, on_hedge_usage=on_hedge_usage
+                    )
+                finally:
+                    lease.release()
+        except BaseException as e:
+            if reservation is not None:
+                budget.settle(reservation)
+            if coalescer is not None:
+                coalescer.fail(key, future, e)
+            raise
+        
+        if reservation is not None:
+            # 释放预约的同时计入实际用量，其他请求预约时不会基于偏低的已用量
+            budget.settle(reservation, result[1], result[2], row_count)
+        
+        if coalescer is not None:
+            coalescer.resolve(key, future, result)
+        response_text, token_count, completion_tokens, processing_time = result
+        return response_text, token_count, completion_tokens, processing_time, False
+    
+    def _hedge_usage_callback(self, budget, row_count):
+        """
+        对冲中落后的请求结束时将其实际用量计入任务预算（返回的响应只结算胜出的一方）
+        
+        Returns:
+            function: 传给call_api的on_hedge_usage，任务没有设置预算时返回None
+        """
+        if budget is None:
+            return None
+        return lambda token_count, completion_tokens: budget.settle(None, token_count, completion_tokens, row_count)
+    
+    def _reserve_budget(self, budget, task_id, row_count, stop_event=None):
+        """
+        预约任务预算，在途请求的预约占用了剩余预算时等待其结束
+        
+        Returns:
+            tuple: 预约，请求结束后传给budget.settle
+        """
+        while True:
+            reservation = budget.try_reserve(task_id, row_count)
+            if reservation is not None:
+                return reservation
+            if stop_event is None:
+                time.sleep(0.05)
+            elif stop_event.wait(0.05):
+                raise SlotCancelled(f"任务 {task_id} 已停止")
+    
+    async def _reserve_budget_async(self, budget, task_id, row_count):
+        """_reserve_budget的协程版本（asyncio执行引擎使用）"""
+        while True:
+            reservation = budget.try_reserve(task_id, row_count)
+            if reservation is not None:
+                return reservation
+            await asyncio.sleep(0.05)
+    
+    def _call_llm_pool(self, task, prompt, image_data, stop_event=None, on_hedge_usage=None):
+        """
+        在API配置池中调用LLM API，失败时换用其他配置重试
+        
+        每次尝试由调度器在授予槽位时选择配置（加权最少在途请求，跳过被移出配置池的配置），
+        并尽量避开本次请求已经失败过的配置；池中的配置都失败过后等待API_RETRY_DELAY秒再从头开始。
+        最多尝试API_RETRY_COUNT次（至少把池中每个配置都尝试一次）。
+        配置启用了对冲请求时，对冲请求发往池中的另一个配置。
+        
+        Returns:
+            tuple: (响应文本, token数, 输出token数, 处理时间)
+        """
+        routing = self.task_routing[task.id]
+        retry_delay = current_app.config.get('API_RETRY_DELAY', 2)
+        attempts = max(current_app.config.get('API_RETRY_COUNT', 3), len(task.api_config_ids))
+        start_time = time.time()
+        tried = set()
+        
+        for attempt in range(attempts):
+            if len(tried) >= len(task.api_config_ids):
+                tried.clear()
+                if stop_event is None:
+                    time.sleep(retry_delay)
+                elif stop_event.wait(retry_delay):
+                    raise SlotCancelled(f"任务 {task.id} 已停止")
+            
+            lease = SlotLease(self.scheduler, task.id)
+            slot = lease.acquire(stop_event, exclude=tried)
+            hedge_config_id = self.scheduler.pick_config(task.id, {slot.config_id})
+            attempt_start = time.time()
+            try:
+                response_text, token_count, completion_tokens, _ = self.llm_service.call_api(
+                    prompt, image_data, slot.config_id, self.task_cache_stats.get(task.id), max_attempts=1,
+                    hedge_config_id=hedge_config_id, lease=lease, on_hedge_usage=on_hedge_usage,
+                    stop_event=stop_event
+                )
+            except SlotCancelled:
+                raise
+            except Exception as e:
+                routing.record(slot.config_id, False, latency=time.time() - attempt_start)
+                tried.add(slot.config_id)
+                if attempt == attempts - 1:
+                    raise
+                logger.warning(f"任务 {task.id} 使用API配置 {slot.config_id} 调用失败，换用配置池中的其他配置重试: {str(e)}")
+                continue
+            finally:
+                lease.release()
+            
+            routing.record(slot.config_id, True, token_count, time.time() - attempt_start)
+            return response_text, token_count, completion_tokens, time.time() - start_time
+    
+    async def _call_llm_pool_async(self, task, prompt, image_data, on_hedge_usage=None):
+        """
+        _call_llm_pool的协程版本（asyncio执行引擎使用）
+        
+        Returns:
+            tuple: (响应文本, token数, 输出token数, 处理时间)
+        """
+        routing = self.task_routing[task.id]
+        retry_delay = current_app.config.get('API_RETRY_DELAY', 2)
+        attempts = max(current_app.config.get('API_RETRY_COUNT', 3), len(task.api_config_ids))
+        start_time = time.time()
+        tried = set()
+        
+        for attempt in range(attempts):
+            if len(tried) >= len(task.api_config_ids):
+                tried.clear()
+                await asyncio.sleep(retry_delay)
+            
+            lease = SlotLease(self.scheduler, task.id)
+            slot = await lease.acquire_async(exclude=tried)
+            hedge_config_id = self.scheduler.pick_config(task.id, {slot.config_id})
+            attempt_start = time.time()
+            try:
+                response_text, token_count, completion_tokens, _ = await self.llm_service.call_api_async(
+                    prompt, image_data, slot.config_id, self.task_cache_stats.get(task.id), max_attempts=1,
+                    hedge_config_id=hedge_config_id, lease=lease, on_hedge_usage=on_hedge_usage
+                )
+            except SlotCancelled:
+                raise
+            except Exception as e:
+                routing.record(slot.config_id, False, latency=time.time() - attempt_start)
+                tried.add(slot.config_id)
+                if attempt == attempts - 1:
+                    raise
+                logger.warning(f"任务 {task.id} 使用API配置 {slot.config_id} 调用失败，换用配置池中的其他配置重试: {str(e)}")
+                continue
+            finally:
+                lease.release()
+            
+            routing.record(slot.config_id, True, token_count, time.time() - attempt_start)
+            return response_text, token_count, completion_tokens, time.time() - start_time
+    
+    async def _process_row_async(self, task, row_data, row_index, http_client=None):
+        """
+        处理单行数据（asyncio执行引擎使用）
+        
+        与_process_row语义一致：渲染模板、获取图片、调用LLM并写入任务日志，
+        区别在于图片下载和LLM调用以协程方式等待，不占用线程
+        
+        Args:
+            task: 任务对象
+            row_data: 行数据
+            row_index: 行索引
+            http_client: 下载图片使用的httpx.AsyncClient
+            
+        Returns:
+            tuple: (处理结果, 是否成功)
+        """
+        task_id = task.id
+        prompt_template = task.prompt_template
+        image_fields = task.image_fields
+        
+        try:
+            log = TaskLog(task_id=task_id, row_index=row_index)
+            
+            # 检查行数据是否有效
+            if row_data is None or not isinstance(row_data, dict) or len(row_data) == 0:
+                error_msg = f"行 {row_index} 数据无效或为空"
+                logger.warning(error_msg)
+                log.status = TaskLog.STATUS_ERROR
+                log.error_message = error_msg
+                self.log_writer.write(log)
+                return error_msg, False
+            
+            # 处理空值行
+            if all(value is None or (isinstance(value, str) and value.strip() == "") for value in row_data.values()):
+                logger.warning(f"行 {row_index} 所有字段均为空值")
+            
+            # 处理提示词模板（任务开始时已批量渲染的直接使用）
+            if task.prompts is not None:
+                prompt = task.prompts[row_index]
+            else:
+                prompt = self.excel_service.process_template(prompt_template, row_data)
+            
+            # 处理图片数据
+            image_data = None
+            if image_fields and http_client is not None:
+                try:
+                    image_data = await self.image_service.extract_image_data_from_row_async(
+                        row_data, image_fields, http_client
+                    )
+                except Exception as e:
+                    logger.warning(f"处理图片数据时出错: {str(e)}")
+            
+            # 调用LLM API（同一任务中相同的请求只调用一次）
+            response_text, token_count, completion_tokens, processing_time, deduplicated = await self._call_llm_async(
+                task, prompt, image_data
+            )
+            
+            # 记录日志
+            log.status = TaskLog.STATUS_SUCCESS
+            log.processing_time = processing_time
+            log.token_count = token_count
+            log.completion_tokens = completion_tokens
+            log.response_text = response_text
+            log.deduplicated = deduplicated
+            self.log_writer.write(log)
+            
+            return response_text, True
+            
+        except asyncio.CancelledError:
+            # 任务被停止，不记录日志
+            raise
+        except SlotCancelled:
+            return None, None
+        except Exception as e:
+            logger.error(f"处理行 {row_index} 时出错: {str(e)}")
+            
+            try:
+                log = TaskLog(
+                    task_id=task_id,
+                    row_index=row_index,
+                    status=TaskLog.STATUS_ERROR,
+                    error_message=str(e)
+                )
+                self.log_writer.write(log)
+            except Exception as inner_e:
+                logger.error(f"记录错误日志失败: {str(inner_e)}")
+            
+            return f"处理错误: {str(e)}", False
+    
     def stop_task(self, task_id):
         """
         停止正在运行的任务
@@ -402,24 +1711,32 @@ class TaskService:
         """
         try:
             if task_id not in self.running_tasks:
+                # worker引擎的任务不在本进程中运行，更新状态后Worker进程会在心跳时停止处理
+                task = Task.get_by_id(task_id)
+                if task and task.engine == Task.ENGINE_WORKER and task.status == Task.STATUS_RUNNING:
+                    Task.set_status(task_id, Task.STATUS_STOPPED)
+                    logger.info(f"任务 {task_id} 已停止")
+                    return
                 raise ValueError(f"任务 {task_id} 未在运行")
             
             # 设置停止事件
             if task_id in self.task_stop_events:
                 self.task_stop_events[task_id].set()
             
-            # 关闭线程池
+            # 释放调度器中等待的请求
+            self.scheduler.unregister_task(task_id)
+            
+            # 关闭线程池（取消尚未开始的行，正在处理的行由任务线程等待其结束）
             if task_id in self.task_executors:
-                self.task_executors[task_id].shutdown(wait=False)
+                self.task_executors[task_id].shutdown(wait=False, cancel_futures=True)
             
             # 等待一段时间，让任务有机会清理
             time.sleep(1)
             
-            # 强制更新任务状态
+            # 强制更新任务状态（只更新状态列，避免用数据库中较旧的进度覆盖内存中的计数）
             task = Task.get_by_id(task_id)
             if task and task.status == Task.STATUS_RUNNING:
-                task.status = Task.STATUS_STOPPED
-                task.save()
+                Task.set_status(task_id, Task.STATUS_STOPPED)
             
             logger.info(f"任务 {task_id} 已停止")
             
@@ -430,15 +1747,143 @@ class TaskService:
                 del self.task_queues[task_id]
             if task_id in self.running_tasks:
                 del self.running_tasks[task_id]
-            if task_id in self.task_threads:
-                del self.task_threads[task_id]
             if task_id in self.task_stop_events:
                 del self.task_stop_events[task_id]
+            # 任务线程记录由线程退出时自行清理
             
         except Exception as e:
             logger.error(f"停止任务 {task_id} 时出错: {str(e)}")
             raise
     
+    def retry_failed_rows(self, task_id, api_config_id=None, concurrency=None):
+        """
+        为任务中处理失败的行创建并启动一个重试任务
+        
+        重试任务只处理原任务（及其之前的重试任务）中失败且从未成功的行，
+        完成后结果合并回原任务的结果文件，已成功的行保持不变
+        
+        Args:
+            task_id: 原任务ID（传入重试任务ID时使用其原任务）
+            api_config_id: 重试使用的API配置ID（为None则沿用原任务的配置或API配置池）
+            concurrency: 重试的并发数（为None则沿用原任务的并发数）
+            
+        Returns:
+            int: 重试任务ID
+        """
+        try:
+            task = Task.get_by_id(task_id)
+            if not task:
+                raise ValueError(f"找不到ID为{task_id}的任务")
+            if task.parent_task_id:
+                task = Task.get_by_id(task.parent_task_id)
+                if not task:
+                    raise ValueError(f"找不到任务 {task_id} 的原任务")
+            
+            # 原任务及其重试任务都不能处于运行中
+            family = [task] + task.get_retry_tasks()
+            for member in family:
+                if self._is_task_active(member):
+                    raise ValueError(f"任务 {member.id} 正在运行，请等待其结束后再重试")
+            
+            _, failed = TaskLog.get_row_results(task.id, include_retries=True)
+            row_indexes = sorted(failed)
+            if not row_indexes:
+                raise ValueError(f"任务 {task.id} 没有需要重试的失败行")
+            
+            if api_config_id:
+                self.llm_service.resolve_api_config(api_config_id)
+            
+            retry_task = Task(
+                name=f"{task.name}-重试失败行",
+                schema_id=task.schema_id,
+                prompt_template=task.prompt_template,
+                total_count=len(row_indexes),
+                concurrency=int(concurrency or task.concurrency),
+                image_fields=task.image_fields,
+                engine=task.engine,
+                api_config_id=api_config_id or task.api_config_id,
+                weight=task.weight,
+                parent_task_id=task.id,
+                row_indexes=row_indexes,
+                pack_size=task.pack_size,
+                row_order=task.row_order,
+                token_budget=task.token_budget,
+                cost_budget=task.cost_budget,
+                # 指定了重试使用的API配置时不再使用原任务的配置池
+                api_config_ids=[] if api_config_id else task.api_config_ids
+            )
+            retry_task_id = retry_task.save()
+            logger.info(f"为任务 {task.id} 创建重试任务 {retry_task_id}，失败行数: {len(row_indexes)}")
+            
+            self.start_task(retry_task_id)
+            return retry_task_id
+            
+        except Exception as e:
+            logger.error(f"重试任务 {task_id} 的失败行时出错: {str(e)}")
+            raise
+    
+    def _is_task_active(self, task):
+        """
+        判断任务是否正在运行
+        
+        worker引擎的任务由独立进程处理，状态为running即视为运行中（Worker崩溃后由租约机制恢复）
+        
+        Args:
+            task: 任务对象
+            
+        Returns:
+            bool: 是否正在运行
+        """
+        if task.id in self.running_tasks:
+            return True
+        return task.engine == Task.ENGINE_WORKER and task.status == Task.STATUS_RUNNING
+    
+    def resume_task(self, task_id, token_budget=None, cost_budget=None):
+        """
+        续跑已停止、出错、因用完预算而暂停或因进程退出而中断的任务
+        
+        已有成功日志的行直接使用日志中的结果，只重新处理缺失或失败的行
+        
+        Args:
+            task_id: 任务ID
+            token_budget: 新的token预算（为None则保持不变），已消耗的token数计入新预算
+            cost_budget: 新的费用预算（为None则保持不变），已花费的费用计入新预算
+        """
+        try:
+            if task_id in self.running_tasks:
+                raise ValueError(f"任务 {task_id} 已经在运行")
+            
+            thread = self.task_threads.get(task_id)
+            if thread is not None and thread.is_alive():
+                raise ValueError(f"任务 {task_id} 正在停止，请稍后再试")
+            
+            task = Task.get_by_id(task_id)
+            if not task:
+                raise ValueError(f"找不到ID为{task_id}的任务")
+            
+            if self._is_task_active(task):
+                raise ValueError(f"任务 {task_id} 已经在运行")
+            
+            # 状态为running但不在本进程中运行的任务，说明上次运行时进程已退出
+            resumable = (Task.STATUS_STOPPED, Task.STATUS_ERROR, Task.STATUS_PAUSED, Task.STATUS_RUNNING)
+            if task.status not in resumable:
+                raise ValueError(f"任务 {task_id} 当前状态为 {task.status}，无法续跑")
+            
+            if token_budget is not None or cost_budget is not None:
+                task.token_budget, task.cost_budget = self._validate_budget(
+                    task.token_budget if token_budget is None else token_budget,
+                    task.cost_budget if cost_budget is None else cost_budget,
+                    task.engine,
+                    self._resolve_task_configs(task.api_config_id, task.api_config_ids)
+                )
+                task.save()
+            
+            self.start_task(task_id, resume=True)
+            
+        except Exception as e:
+            logger.error(f"续跑任务 {task_id} 时出错: {str(e)}")
+            raise
+    
     def delete_task(self, task_id):
         """
         删除任务
@@ -474,6 +1919,10 @@ class TaskService:
                 except Exception as e:
                     logger.warning(f"删除任务目录时出错: {str(e)}")
             
+            # 删除响应缓存命中统计（缓存的响应仍可被其他任务复用）
+            if self.llm_service.response_cache is not None:
+                self.llm_service.response_cache.delete_task_stats(task_id)
+            
             # 删除任务记录
             task.delete()
             logger.info(f"任务 {task_id} 已删除")
@@ -497,8 +1946,82 @@ class TaskService:
             if not task:
                 raise ValueError(f"找不到ID为{task_id}的任务")
             
+            # 本进程中运行的任务直接读取内存中的实时进度（数据库中的计数按间隔更新）
+            progress = self.task_progress.get(task_id)
+            if progress:
+                counts = progress.snapshot()
+                task.processed_count = counts['processed_count']
+                task.success_count = counts['success_count']
+                task.error_count = counts['error_count']
+            
             task_dict = task.to_dict()
             
+            # 运行中的任务附带其在全局调度器中的份额
+            share = self.scheduler.get_task_share(task_id)
+            if share:
+                task_dict['scheduler'] = share
+            
+            # 使用API配置池的运行中任务附带各配置的吞吐量和健康状况
+            routing = self.get_routing_stats(task)
+            if routing:
+                task_dict['routing'] = routing
+            
+            # 运行中的任务读取内存中的多行合并请求统计
+            packing = self.task_packing.get(task_id)
+            if packing:
+                task_dict['pack_stats'] = packing.snapshot()
+            
+            # 预算的使用和剩余情况：运行中的任务读取内存中的实时用量，其余任务读取结束或暂停时保存的用量
+            budget = self.task_budgets.get(task_id)
+            if budget:
+                task_dict['budget'] = budget.snapshot()
+            elif task.budget_stats:
+                task_dict['budget'] = task.budget_stats
+            
+            # 请求去重统计：运行中的任务读取内存中的统计，其余任务按日志统计
+            coalescer = self.task_dedup.get(task_id)
+            if coalescer:
+                task_dict['dedup'] = coalescer.snapshot()
+            else:
+                total, deduplicated = TaskLog.get_dedup_summary(task_id)
+                if deduplicated:
+                    task_dict['dedup'] = {
+                        'unique_requests': total - deduplicated,
+                        'deduplicated': deduplicated,
+                        'ratio': round(deduplicated / total, 4)
+                    }
+            
+            # 响应缓存命中统计：已保存的统计加上运行中尚未保存的统计
+            cache_stats = self.get_cache_stats(task_id)
+            if cache_stats:
+                task_dict['response_cache'] = cache_stats
+            
+            # batch引擎的任务附带服务端批处理的状态
+            batches = self.batch_engine.get_task_batches(task_id)
+            if batches:
+                task_dict['batches'] = batches
+            
+            # worker引擎的任务附带队列进度
+            if task.engine == Task.ENGINE_WORKER:
+                jobs = TaskJob.get_task_summary(task_id)
+                if jobs:
+                    task_dict['jobs'] = jobs
+            
+            # 任务所用API配置的自适应并发上限及其变化历史、RPM/TPM限流状态和对冲请求统计
+            try:
+                config = self.llm_service.resolve_api_config(share['config_id'] if share else task.api_config_id)
+                controller = self.llm_service.adaptive_limits.peek(config.id)
+                if controller:
+                    task_dict['adaptive_concurrency'] = controller.snapshot()
+                rate_limit = self.llm_service.rate_limiter.snapshot(config)
+                if rate_limit:
+                    task_dict['rate_limit'] = rate_limit
+                hedging = self.llm_service.hedging.snapshot(config.id)
+                if hedging:
+                    task_dict['hedging'] = hedging
+            except ValueError:
+                pass
+            
             # 计算预计剩余时间
             if task.status == Task.STATUS_RUNNING and task.processed_count > 0:
                 if task.started_at:
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import logging
+import threading
+
+# 导入tiktoken（可选，安装且词表已缓存时使用BPE词表精确计数）
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+_CJK_CHARS = '\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_LETTERS = rf'[^\W\d_{_CJK_CHARS}]'
+
+# 每个片段按1个token计：中日韩字符（每字一个片段）、其余字母组成的单词、1-3位数字、连续的符号、换行和连续的空白
+# （单个空格并入后面的单词）
+_PIECES = re.compile(rf'[{_CJK_CHARS}]|{_LETTERS}+|\d{{1,3}}|(?:[^\s\w]|_)+|\s*[\r\n]\s*|[ \t]{{2,}}')
+# 长单词按每5个字母1个token切分，长符号串按每2个字符1个token切分，需要补充的token数单独计算
+_LONG_WORDS = re.compile(rf'{_LETTERS}{{8,}}')
+_LONG_SYMBOLS = re.compile(r'(?:[^\s\w]|_){3,}')
+
+
+def _estimate_tokens(text):
+    """
+    不使用词表，按cl100k_base的切分方式估算token数
+
+    中日韩字符每字1个token；常见英文单词是1个token，8个字母以上的长单词按每5个字母1个token；
+    数字每3位1个token；符号串中常见的组合（如"..."、"://"）会合并，按每2个字符1个token；
+    换行和连续空白各1个token
+    """
+    tokens = len(_PIECES.findall(text))
+    for word in _LONG_WORDS.findall(text):
+        tokens += (len(word) + 4) // 5 - 1
+    for symbols in _LONG_SYMBOLS.findall(text):
+        tokens += (len(symbols) + 1) // 2 - 1
+    return tokens
+
+
+class Tokenizer:
+    """离线token计数器
+
+    安装了tiktoken且本地已缓存指定编码的词表时使用tiktoken精确计数；
+    否则使用内置规则估算（不需要词表文件，不访问网络），见_estimate_tokens。
+    """
+
+    def __init__(self, encoding_name='cl100k_base', image_tokens=765):
+        """
+        初始化token计数器
+
+        Args:
+            encoding_name: tiktoken编码名称，为空时只使用内置规则
+            image_tokens: 每张图片预估占用的token数
+        """
+        self.encoding_name = encoding_name
+        self.image_tokens = image_tokens
+        self._encoding = None
+        self._loaded = not (encoding_name and TIKTOKEN_AVAILABLE)
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        """当前使用的计数方式"""
+        return f'tiktoken:{self.encoding_name}' if self._get_encoding() else 'builtin'
+
+    def _get_encoding(self):
+        """首次使用时加载tiktoken编码，加载失败（如离线且词表未缓存）时退回内置规则"""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        logger.warning(f"无法加载tiktoken编码 {self.encoding_name}，使用内置规则估算token数: {str(e)}")
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text):
+        """
+        计算文本的token数
+
+        Args:
+            text: 文本
+
+        Returns:
+            int: token数
+        """
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return _estimate_tokens(text)
+
+    def count_messages(self, messages):
+        """
+        计算一组对话消息的提示词token数（包括每条消息的角色和分隔符开销）
+
+        Args:
+            messages: API请求的messages列表
+
+        Returns:
+            int: token数
+        """
+        tokens = 0
+        for message in messages or []:
+            content = message.get('content')
+            if isinstance(content, list):
+                for part in content:
+                    if part.get('type') == 'text':
+                        tokens += self.count(part.get('text', ''))
+                    else:
+                        tokens += self.image_tokens
+            else:
+                tokens += self.count(content or '')
+            tokens += 4
+        return tokens
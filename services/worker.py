@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+独立Worker进程：从SQLite任务队列领取行批次并调用LLM处理
+
+用法（在项目根目录下运行，可以同时启动多个进程）:
+    python -m services.worker [--threads N] [--worker-id ID]
+
+远程节点通过协调端的HTTP接口领取批次（不需要访问协调端的数据库）:
+    python -m services.worker --coordinator http://主机:5001 --token 令牌 [--payload prompt|row]
+"""
+
+import os
+import socket
+import argparse
+import logging
+import threading
+import concurrent.futures
+import requests
+from database.models import Task, TaskLog, TaskJob, APIConfig
+from services.excel_service import RowAccessor
+
+logger = logging.getLogger(__name__)
+
+class TaskWorker:
+    """任务队列Worker
+
+    循环领取执行引擎为worker的任务写入的队列任务：行批次逐行调用LLM并写入任务日志，
+    finalize任务生成结果文件。领取后由心跳线程定期续约，租约被其他Worker接管或任务
+    被停止时放弃当前批次。
+    """
+
+    def __init__(self, app, worker_id=None, threads=1):
+        """
+        初始化Worker
+
+        Args:
+            app: Flask应用实例（提供配置和各服务）
+            worker_id: Worker标识，默认为"主机名-进程号"
+            threads: 同时处理的队列任务数
+        """
+        self.app = app
+        self.task_service = app.task_service
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.threads = max(1, int(threads))
+        self.lease_seconds = app.config.get('WORKER_LEASE_SECONDS', 60)
+        self.poll_interval = app.config.get('WORKER_POLL_INTERVAL', 1.0)
+        self._shutdown = threading.Event()
+        self._data_cache = {}   # (schema_id, 列) -> RowAccessor
+        self._registered = {}   # 任务ID -> 正在处理的批次数
+        self._lock = threading.Lock()
+
+    def run(self):
+        """启动领取循环，直到收到中断信号"""
+        loops = [
+            threading.Thread(target=self._loop, name=f"task-worker-{i}", daemon=True)
+            for i in range(self.threads)
+        ]
+        for thread in loops:
+            thread.start()
+        logger.info(f"Worker {self.worker_id} 已启动，同时处理 {self.threads} 个批次")
+
+        try:
+            while any(thread.is_alive() for thread in loops):
+                for thread in loops:
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            logger.info(f"Worker {self.worker_id} 收到中断信号，处理完当前批次后退出")
+            self.stop()
+            for thread in loops:
+                thread.join()
+
+    def stop(self):
+        """通知所有领取循环退出"""
+        self._shutdown.set()
+
+    def _loop(self):
+        """领取循环：每个线程使用独立的应用上下文（即独立的数据库连接）"""
+        with self.app.app_context():
+            while not self._shutdown.is_set():
+                try:
+                    jobs = self._claim_jobs()
+                except Exception as e:
+                    logger.error(f"领取队列任务时出错: {str(e)}")
+                    jobs = []
+
+                if not jobs:
+                    self._shutdown.wait(self.poll_interval)
+                    continue
+
+                for job in jobs:
+                    try:
+                        self.run_job(job)
+                    except Exception as e:
+                        logger.error(f"处理队列任务时出错: {str(e)}")
+
+    def _claim_jobs(self):
+        """从本地数据库的任务队列领取一个队列任务"""
+        job = TaskJob.claim(self.worker_id, self.lease_seconds)
+        return [job] if job else []
+
+    def run_job(self, job):
+        """
+        处理一个已领取的队列任务
+
+        Args:
+            job: 队列任务
+        """
+        task = Task.get_by_id(job.task_id)
+        if not task or task.status != Task.STATUS_RUNNING:
+            return
+
+        stop_event = threading.Event()   # 租约丢失或任务停止
+        finished = threading.Event()     # 队列任务处理结束
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(job, stop_event, finished),
+            daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            if job.kind == TaskJob.KIND_FINALIZE:
+                self._finalize(task, job)
+            else:
+                self._process_rows(task, job, stop_event)
+        finally:
+            finished.set()
+            heartbeat.join()
+
+    def _heartbeat(self, job, stop_event, finished):
+        """
+        心跳线程：定期续约并检查任务状态
+
+        Args:
+            job: 队列任务
+            stop_event: 需要放弃当前批次时设置
+            finished: 队列任务处理结束事件
+        """
+        interval = max(1.0, min(self.lease_seconds / 3, 5.0))
+        with self.app.app_context():
+            while not finished.wait(interval):
+                try:
+                    if not job.heartbeat(self.lease_seconds):
+                        logger.warning(f"队列任务 {job.id} 的租约已被其他Worker接管，放弃当前批次")
+                        stop_event.set()
+                        return
+                    task = Task.get_by_id(job.task_id)
+                    if not task or task.status != Task.STATUS_RUNNING:
+                        logger.info(f"任务 {job.task_id} 已停止，放弃队列任务 {job.id}")
+                        stop_event.set()
+                        return
+                except Exception as e:
+                    logger.error(f"队列任务 {job.id} 续约失败: {str(e)}")
+
+    def _process_rows(self, task, job, stop_event):
+        """
+        处理一个行批次：跳过已有成功日志的行，其余行并发调用LLM
+
+        Args:
+            task: 任务对象
+            job: 队列任务
+            stop_event: 停止事件
+        """
+        # 批次可能在上一个Worker失联前已部分完成
+        succeeded = TaskLog.get_succeeded_rows(task.id, job.row_indexes)
+        rows = [i for i in job.row_indexes if i not in succeeded]
+
+        processed = 0
+        success = 0
+        error = 0
+
+        if rows:
+            data = self.get_task_data(task)
+            self._register(task)
+            try:
+                workers = max(1, min(task.concurrency, len(rows)))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [
+                        executor.submit(self.task_service._process_row, task, data.row(i), i, stop_event)
+                        for i in rows
+                    ]
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            _, is_success = future.result()
+                        except Exception as e:
+                            logger.error(f"处理行结果时出错: {str(e)}")
+                            is_success = False
+
+                        # 停止后被放弃的行没有写入日志，不计入进度
+                        if is_success is None:
+                            continue
+                        if is_success:
+                            processed += 1
+                            success += 1
+                        elif not stop_event.is_set():
+                            processed += 1
+                            error += 1
+            finally:
+                self._unregister(task.id)
+                # 批次结束（包括被停止）前提交本批次的日志，finalize和续跑依赖这些日志
+                self.task_service.log_writer.flush()
+
+        if processed:
+            Task.add_progress(task.id, processed, success, error)
+
+        if stop_event.is_set():
+            return
+        if not job.complete():
+            logger.warning(f"队列任务 {job.id} 完成时租约已失效")
+        logger.info(f"Worker {self.worker_id} 完成任务 {task.id} 的批次 {job.id}：成功 {success}，失败 {error}")
+
+    def _finalize(self, task, job):
+        """
+        生成结果文件并标记任务完成
+
+        Args:
+            task: 任务对象
+            job: finalize队列任务
+        """
+        try:
+            self.task_service.finalize_worker_task(task)
+        except Exception as e:
+            logger.error(f"任务 {task.id} 生成结果时出错: {str(e)}")
+            Task.set_status(task.id, Task.STATUS_ERROR)
+        job.complete()
+
+    def get_task_data(self, task):
+        """
+        获取任务数据（只包含模板和图片字段用到的列），同一个Excel文件的同一组列只读取一次
+
+        Args:
+            task: 任务对象
+
+        Returns:
+            RowAccessor: 任务数据的行访问器
+        """
+        excel_service = self.task_service.excel_service
+        columns = excel_service.get_task_columns(task.schema_id, task.prompt_template, task.image_fields)
+        key = (task.schema_id, tuple(columns) if columns is not None else None)
+
+        with self._lock:
+            data = self._data_cache.get(key)
+        if data is None:
+            df, _ = excel_service.get_excel_data(task.schema_id, columns)
+            data = RowAccessor(df)
+            with self._lock:
+                # 只缓存最近使用的几个文件
+                if len(self._data_cache) >= 4:
+                    self._data_cache.pop(next(iter(self._data_cache)))
+                self._data_cache[key] = data
+        return data
+
+    def _register(self, task):
+        """在本进程的全局调度器中注册任务（同一任务的多个批次共用一次注册）"""
+        with self._lock:
+            count = self._registered.get(task.id, 0)
+            if count == 0:
+                config = self.task_service.register_scheduler_task(task)
+                self.task_service.start_cache_stats(task.id, config)
+            self._registered[task.id] = count + 1
+
+    def _unregister(self, task_id):
+        """批次处理结束后减少注册计数，归零时从调度器注销"""
+        with self._lock:
+            count = self._registered.get(task_id, 0) - 1
+            if count > 0:
+                self._registered[task_id] = count
+                return
+            self._registered.pop(task_id, None)
+            self.task_service.scheduler.unregister_task(task_id)
+            self.task_service.save_cache_stats(task_id)
+            self.task_service.task_routing.pop(task_id, None)
+
+
+class RemoteTaskWorker(TaskWorker):
+    """远程Worker
+
+    通过协调端的/worker/lease、/worker/heartbeat和/worker/results接口工作：
+    领取批次时获得提示词（或原始行数据）和API配置，在本机下载图片、调用LLM，
+    再把结果批量回传。本机数据库只用于读取配置，任务状态全部由协调端维护。
+    """
+
+    def __init__(self, app, coordinator_url, token, worker_id=None, threads=1, payload='prompt',
+                 flush_size=20):
+        """
+        初始化远程Worker
+
+        Args:
+            app: Flask应用实例（提供配置和LLM、图片服务）
+            coordinator_url: 协调端地址，例如 http://127.0.0.1:5001
+            token: 共享令牌（与协调端的WORKER_TOKEN一致）
+            worker_id: Worker标识
+            threads: 同时处理的批次数
+            payload: 领取的内容，prompt（协调端渲染提示词）或row（原始行数据，本机渲染）
+            flush_size: 累计多少条结果回传一次
+        """
+        super().__init__(app, worker_id=worker_id, threads=threads)
+        self.coordinator_url = coordinator_url.rstrip('/')
+        self.payload = payload
+        self.flush_size = max(1, int(flush_size))
+        self.session = requests.Session()
+        self.session.headers['X-Worker-Token'] = token or ''
+
+    def _post(self, path, data):
+        """
+        调用协调端接口
+
+        Returns:
+            tuple: (HTTP状态码, 响应JSON)
+        """
+        response = self.session.post(f"{self.coordinator_url}{path}", json=data, timeout=30)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return response.status_code, body
+
+    def _claim_jobs(self):
+        """通过协调端领取批次"""
+        status, body = self._post('/worker/lease', {
+            'worker_id': self.worker_id,
+            'max_jobs': 1,
+            'payload': self.payload
+        })
+        if status != 200:
+            raise ValueError(f"协调端返回 {status}: {body.get('error')}")
+        self.lease_seconds = body.get('lease_seconds', self.lease_seconds)
+        return body.get('jobs', [])
+
+    def run_job(self, job):
+        """
+        处理协调端下发的批次
+
+        Args:
+            job: 批次数据（见WorkerCoordinator._build_job_payload）
+        """
+        stop_event = threading.Event()
+        finished = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(job, stop_event, finished),
+            daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            self._process_remote_rows(job, stop_event)
+        finally:
+            finished.set()
+            heartbeat.join()
+
+    def _heartbeat(self, job, stop_event, finished):
+        """心跳线程：定期向协调端续约，租约失效或任务停止时放弃批次"""
+        interval = max(1.0, min(self.lease_seconds / 3, 5.0))
+        while not finished.wait(interval):
+            try:
+                status, body = self._post('/worker/heartbeat', {
+                    'job_id': job['job_id'],
+                    'lease_token': job['lease_token']
+                })
+                if status == 409 or (status == 200 and not body.get('task_running')):
+                    logger.info(f"批次 {job['job_id']} 的租约已失效或任务已停止，放弃当前批次")
+                    stop_event.set()
+                    return
+            except Exception as e:
+                logger.error(f"批次 {job['job_id']} 续约失败: {str(e)}")
+
+    def _process_remote_rows(self, job, stop_event):
+        """
+        并发处理批次中的行并分批回传结果
+
+        Args:
+            job: 批次数据
+            stop_event: 停止事件
+        """
+        config = APIConfig.from_dict(job['api_config'])
+        rows = job.get('rows', [])
+        pending = []
+        success = 0
+
+        if rows:
+            workers = max(1, min(int(job.get('concurrency') or 1), len(rows)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self._process_remote_row, job, config, row, stop_event)
+                    for row in rows
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    result = future.result()
+                    if result is None:
+                        continue
+                    if result['status'] == TaskLog.STATUS_SUCCESS:
+                        success += 1
+                    pending.append(result)
+                    if len(pending) >= self.flush_size and not stop_event.is_set():
+                        if not self._submit(job, pending, complete=False):
+                            stop_event.set()
+                        pending = []
+
+        if stop_event.is_set():
+            # 已完成的行仍然回传，批次留给租约过期后重新领取
+            if pending:
+                self._submit(job, pending, complete=False)
+            return
+
+        if self._submit(job, pending, complete=True):
+            logger.info(f"Worker {self.worker_id} 完成任务 {job['task_id']} 的批次 {job['job_id']}：成功 {success}，失败 {len(rows) - success}")
+
+    def _process_remote_row(self, job, config, row, stop_event):
+        """
+        处理单行：渲染提示词（如需要）、获取图片、调用LLM
+
+        Returns:
+            dict: 回传给协调端的结果，任务停止时返回None
+        """
+        if stop_event.is_set():
+            return None
+
+        row_index = row['row_index']
+        with self.app.app_context():
+            try:
+                row_data = row.get('row_data') or {}
+                prompt = row.get('prompt')
+                if prompt is None:
+                    prompt = self.task_service.excel_service.process_template(job['prompt_template'], row_data)
+
+                image_data = None
+                if job.get('image_fields'):
+                    try:
+                        image_data = self.task_service.image_service.extract_image_data_from_row(
+                            row_data, job['image_fields']
+                        )
+                    except Exception as e:
+                        logger.warning(f"处理图片数据时出错: {str(e)}")
+
+                response_text, token_count, completion_tokens, processing_time = self.task_service.llm_service.call_api(
+                    prompt, image_data, config
+                )
+                return {
+                    'row_index': row_index,
+                    'status': TaskLog.STATUS_SUCCESS,
+                    'response_text': response_text,
+                    'token_count': token_count,
+                    'completion_tokens': completion_tokens,
+                    'processing_time': processing_time
+                }
+            except Exception as e:
+                logger.error(f"处理行 {row_index} 时出错: {str(e)}")
+                return {
+                    'row_index': row_index,
+                    'status': TaskLog.STATUS_ERROR,
+                    'error_message': str(e)
+                }
+
+    def _submit(self, job, results, complete):
+        """
+        回传结果
+
+        Returns:
+            bool: 是否被协调端接受（租约失效时返回False）
+        """
+        try:
+            status, body = self._post('/worker/results', {
+                'job_id': job['job_id'],
+                'lease_token': job['lease_token'],
+                'results': results,
+                'complete': complete
+            })
+        except Exception as e:
+            logger.error(f"回传批次 {job['job_id']} 的结果失败: {str(e)}")
+            return False
+        if status != 200:
+            logger.warning(f"协调端拒绝了批次 {job['job_id']} 的结果: {body.get('error')}")
+            return False
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ExcelLLM任务队列Worker')
+    parser.add_argument('--threads', type=int, default=1, help='同时处理的批次数（默认1）')
+    parser.add_argument('--worker-id', default=None, help='Worker标识，默认为"主机名-进程号"')
+    parser.add_argument('--coordinator', default=None, help='协调端地址，设置后以远程模式运行')
+    parser.add_argument('--token', default=os.environ.get('EXCEL_LLM_WORKER_TOKEN', ''),
+                        help='远程模式的共享令牌，默认读取环境变量EXCEL_LLM_WORKER_TOKEN')
+    parser.add_argument('--payload', choices=['prompt', 'row'], default='prompt',
+                        help='远程模式领取的内容：prompt（渲染后的提示词）或row（原始行数据）')
+    args = parser.parse_args()
+
+    from app import app
+    if args.coordinator:
+        worker = RemoteTaskWorker(
+            app, args.coordinator, args.token,
+            worker_id=args.worker_id, threads=args.threads, payload=args.payload
+        )
+    else:
+        worker = TaskWorker(app, worker_id=args.worker_id, threads=args.threads)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+用本地模拟的Batch API（tools/mock_batch_api.py）验证batch执行引擎
+
+把项目复制到临时目录后在子进程中运行应用（不影响本地的数据库和结果文件），检查两个场景:
+    1. 完整运行：所有行按custom_id写回结果，相同的请求只提交一次，返回错误的行记为失败
+    2. 进程重启：批处理提交后子进程直接退出（模拟崩溃），新进程续跑时接管原批处理，
+       不重新提交，所有行只有一条成功日志
+
+用法（在项目根目录下运行）:
+    python -m tools.batch_check [--rows 40]
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from tools.mock_batch_api import start_server
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+# 在子进程中运行的应用脚本：argv为 阶段 模拟接口地址 行数 [任务ID]
+CHILD_SCRIPT = r'''
+import io, os, sys, json, time, sqlite3
+stage, api_url, rows = sys.argv[1], sys.argv[2], int(sys.argv[3])
+from app import app
+app.config['BATCH_POLL_INTERVAL'] = 0.2
+database = app.config['DATABASE']
+client = app.test_client()
+
+def wait_task(task_id):
+    for _ in range(600):
+        status = client.get(f'/task_status/{task_id}').json
+        if status['status'] not in ('pending', 'running'):
+            return status
+        time.sleep(0.1)
+    return status
+
+def summary(task_id):
+    status = wait_task(task_id)
+    conn = sqlite3.connect(database)
+    logs = conn.execute(
+        "SELECT row_index, COUNT(*), SUM(status = 'success') FROM task_logs WHERE task_id = ? GROUP BY row_index",
+        (task_id,)
+    ).fetchall()
+    pending_batches = conn.execute("SELECT COUNT(*) FROM task_batches WHERE task_id = ?", (task_id,)).fetchone()[0]
+    results = []
+    if status.get('result_path'):
+        import pandas as pd
+        results = [str(value) for value in pd.read_excel(status['result_path'])['处理结果']]
+    return {
+        'status': status['status'], 'success_count': status['success_count'], 'error_count': status['error_count'],
+        'results': results, 'max_logs_per_row': max((count for _, count, _ in logs), default=0),
+        'logged_rows': len(logs), 'pending_batches': pending_batches
+    }
+
+if stage in ('run', 'start'):
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE api_configs SET url = ?, api_key = 'mock' WHERE id = 1", (api_url,))
+    conn.commit()
+    # 每5行中有1行与前一行相同，用于检查请求去重
+    csv = 'title\n' + ''.join(f't{i - 1 if i % 5 == 4 else i}\n' for i in range(rows))
+    schema_id = client.post(
+        '/upload', data={'file': (io.BytesIO(csv.encode()), 'rows.csv')}, content_type='multipart/form-data'
+    ).json['schema_id']
+    task_id = client.post('/process', json={
+        'schema_id': schema_id, 'prompt_template': 'T={{title}}', 'concurrency': 1, 'engine': 'batch'
+    }).json['task_id']
+
+    if stage == 'start':
+        # 批处理提交并记录后直接退出，不做任何清理（模拟进程崩溃）
+        for _ in range(300):
+            if sqlite3.connect(database).execute(
+                "SELECT COUNT(*) FROM task_batches WHERE task_id = ?", (task_id,)
+            ).fetchone()[0]:
+                break
+            time.sleep(0.05)
+        print('RESULT ' + json.dumps({'task_id': task_id}), flush=True)
+        os._exit(0)
+else:
+    task_id = int(sys.argv[4])
+    response = client.post(f'/resume_task/{task_id}')
+    if response.status_code != 200:
+        print('RESULT ' + json.dumps({'error': response.json}), flush=True)
+        sys.exit(1)
+
+print('RESULT ' + json.dumps(summary(task_id), ensure_ascii=False), flush=True)
+'''
+
+
+def expected_results(rows):
+    return [f'ECHO:T=t{i - 1 if i % 5 == 4 else i}' for i in range(rows)]
+
+
+def run_child(workdir, stage, api_url, rows, task_id=None):
+    """在临时目录中运行应用子进程，返回其输出的结果"""
+    args = [sys.executable, '-c', CHILD_SCRIPT, stage, api_url, str(rows)]
+    if task_id is not None:
+        args.append(str(task_id))
+    proc = subprocess.run(args, cwd=workdir, capture_output=True, text=True, timeout=300)
+    for line in proc.stdout.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    raise RuntimeError(f"子进程没有输出结果（退出码 {proc.returncode}）:\n{proc.stderr[-3000:]}")
+
+
+def check(name, condition, detail=''):
+    print(f"  [{'通过' if condition else '失败'}] {name}" + (f": {detail}" if detail and not condition else ''))
+    return condition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用本地模拟的Batch API验证batch执行引擎')
+    parser.add_argument('--rows', type=int, default=40, help='测试数据的行数')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录')
+    args = parser.parse_args()
+    rows = args.rows
+    unique = len(set(expected_results(rows)))
+
+    server, state = start_server(0)
+    api_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    tempdir = tempfile.mkdtemp(prefix='batch_check_')
+    workdir = os.path.join(tempdir, 'app')
+    shutil.copytree(PROJECT_DIR, workdir, ignore=shutil.ignore_patterns(
+        '.git', '__pycache__', 'uploads', 'results', '*.db', '*.db-*', '*.log'
+    ))
+    ok = True
+
+    try:
+        # 第4行与第3行的请求相同，共用row-3的结果
+        print("场景1: 完整运行（custom_id为row-3的请求返回错误，第3、4行失败）")
+        state.fail_ids = {'row-3'}
+        result = run_child(workdir, 'run', api_url, rows)
+        stats = state.stats()
+        expected = expected_results(rows)
+        ok &= check('任务完成', result['status'] == 'completed', result['status'])
+        ok &= check('相同的请求只提交一次', stats['batch_requests'] == unique, f"{stats['batch_requests']} != {unique}")
+        ok &= check('没有逐行调用', stats['chat_requests'] == 0, stats['chat_requests'])
+        ok &= check('失败的请求记为失败', result['error_count'] == 2, result['error_count'])
+        wrong = [i for i, value in enumerate(result['results']) if i not in (3, 4) and value != expected[i]]
+        ok &= check('结果按行写回', len(result['results']) == rows and not wrong, f"错误的行: {wrong[:5]}")
+        ok &= check('批处理记录已清理', result['pending_batches'] == 0, result['pending_batches'])
+
+        print("场景2: 批处理提交后进程退出，新进程续跑")
+        state.fail_ids = set()
+        state.hold = True
+        before = state.stats()
+        task_id = run_child(workdir, 'start', api_url, rows)['task_id']
+        submitted = state.stats()
+        state.hold = False
+        result = run_child(workdir, 'resume', api_url, rows, task_id)
+        after = state.stats()
+        ok &= check('退出前已提交批处理', submitted['batches'] == before['batches'] + 1)
+        ok &= check('续跑没有重新提交', after['batches'] == submitted['batches']
+                    and after['batch_requests'] == submitted['batch_requests'],
+                    f"{submitted} -> {after}")
+        ok &= check('任务完成', result.get('status') == 'completed', result)
+        ok &= check('所有行成功', result.get('success_count') == rows, result.get('success_count'))
+        ok &= check('结果按行写回', result.get('results') == expected)
+        ok &= check('每行只有一条日志', result.get('max_logs_per_row') == 1, result.get('max_logs_per_row'))
+        ok &= check('批处理记录已清理', result.get('pending_batches') == 0, result.get('pending_batches'))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"临时目录: {tempdir}")
+        else:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    print('全部通过' if ok else '有检查未通过')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟的OpenAI兼容接口（只使用标准库），用于在没有真实服务商的情况下验证执行引擎
+
+支持的接口:
+    POST /v1/chat/completions          返回 "ECHO:" + 最后一条用户消息
+    POST /v1/files                     上传批处理请求文件（multipart/form-data）
+    GET  /v1/files/<文件ID>/content     下载结果文件或错误文件
+    POST /v1/batches                   创建批处理
+    GET  /v1/batches/<批处理ID>         查询批处理状态，查询polls_before_done次后完成
+    POST /v1/batches/<批处理ID>/cancel  取消批处理
+    GET  /mock/stats                   已创建的批处理数和批处理中的请求数
+
+用法:
+    python -m tools.mock_batch_api [--port 18080]
+"""
+
+import re
+import json
+import uuid
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockState:
+    """模拟服务的状态（线程安全）"""
+
+    def __init__(self, polls_before_done=2):
+        """
+        初始化模拟服务的状态
+
+        Args:
+            polls_before_done: 批处理被查询多少次后完成
+        """
+        self.polls_before_done = polls_before_done
+        self.hold = False          # 为True时批处理一直停留在in_progress状态
+        self.fail_ids = set()      # 返回错误结果的custom_id
+        self.files = {}
+        self.batches = {}
+        self.chat_requests = 0
+        self.batch_requests = 0    # 所有批处理中的请求总数
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': len(self.batches),
+                'batch_requests': self.batch_requests,
+                'chat_requests': self.chat_requests
+            }
+
+
+def _echo(body):
+    """模拟的模型输出：最后一条用户消息的文本"""
+    messages = body.get('messages') or []
+    content = messages[-1]['content'] if messages else ''
+    if isinstance(content, list):
+        content = ''.join(part.get('text', '') for part in content if part.get('type') == 'text')
+    return 'ECHO:' + content
+
+
+def _public(batch):
+    """返回给客户端的批处理对象"""
+    return {key: value for key, value in batch.items() if key not in ('lines', 'polls')}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, obj=None, raw=None):
+        out = raw if raw is not None else json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def do_POST(self):
+        data = self._read_body()
+        state = self.state
+
+        if self.path == '/v1/chat/completions':
+            body = json.loads(data or b'{}')
+            with state.lock:
+                state.chat_requests += 1
+            return self._send(200, {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': 0, 'model': body.get('model', 'mock'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': _echo(body)}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+            })
+
+        if self.path == '/v1/files':
+            message = BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers.get('Content-Type', '').encode() + b'\r\n\r\n' + data
+            )
+            content = None
+            purpose = None
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if name == 'file':
+                    content = part.get_payload(decode=True)
+                elif name == 'purpose':
+                    purpose = part.get_payload(decode=True).decode()
+            file_id = 'file-' + uuid.uuid4().hex[:12]
+            with state.lock:
+                state.files[file_id] = content or b''
+            return self._send(200, {'id': file_id, 'object': 'file', 'purpose': purpose, 'bytes': len(content or b'')})
+
+        if self.path == '/v1/batches':
+            body = json.loads(data or b'{}')
+            with state.lock:
+                content = state.files.get(body.get('input_file_id'))
+                if content is None:
+                    return self._send(404, {'error': {'message': 'input file not found'}})
+                lines = [json.loads(line) for line in content.decode('utf-8').splitlines() if line.strip()]
+                batch_id = 'batch_' + uuid.uuid4().hex[:12]
+                state.batches[batch_id] = {
+                    'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint'), 'status': 'validating',
+                    'metadata': body.get('metadata'), 'lines': lines, 'polls': 0,
+                    'request_counts': {'total': len(lines), 'completed': 0, 'failed': 0}
+                }
+                state.batch_requests += len(lines)
+                return self._send(200, _public(state.batches[batch_id]))
+
+        match = re.match(r'^/v1/batches/([^/]+)/cancel$', self.path)
+        if match:
+            with state.lock:
+                batch = state.batches.get(match.group(1))
+                if batch is None:
+                    return self._send(404, {'error': {'message': 'batch not found'}})
+                if batch['status'] not in ('completed', 'failed', 'expired'):
+                    batch['status'] = 'cancelled'
+                return self._send(200, _public(batch))
+
+        return self._send(404, {'error': {'message': 'not found'}})
+
+    def do_GET(self):
+        state = self.state
+
+        if self.path == '/mock/stats':
+            return self._send(200, state.stats())
+
+        match = re.match(r'^/v1/batches/([^/]+)$', self.path)
+        if match:
+            with state.lock:
+                batch = state.batches.get(match.group(1))
+                if batch is None:
+                    return self._send(404, {'error': {'message': 'batch not found'}})
+                if batch['status'] in ('validating', 'in_progress'):
+                    batch['status'] = 'in_progress'
+                    batch['polls'] += 1
+                    if not state.hold and batch['polls'] >= state.polls_before_done:
+                        self._complete(batch)
+                return self._send(200, _public(batch))
+
+        match = re.match(r'^/v1/files/([^/]+)/content$', self.path)
+        if match:
+            with state.lock:
+                content = state.files.get(match.group(1))
+            if content is None:
+                return self._send(404, {'error': {'message': 'file not found'}})
+            return self._send(200, raw=content)
+
+        return self._send(404, {'error': {'message': 'not found'}})
+
+    def _complete(self, batch):
+        """生成结果文件和错误文件并把批处理标记为完成（调用方持有state.lock）"""
+        state = self.state
+        outputs = []
+        errors = []
+        for line in batch['lines']:
+            custom_id = line['custom_id']
+            if custom_id in state.fail_ids:
+                errors.append({'id': 'req-' + custom_id, 'custom_id': custom_id, 'response': {
+                    'status_code': 400, 'body': {'error': {'message': 'mock failure'}}
+                }, 'error': None})
+            else:
+                outputs.append({'id': 'req-' + custom_id, 'custom_id': custom_id, 'response': {
+                    'status_code': 200, 'body': {
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': _echo(line['body'])}}],
+                        'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+                    }
+                }, 'error': None})
+
+        for key, records in (('output_file_id', outputs), ('error_file_id', errors)):
+            if records:
+                file_id = 'file-' + uuid.uuid4().hex[:12]
+                state.files[file_id] = ''.join(
+                    json.dumps(record, ensure_ascii=False) + '\n' for record in records
+                ).encode('utf-8')
+                batch[key] = file_id
+        batch['status'] = 'completed'
+        batch['request_counts'] = {'total': len(batch['lines']), 'completed': len(outputs), 'failed': len(errors)}
+
+
+def start_server(port=18080, state=None):
+    """
+    在后台线程中启动模拟服务
+
+    Args:
+        port: 监听端口（0表示随机端口）
+        state: 模拟服务的状态，为None时新建
+
+    Returns:
+        tuple: (服务器对象, 模拟服务的状态)
+    """
+    state = state or MockState()
+    handler = type('BoundMockHandler', (MockHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-batch-api', daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的OpenAI兼容Batch API')
+    parser.add_argument('--port', type=int, default=18080, help='监听端口')
+    parser.add_argument('--polls', type=int, default=2, help='批处理被查询多少次后完成')
+    args = parser.parse_args()
+
+    server, _ = start_server(args.port, MockState(polls_before_done=args.polls))
+    print(f"模拟接口已启动: http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()